@@ -1,9 +1,10 @@
 # 02_document_loading.py - 文件載入與處理
 import os
 from dotenv import load_dotenv
-from llama_index.core import Document, SimpleDirectoryReader
+from llama_index.core import Document
 from llama_index.readers.file import PDFReader, DocxReader
 from llama_index.readers.web import BeautifulSoupWebReader
+from parallel_ingest import ParallelIngestPipeline
 
 # 載入環境變數
 load_dotenv()
@@ -72,16 +73,22 @@ def load_documents_from_directory(directory_path):
     """從資料夾載入所有文件"""
     print(f"\n📁 從資料夾載入文件: {directory_path}")
     
-    # 使用 SimpleDirectoryReader 載入所有文件
-    reader = SimpleDirectoryReader(
+    # 在行程池中平行解析（每個檔案仍由 SimpleDirectoryReader 依副檔名選擇讀取器），
+    # 檔案惰性走訪、各有逾時限制，解析失敗的檔案會被略過並記錄
+    pipeline = ParallelIngestPipeline(
         input_dir=directory_path,
         recursive=True,  # 遞歸搜尋子資料夾
-        required_exts=[".txt", ".md", ".py"]  # 指定檔案類型
+        required_exts=[".txt", ".md", ".py"],  # 指定檔案類型
+        split=False,  # 只解析成 Document，切塊留給索引建立時處理
+        file_timeout=60.0
     )
     
-    documents = reader.load_data()
+    # 依檔案路徑排序，輸出順序與逐一載入時相同
+    documents = [doc for _, docs in sorted(pipeline) for doc in docs]
     
-    print(f"✅ 載入了 {len(documents)} 個文件")
+    print(f"✅ 載入了 {len(documents)} 個文件（{pipeline.stats['seconds']:.2f} 秒）")
+    for path, error in pipeline.errors:
+        print(f"   ⚠️ 略過 {path}: {error}")
     for i, doc in enumerate(documents):
         print(f"   文件 {i+1}: {doc.metadata.get('file_path', 'Unknown')}")
         print(f"   內容長度: {len(doc.text)} 字元")
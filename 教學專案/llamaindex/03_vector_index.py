@@ -4,16 +4,20 @@ from dotenv import load_dotenv
 from llama_index.core import (
     VectorStoreIndex, 
     SimpleDirectoryReader,
-    StorageContext,
-    load_index_from_storage
+    StorageContext
 )
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.embeddings.openai import OpenAIEmbedding
 import chromadb
+from embedding_cache import install_embedding_cache
+from numpy_vector_store import NumpyVectorStore
 
 # 載入環境變數
 load_dotenv()
 
+# 啟用持久化嵌入快取，各範例對相同切塊只需嵌入一次
+install_embedding_cache()
+
 def create_basic_vector_index():
     """建立基本的向量索引"""
     print("🔨 建立基本向量索引...")
@@ -46,28 +50,41 @@ def create_persistent_index():
     persist_dir = "./storage"
     if os.path.exists(persist_dir):
         print("📂 載入現有索引...")
-        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
-        index = load_index_from_storage(storage_context)
-        print("✅ 索引載入完成！")
-    else:
-        print("🆕 建立新索引...")
-        
-        # 載入文件
-        documents_dir = "sample_documents"
-        if not os.path.exists(documents_dir):
-            print("❌ 找不到範例文件，請先執行 02_document_loading.py")
-            return None
-            
-        reader = SimpleDirectoryReader(input_dir=documents_dir)
-        documents = reader.load_data()
-        
-        # 建立索引並持久化
-        index = VectorStoreIndex.from_documents(
-            documents,
-            storage_context=StorageContext.from_defaults(persist_dir=persist_dir)
-        )
+        try:
+            # 向量 .npy 與節點紀錄檔都以記憶體映射開啟，不解析 docstore JSON，
+            # 開啟時間與索引大小無關，頁面在查詢用到時才載入
+            vector_store = NumpyVectorStore.from_persist_dir(persist_dir)
+            index = VectorStoreIndex.from_vector_store(vector_store)
+            print("✅ 索引載入完成！")
+            print(f"   向量數量: {vector_store.node_count}（{vector_store.dtype}）")
+            return index
+        except (FileNotFoundError, ValueError) as e:
+            print(f"⚠️ 無法載入現有索引（{e}），重新建立...")
+    
+    print("🆕 建立新索引...")
+    
+    # 載入文件
+    documents_dir = "sample_documents"
+    if not os.path.exists(documents_dir):
+        print("❌ 找不到範例文件，請先執行 02_document_loading.py")
+        return None
         
-        print("✅ 持久化索引建立完成！")
+    reader = SimpleDirectoryReader(input_dir=documents_dir)
+    documents = reader.load_data()
+    
+    # 向量以 float16 存放在單一連續陣列（每維 2 bytes，Python float 串列每維約 32 bytes）；
+    # 重新計分用的 float32 向量寫在暫存檔並以記憶體映射讀取，不佔常駐記憶體。
+    # 節點文字也存在向量儲存中，不寫入 docstore
+    vector_store = NumpyVectorStore(dtype="float16", stores_text=True)
+    
+    # 建立索引並持久化
+    index = VectorStoreIndex.from_documents(
+        documents,
+        storage_context=StorageContext.from_defaults(vector_store=vector_store)
+    )
+    index.storage_context.persist(persist_dir=persist_dir)
+    
+    print("✅ 持久化索引建立完成！")
     
     return index
 
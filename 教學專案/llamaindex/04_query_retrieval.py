@@ -4,16 +4,24 @@ from dotenv import load_dotenv
 from llama_index.core import (
     VectorStoreIndex, 
     SimpleDirectoryReader,
-    QueryBundle,
-    ResponseMode
+    StorageContext,
+    QueryBundle
 )
+from llama_index.core.response_synthesizers import ResponseMode
 from llama_index.core.retrievers import VectorIndexRetriever
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.postprocessor import SimilarityPostprocessor
+from batch_retrieval import BatchVectorIndexRetriever
+from embedding_cache import install_embedding_cache
+from multi_synthesis import MultiSynthesisEngine
+from numpy_vector_store import NumpyVectorStore
 
 # 載入環境變數
 load_dotenv()
 
+# 啟用持久化嵌入快取，各範例對相同切塊只需嵌入一次
+install_embedding_cache()
+
 def setup_index():
     """設定索引用於查詢示範"""
     print("🔧 設定索引...")
@@ -27,8 +35,9 @@ def setup_index():
     reader = SimpleDirectoryReader(input_dir=documents_dir)
     documents = reader.load_data()
     
-    # 建立索引
-    index = VectorStoreIndex.from_documents(documents)
+    # 建立索引：NumpyVectorStore 支援多個查詢以一次矩陣乘法計分（retrieve_many）
+    storage_context = StorageContext.from_defaults(vector_store=NumpyVectorStore())
+    index = VectorStoreIndex.from_documents(documents, storage_context=storage_context)
     print("✅ 索引設定完成！")
     
     return index
@@ -38,7 +47,8 @@ def basic_query_demo(index):
     print("\n🔍 基本查詢示範...")
     
     # 建立查詢引擎
-    query_engine = index.as_query_engine()
+    retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=2)
+    query_engine = RetrieverQueryEngine.from_args(retriever)
     
     # 測試查詢
     queries = [
@@ -47,9 +57,12 @@ def basic_query_demo(index):
         "機器學習和深度學習有什麼不同？"
     ]
     
-    for i, query in enumerate(queries, 1):
+    # 所有查詢一次嵌入、一次計分，再逐一生成回答
+    results = retriever.retrieve_many(queries)
+    
+    for i, (query, nodes) in enumerate(zip(queries, results), 1):
         print(f"\n查詢 {i}: {query}")
-        response = query_engine.query(query)
+        response = query_engine.synthesize(QueryBundle(query), nodes)
         print(f"回答: {response.response}")
         print(f"來源節點數: {len(response.source_nodes)}")
         
@@ -127,42 +140,57 @@ def custom_query_bundle_demo(index):
         custom_embedding_strs=["cloud computing", "service types", "IaaS", "PaaS", "SaaS"]
     )
     
-    # 建立檢索器
-    retriever = VectorIndexRetriever(
-        index=index,
-        similarity_top_k=3
-    )
-    
-    # 執行檢索
-    nodes = retriever.retrieve(query_bundle)
-    
-    print(f"檢索到的節點數: {len(nodes)}")
-    for i, node in enumerate(nodes):
-        print(f"節點 {i+1}: {node.text[:100]}...")
+    # 五個字串一次批次嵌入，再以不同方式合併：
+    # mean 平均成一個查詢向量；max 取節點與各字串的最高相似度；rrf 融合各字串的排序
+    for aggregation in ("mean", "max", "rrf"):
+        retriever = BatchVectorIndexRetriever.from_index(
+            index,
+            similarity_top_k=3,
+            embedding_aggregation=aggregation
+        )
+        
+        # 執行檢索
+        nodes = retriever.retrieve(query_bundle)
+        
+        print(f"\n[{aggregation}] 檢索到的節點數: {len(nodes)}")
+        for i, node in enumerate(nodes):
+            print(f"節點 {i+1} (分數 {node.score:.3f}): {node.text[:100]}...")
 
 def response_mode_comparison(index):
-    """不同回應模式比較"""
+    """不同回應模式比較：檢索一次，各模式平行合成"""
     print("\n🔄 回應模式比較...")
     
     query = "什麼是機器學習？"
     print(f"查詢: {query}")
     
-    # 測試不同的回應模式
-    response_modes = [
-        ResponseMode.DEFAULT,
-        ResponseMode.COMPACT,
-        ResponseMode.TREE_SUMMARIZE,
-        ResponseMode.SIMPLE_SUMMARIZE
+    # 測試不同的回應模式；每種模式共用同一次檢索結果，只有合成步驟各自執行
+    variants = [
+        {"response_mode": ResponseMode.REFINE, "top_k": 3},
+        {"response_mode": ResponseMode.COMPACT, "top_k": 3},
+        {"response_mode": ResponseMode.TREE_SUMMARIZE, "top_k": 3},
+        {"response_mode": ResponseMode.SIMPLE_SUMMARIZE, "top_k": 3},
+        {"response_mode": ResponseMode.COMPACT, "top_k": 1}
     ]
     
-    for mode in response_modes:
-        print(f"\n📋 {mode.value} 模式:")
-        try:
-            query_engine = index.as_query_engine(response_mode=mode)
-            response = query_engine.query(query)
-            print(f"回答: {response.response[:150]}...")
-        except Exception as e:
-            print(f"❌ 模式不支援: {e}")
+    engine = MultiSynthesisEngine(
+        index.as_retriever(similarity_top_k=max(variant["top_k"] for variant in variants))
+    )
+    results = engine.compare(query, variants)
+    
+    for result in results:
+        print(f"\n📋 {result['name']} 模式:")
+        if result["error"]:
+            print(f"❌ 模式不支援: {result['error']}")
+        else:
+            print(f"回答: {str(result['response'])[:150]}...")
+    
+    print(f"\n{'模式':<24}{'延遲(秒)':>10}{'LLM 呼叫':>10}{'Token':>10}")
+    for result in results:
+        print(
+            f"{result['name']:<24}{result['latency_seconds']:>10.2f}"
+            f"{result['llm_calls']:>10}{result['total_tokens']:>10}"
+        )
+    print(f"檢索統計: {engine.cache_stats()}")
 
 def explain_retrieval_strategies():
     """解釋檢索策略"""
@@ -5,15 +5,24 @@ from llama_index.core import (
     VectorStoreIndex, 
     SimpleDirectoryReader,
     Settings,
-    PromptTemplate
+    PromptTemplate,
+    StorageContext
 )
-from llama_index.core.query_engine import SubQuestionQueryEngine
+from llama_index.core.query_engine import RetrieverQueryEngine, SubQuestionQueryEngine
+from llama_index.core.schema import QueryBundle
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
+from llama_index.core.vector_stores import MetadataFilter, MetadataFilters
 from llama_index.llms.openai import OpenAI
+from batch_retrieval import BatchVectorIndexRetriever
+from embedding_cache import install_embedding_cache
+from numpy_vector_store import NumpyVectorStore
 
 # 載入環境變數
 load_dotenv()
 
+# 啟用持久化嵌入快取，各範例對相同切塊只需嵌入一次
+install_embedding_cache()
+
 def setup_rag_system():
     """設定完整的 RAG 系統"""
     print("🔧 設定 RAG 系統...")
@@ -31,8 +40,9 @@ def setup_rag_system():
     reader = SimpleDirectoryReader(input_dir=documents_dir)
     documents = reader.load_data()
     
-    # 建立索引
-    index = VectorStoreIndex.from_documents(documents)
+    # 建立索引：NumpyVectorStore 以元數據索引先篩出符合過濾條件的向量再計分
+    storage_context = StorageContext.from_defaults(vector_store=NumpyVectorStore())
+    index = VectorStoreIndex.from_documents(documents, storage_context=storage_context)
     
     print("✅ RAG 系統設定完成！")
     return index
@@ -42,10 +52,8 @@ def basic_rag_demo(index):
     print("\n🤖 基本 RAG 示範...")
     
     # 建立查詢引擎
-    query_engine = index.as_query_engine(
-        response_mode="compact",
-        similarity_top_k=3
-    )
+    retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=3)
+    query_engine = RetrieverQueryEngine.from_args(retriever, response_mode="compact")
     
     # 測試查詢
     queries = [
@@ -54,9 +62,12 @@ def basic_rag_demo(index):
         "機器學習和深度學習有什麼關係？"
     ]
     
-    for i, query in enumerate(queries, 1):
+    # 所有查詢一次嵌入、一次計分，再逐一生成回答
+    results = retriever.retrieve_many(queries)
+    
+    for i, (query, nodes) in enumerate(zip(queries, results), 1):
         print(f"\n查詢 {i}: {query}")
-        response = query_engine.query(query)
+        response = query_engine.synthesize(QueryBundle(query), nodes)
         print(f"回答: {response.response}")
         print(f"來源節點數: {len(response.source_nodes)}")
 
@@ -125,9 +136,12 @@ def rag_with_metadata_filtering(index):
     """帶有元數據過濾的 RAG"""
     print("\n🏷️ 元數據過濾 RAG...")
     
-    # 建立帶有元數據過濾的查詢引擎
+    # 建立帶有元數據過濾的查詢引擎：過濾條件先轉成候選向量，只有符合的向量會被計分
+    # （SimpleDirectoryReader 的 file_path 是完整路徑，比對檔名要用 file_name）
     query_engine = index.as_query_engine(
-        filters={"file_path": "sample_ai.txt"},  # 只查詢特定文件
+        filters=MetadataFilters(filters=[
+            MetadataFilter(key="file_name", value="sample_ai.txt")  # 只查詢特定文件
+        ]),
         response_mode="compact"
     )
     
@@ -137,6 +151,7 @@ def rag_with_metadata_filtering(index):
     
     response = query_engine.query(query)
     print(f"回答: {response.response}")
+    print(f"來源文件: {sorted({node.node.metadata.get('file_name') for node in response.source_nodes})}")
 
 def rag_performance_optimization(index):
     """RAG 效能優化示範"""
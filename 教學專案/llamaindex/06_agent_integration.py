@@ -4,10 +4,14 @@ from dotenv import load_dotenv
 from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
 from agents import Agent, Runner, function_tool
 from typing import List, Dict, Any
+from embedding_cache import install_embedding_cache
 
 # 載入環境變數
 load_dotenv()
 
+# 啟用持久化嵌入快取，各範例對相同切塊只需嵌入一次
+install_embedding_cache()
+
 def setup_llamaindex_agent():
     """設定 LlamaIndex 與 Agent 整合系統"""
     print("🔧 設定 LlamaIndex + Agent 整合系統...")
@@ -1,5 +1,6 @@
 # 07_advanced_features.py - LlamaIndex 進階功能
 import os
+import time
 from dotenv import load_dotenv
 from llama_index.core import (
     VectorStoreIndex, 
@@ -11,9 +12,17 @@ from llama_index.core import (
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.postprocessor import SimilarityPostprocessor, KeywordNodePostprocessor
 from llama_index.core.retrievers import VectorIndexRetriever
+from llama_index.core.schema import QueryBundle
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.vector_stores import FilterOperator, MetadataFilter, MetadataFilters
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.embeddings.openai import OpenAIEmbedding
 import chromadb
+from embedding_cache import CachedEmbedding
+from adaptive_embedding import AdaptiveBatchEmbedding
+from bm25_index import BM25Index, BM25Indexer, BM25Retriever, HybridRetriever
+from multi_synthesis import MultiSynthesisEngine
+from numpy_vector_store import NumpyVectorStore
 
 # 載入環境變數
 load_dotenv()
@@ -22,12 +31,12 @@ def setup_advanced_system():
     """設定進階系統"""
     print("🔧 設定進階 LlamaIndex 系統...")
     
-    # 設定嵌入模型
-    embed_model = OpenAIEmbedding(
-        model="text-embedding-3-small",
-        embed_batch_size=10
+    # 設定嵌入模型：依 token 預算打包批次並自動調整並行數（取代固定的 embed_batch_size）
+    embed_model = AdaptiveBatchEmbedding(
+        OpenAIEmbedding(model="text-embedding-3-small", max_retries=0)
     )
-    Settings.embed_model = embed_model
+    # 包上持久化快取，重複執行時不會再次嵌入相同切塊
+    Settings.embed_model = CachedEmbedding(embed_model)
     
     # 載入文件
     documents_dir = "sample_documents"
@@ -53,18 +62,22 @@ def demonstrate_custom_node_parser(documents):
         paragraph_separator="\n\n"  # 段落分隔符
     )
     
-    # 建立索引
+    # 建立索引：切塊後的節點同時加入 BM25 關鍵字索引，不需要事後再掃描一次 docstore
+    # 向量放在 NumpyVectorStore：元數據過濾會先篩出候選向量再計分
+    keyword_index = BM25Index()
     index = VectorStoreIndex.from_documents(
         documents,
-        transformations=[custom_splitter]
+        storage_context=StorageContext.from_defaults(vector_store=NumpyVectorStore()),
+        transformations=[custom_splitter, BM25Indexer(keyword_index)]
     )
     
     print("✅ 自定義節點解析器設定完成！")
     print(f"   塊大小: {custom_splitter.chunk_size}")
     print(f"   重疊大小: {custom_splitter.chunk_overlap}")
     print(f"   分隔符: {custom_splitter.separator}")
+    print(f"   關鍵字索引: {keyword_index.node_count} 個節點, {keyword_index.vocabulary_size} 個詞元")
     
-    return index
+    return index, keyword_index
 
 def demonstrate_advanced_retrievers(index):
     """示範進階檢索器"""
@@ -160,14 +173,19 @@ def demonstrate_chroma_integration(documents):
         print(f"❌ ChromaDB 整合失敗: {e}")
         return None
 
-def demonstrate_hybrid_search(index):
-    """示範混合搜尋"""
+def demonstrate_hybrid_search(index, keyword_index):
+    """示範混合搜尋：向量檢索與 BM25 關鍵字檢索同時執行，以 RRF 合併"""
     print("\n🔀 混合搜尋...")
     
-    # 建立查詢引擎
-    query_engine = index.as_query_engine(
-        response_mode="compact",
-        similarity_top_k=3
+    # 兩邊各取較多候選，融合後再取前 3 名
+    vector_retriever = VectorIndexRetriever(index=index, similarity_top_k=10)
+    keyword_retriever = BM25Retriever.from_vector_index(index, keyword_index, similarity_top_k=10)
+    hybrid_retriever = HybridRetriever(vector_retriever, keyword_retriever, similarity_top_k=3)
+    
+    # 融合分數是 RRF 分數，不可再接相似度門檻的後處理器
+    query_engine = RetrieverQueryEngine.from_args(
+        hybrid_retriever,
+        response_mode="compact"
     )
     
     # 測試不同類型的查詢
@@ -179,18 +197,37 @@ def demonstrate_hybrid_search(index):
     
     for query in queries:
         print(f"\n查詢: {query}")
-        response = query_engine.query(query)
+        # 查詢只嵌入一次，對照用的純向量檢索與混合檢索共用同一個 QueryBundle
+        query_bundle = QueryBundle(query_str=query, embedding=Settings.embed_model.get_query_embedding(query))
+        vector_ids = [node.node.node_id for node in vector_retriever.retrieve(query_bundle)[:3]]
+        keyword_ids = {node.node.node_id for node in keyword_retriever.retrieve(query_bundle)}
+        
+        response = query_engine.query(query_bundle)
+        for node in response.source_nodes:
+            sources = []
+            if node.node.node_id in vector_ids:
+                sources.append("向量")
+            if node.node.node_id in keyword_ids:
+                sources.append("關鍵字")
+            print(f"   RRF {node.score:.4f} [{'+'.join(sources)}] {' '.join(node.node.get_content().split())[:40]}...")
+        
+        new_ids = [node.node.node_id for node in response.source_nodes if node.node.node_id not in vector_ids]
+        print(f"   與純向量檢索相比新增 {len(new_ids)} 個節點")
         print(f"回答: {response.response[:150]}...")
 
 def demonstrate_custom_embeddings():
     """示範自定義嵌入"""
     print("\n🧠 自定義嵌入...")
     
-    # 創建自定義嵌入模型
-    custom_embed_model = OpenAIEmbedding(
-        model="text-embedding-3-small",
-        embed_batch_size=5,
-        api_key=os.getenv('OPENAI_API_KEY')
+    # 創建自定義嵌入模型：批次大小由 token 預算決定，而不是固定筆數
+    custom_embed_model = AdaptiveBatchEmbedding(
+        OpenAIEmbedding(
+            model="text-embedding-3-small",
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_retries=0
+        ),
+        max_batch_tokens=8000,
+        max_concurrency=4
     )
     
     # 測試嵌入
@@ -201,19 +238,26 @@ def demonstrate_custom_embeddings():
     ]
     
     print("測試文字嵌入:")
-    for i, text in enumerate(texts, 1):
-        embedding = custom_embed_model.get_text_embedding(text)
+    embeddings = custom_embed_model.get_text_embedding_batch(texts)
+    for i, (text, embedding) in enumerate(zip(texts, embeddings), 1):
         print(f"文字 {i}: {text}")
         print(f"嵌入維度: {len(embedding)}")
         print(f"前 5 個值: {embedding[:5]}")
+    
+    stats = custom_embed_model.ingest_stats()
+    print(f"批次數: {stats['batches']}，tokens: {stats['tokens']}，"
+          f"吞吐量: {stats['chunks_per_second']:.1f} chunks/s / {stats['tokens_per_second']:.0f} tokens/s")
 
 def demonstrate_metadata_filtering(index):
     """示範元數據過濾"""
     print("\n🏷️ 元數據過濾...")
     
-    # 建立帶有元數據過濾的查詢引擎
+    # 過濾條件由向量儲存的元數據索引轉成候選列（每個欄位值對應一組列號），
+    # 不符合的向量完全不計分；file_path 是完整路徑，比對檔名要用 file_name
     query_engine = index.as_query_engine(
-        filters={"file_path": "sample_ai.txt"},
+        filters=MetadataFilters(filters=[
+            MetadataFilter(key="file_name", value="sample_ai.txt")
+        ]),
         response_mode="compact"
     )
     
@@ -223,6 +267,19 @@ def demonstrate_metadata_filtering(index):
     
     response = query_engine.query(query)
     print(f"回答: {response.response}")
+    print(f"來源文件: {sorted({node.node.metadata.get('file_name') for node in response.source_nodes})}")
+    
+    # 條件可以組合：IN 為各值列號的聯集，OR / AND 為遮罩的位元運算
+    combined_filters = MetadataFilters(
+        filters=[
+            MetadataFilter(key="file_name", operator=FilterOperator.IN, value=["sample_ai.txt", "sample_tech.txt"]),
+            MetadataFilter(key="file_type", value="text/plain")
+        ],
+        condition="and"
+    )
+    retriever = index.as_retriever(filters=combined_filters, similarity_top_k=5)
+    nodes = retriever.retrieve("雲端運算與人工智慧")
+    print(f"組合過濾: {len(nodes)} 個節點，來源 {sorted({node.node.metadata.get('file_name') for node in nodes})}")
 
 def demonstrate_streaming_response(index):
     """示範串流回應"""
@@ -298,28 +355,34 @@ def demonstrate_performance_optimization(index):
     """示範效能優化"""
     print("\n⚡ 效能優化...")
     
-    import time
-    
-    # 測試不同配置的效能
+    # 測試不同配置的效能；top-k 不同的配置取同一次檢索結果的前綴，查詢只嵌入與檢索一次
     configurations = [
-        {"similarity_top_k": 3, "response_mode": "compact"},
-        {"similarity_top_k": 5, "response_mode": "compact"},
-        {"similarity_top_k": 3, "response_mode": "tree_summarize"}
+        {"top_k": 3, "response_mode": "compact"},
+        {"top_k": 5, "response_mode": "compact"},
+        {"top_k": 3, "response_mode": "tree_summarize"}
     ]
     
     query = "什麼是人工智慧？"
     
-    for i, config in enumerate(configurations, 1):
+    engine = MultiSynthesisEngine(
+        index.as_retriever(similarity_top_k=max(config["top_k"] for config in configurations))
+    )
+    
+    started = time.perf_counter()
+    results = engine.compare(query, configurations)
+    total_seconds = time.perf_counter() - started
+    
+    for i, (config, result) in enumerate(zip(configurations, results), 1):
         print(f"\n配置 {i}: {config}")
-        
-        query_engine = index.as_query_engine(**config)
-        
-        start_time = time.time()
-        response = query_engine.query(query)
-        end_time = time.time()
-        
-        print(f"查詢時間: {end_time - start_time:.2f} 秒")
-        print(f"回應長度: {len(response.response)} 字元")
+        if result["error"]:
+            print(f"❌ 合成失敗: {result['error']}")
+            continue
+        print(f"合成時間: {result['latency_seconds']:.2f} 秒")
+        print(f"LLM 呼叫: {result['llm_calls']} 次，Token: {result['prompt_tokens']} + {result['completion_tokens']}")
+        print(f"回應長度: {len(str(result['response']))} 字元")
+    
+    print(f"\n總時間（檢索一次 + 平行合成）: {total_seconds:.2f} 秒")
+    print(f"檢索統計: {engine.cache_stats()}")
 
 if __name__ == "__main__":
     try:
@@ -335,7 +398,7 @@ if __name__ == "__main__":
             exit(1)
         
         # 自定義節點解析器
-        index = demonstrate_custom_node_parser(documents)
+        index, keyword_index = demonstrate_custom_node_parser(documents)
         
         # 進階檢索器
         demonstrate_advanced_retrievers(index)
@@ -347,7 +410,7 @@ if __name__ == "__main__":
         chroma_index = demonstrate_chroma_integration(documents)
         
         # 混合搜尋
-        demonstrate_hybrid_search(index)
+        demonstrate_hybrid_search(index, keyword_index)
         
         # 自定義嵌入
         demonstrate_custom_embeddings()
@@ -1,19 +1,45 @@
 # 08_production_deployment.py - 生產環境部署與監控
 import os
+import asyncio
+import hashlib
+import json
 import logging
+import math
+import shutil
+import threading
 import time
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 from llama_index.core import (
     VectorStoreIndex, 
     SimpleDirectoryReader,
     Settings,
-    StorageContext
+    StorageContext,
+    QueryBundle,
+    get_response_synthesizer,
+    load_index_from_storage
 )
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.utils import get_tokenizer
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.embeddings.openai import OpenAIEmbedding
 import chromadb
-from typing import Dict, List, Any
+import numpy as np
+from typing import Dict, List, Any, Optional, Tuple
+from batch_retrieval import BatchVectorIndexRetriever, aembed_query_batch, embed_query_batch
+from embedding_cache import CachedEmbedding, DEFAULT_CACHE_PATH
+from adaptive_embedding import AdaptiveBatchEmbedding
+from numpy_vector_store import NumpyVectorStore
+from faiss_vector_store import FaissANNVectorStore
+from sharded_vector_store import ShardedVectorStore
+from parallel_ingest import ParallelIngestPipeline
+from lazy_docstore import LazyDocumentStore, remove_database
 
 # 載入環境變數
 load_dotenv()
@@ -29,20 +55,764 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 查詢管線的各個階段，"total" 為端到端延遲
+QUERY_STAGES = ["embedding", "retrieval", "postprocess", "synthesis", "total"]
+
+# get_metrics() 的欄位名稱 -> 指標登錄表中的計數器名稱
+QUERY_COUNTERS = {
+    "total_queries": "rag_queries_total",
+    "successful_queries": "rag_queries_succeeded_total",
+    "failed_queries": "rag_queries_failed_total",
+    "timeout_queries": "rag_queries_timeout_total",
+    "cache_hits": "rag_answer_cache_hits_total",
+    "cache_misses": "rag_answer_cache_misses_total",
+    "coalesced_queries": "rag_queries_coalesced_total",
+    "rejected_queries": "rag_queries_rejected_total"
+}
+
+class LatencyHistogram:
+    """固定記憶體的對數分桶延遲直方圖（相對誤差約等於 growth - 1）"""
+    
+    def __init__(self, min_value: float = 1e-4, max_value: float = 600.0, growth: float = 1.05):
+        """初始化分桶，涵蓋 min_value 到 max_value 秒"""
+        self._min_value = min_value
+        self._growth = growth
+        self._log_growth = math.log(growth)
+        bucket_count = int(math.ceil(math.log(max_value / min_value) / self._log_growth)) + 2
+        self._counts = [0] * bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def _bucket_index(self, value: float) -> int:
+        """計算數值所屬的分桶"""
+        if value <= self._min_value:
+            return 0
+        index = int(math.log(value / self._min_value) / self._log_growth) + 1
+        return min(index, len(self._counts) - 1)
+    
+    def record(self, value: float):
+        """記錄一筆延遲（秒）"""
+        self._counts[self._bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def percentile(self, q: float) -> float:
+        """估算第 q 百分位數（q 介於 0 到 100）"""
+        if self.count == 0:
+            return 0.0
+        
+        rank = max(1, math.ceil(q / 100 * self.count))
+        cumulative = 0
+        for index, bucket_count in enumerate(self._counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                # 回報分桶上界，但不超過實際觀察到的最大值
+                return min(self._min_value * self._growth ** index, self.max)
+        return self.max
+    
+    def mean(self) -> float:
+        """平均延遲"""
+        return self.total / self.count if self.count else 0.0
+    
+    def merge(self, other: "LatencyHistogram"):
+        """合併另一個相同分桶設定的直方圖"""
+        for index, bucket_count in enumerate(list(other._counts)):
+            self._counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+    
+    def snapshot(self) -> Dict[str, float]:
+        """輸出摘要統計"""
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max
+        }
+
+class MetricsRegistry:
+    """每個執行緒各自累加、讀取時才合併的指標登錄表（熱路徑不需要全域鎖）"""
+    
+    def __init__(self):
+        """初始化登錄表"""
+        self._local = threading.local()
+        # 只有新執行緒第一次寫入與讀取合併時才需要這把鎖
+        self._shards_lock = threading.Lock()
+        self._shards = []
+        self._descriptions = {}
+        self._gauges = {}
+    
+    @staticmethod
+    def _key(name: str, labels: Optional[Dict[str, str]]) -> Tuple[str, Tuple]:
+        """將指標名稱與標籤組成字典鍵"""
+        return name, tuple(sorted(labels.items())) if labels else ()
+    
+    def _shard(self) -> Dict[str, Dict]:
+        """取得目前執行緒專屬的分片"""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {"counters": {}, "histograms": {}}
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+    
+    def describe(self, name: str, metric_type: str, help_text: str):
+        """登記指標型別與說明，用於 Prometheus 輸出"""
+        self._descriptions[name] = (metric_type, help_text)
+    
+    def inc(self, name: str, value: int = 1, labels: Optional[Dict[str, str]] = None):
+        """累加計數器"""
+        counters = self._shard()["counters"]
+        key = self._key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        """記錄一筆直方圖觀測值"""
+        histograms = self._shard()["histograms"]
+        key = self._key(name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = LatencyHistogram()
+        histogram.record(value)
+    
+    def set_gauge(self, name: str, value_or_fn, labels: Optional[Dict[str, str]] = None):
+        """設定量表，可傳入數值或讀取時才呼叫的函式"""
+        self._gauges[self._key(name, labels)] = value_or_fn
+    
+    def _snapshot_shards(self) -> List[Dict[str, Dict]]:
+        """複製所有分片（dict.copy 在 GIL 下為原子操作）"""
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [
+            {"counters": shard["counters"].copy(), "histograms": shard["histograms"].copy()}
+            for shard in shards
+        ]
+    
+    def counter(self, name: str, labels: Optional[Dict[str, str]] = None) -> int:
+        """讀取合併後的計數器，未指定標籤時加總所有標籤組合"""
+        if labels is None:
+            return sum(
+                value
+                for shard in self._snapshot_shards()
+                for (counter_name, _), value in shard["counters"].items()
+                if counter_name == name
+            )
+        key = self._key(name, labels)
+        return sum(shard["counters"].get(key, 0) for shard in self._snapshot_shards())
+    
+    def histogram(self, name: str, labels: Optional[Dict[str, str]] = None) -> LatencyHistogram:
+        """讀取合併後的直方圖"""
+        key = self._key(name, labels)
+        merged = LatencyHistogram()
+        for shard in self._snapshot_shards():
+            if key in shard["histograms"]:
+                merged.merge(shard["histograms"][key])
+        return merged
+    
+    def gauge(self, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+        """讀取量表"""
+        value = self._gauges.get(self._key(name, labels), 0)
+        return value() if callable(value) else value
+    
+    @staticmethod
+    def _format_labels(labels: Tuple, extra: Optional[Tuple] = None) -> str:
+        """組成 Prometheus 標籤字串"""
+        pairs = list(labels) + list(extra or ())
+        if not pairs:
+            return ""
+        escaped = [
+            (key, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+            for key, value in pairs
+        ]
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+    
+    def render_prometheus(self) -> str:
+        """輸出 Prometheus 文字格式（直方圖以 summary 分位數呈現）"""
+        counters = {}
+        histograms = {}
+        for shard in self._snapshot_shards():
+            for key, value in shard["counters"].items():
+                counters[key] = counters.get(key, 0) + value
+            for key, histogram in shard["histograms"].items():
+                histograms.setdefault(key, LatencyHistogram()).merge(histogram)
+        
+        samples = {}
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), value in sorted(self._gauges.items(), key=lambda item: item[0]):
+            value = value() if callable(value) else value
+            samples.setdefault(name, []).append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            lines = samples.setdefault(name, [])
+            for quantile in (0.5, 0.9, 0.99):
+                label_str = self._format_labels(labels, (("quantile", str(quantile)),))
+                lines.append(f"{name}{label_str} {histogram.percentile(quantile * 100)}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        
+        output = []
+        for name in sorted(samples):
+            metric_type, help_text = self._descriptions.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+class SemanticAnswerCache:
+    """以查詢嵌入為鍵的語意答案快取（LRU + TTL + 容量上限）"""
+    
+    def __init__(self, similarity_threshold: float = 0.95, max_entries: int = 1000, ttl: Optional[float] = 3600.0):
+        """初始化快取，ttl 為 None 表示不過期"""
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # 預先配置的向量矩陣，每一列是一個快取槽位
+        self._vectors = None
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._created_at = np.zeros(max_entries, dtype=np.float64)
+        # 槽位 -> 回應，順序即 LRU 順序
+        self._entries = OrderedDict()
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+    
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        """轉為單位向量，使內積等於餘弦相似度"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+    
+    def _evict(self, slot: int):
+        """移除指定槽位"""
+        self._entries.pop(slot, None)
+        self._valid[slot] = False
+        self._free_slots.append(slot)
+    
+    def _purge_expired(self):
+        """移除所有超過 TTL 的槽位（呼叫端需持有鎖）"""
+        if self.ttl is None:
+            return
+        expired = np.flatnonzero(self._valid & (self._created_at < time.time() - self.ttl))
+        for slot in expired.tolist():
+            self._evict(slot)
+    
+    def lookup(self, embedding):
+        """找出相似度超過門檻的快取回應，未命中回傳 None"""
+        with self._lock:
+            # 先移除過期項目再取最相似者，過期的最相似項目不會遮住其他仍有效的命中
+            self._purge_expired()
+            if not self._entries:
+                return None
+            
+            query = self._normalize(embedding)
+            similarities = self._vectors @ query
+            similarities[~self._valid] = -np.inf
+            slot = int(np.argmax(similarities))
+            if similarities[slot] < self.similarity_threshold:
+                return None
+            
+            self._entries.move_to_end(slot)
+            return self._entries[slot]
+    
+    def store(self, embedding, response):
+        """寫入快取，滿了就淘汰最久未使用的項目"""
+        with self._lock:
+            vector = self._normalize(embedding)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            
+            # 過期項目先讓出槽位，滿了才淘汰仍有效的最久未使用項目
+            self._purge_expired()
+            if not self._free_slots:
+                oldest_slot = next(iter(self._entries))
+                self._evict(oldest_slot)
+            
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vector
+            self._valid[slot] = True
+            self._created_at[slot] = time.time()
+            self._entries[slot] = response
+    
+    def clear(self):
+        """清空快取（索引重建後舊答案不再可信）"""
+        with self._lock:
+            self._entries.clear()
+            self._valid[:] = False
+            self._free_slots = list(range(self.max_entries - 1, -1, -1))
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class IngestManifest:
+    """記錄已匯入檔案的大小、修改時間與內容雜湊，用於增量匯入"""
+    
+    def __init__(self, path: str):
+        """從磁碟載入清單（不存在則視為空）"""
+        self.path = path
+        # 相對路徑 -> {"size", "mtime", "sha256", "doc_ids"}
+        self.files: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.files = json.load(f).get("files", {})
+    
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        """以 1 MB 為單位計算檔案的 SHA-256"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def diff(self, documents_dir: str, file_paths: List[str]) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+        """比對目前檔案與清單，回傳 (需重新匯入的檔案, 已刪除的檔案)"""
+        changed = {}
+        seen = set()
+        
+        for file_path in file_paths:
+            key = os.path.relpath(file_path, documents_dir)
+            seen.add(key)
+            stat = os.stat(file_path)
+            entry = self.files.get(key)
+            
+            # 大小與修改時間都沒變就不必讀檔計算雜湊
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+            
+            sha256 = self.hash_file(file_path)
+            if entry and entry["sha256"] == sha256:
+                entry["size"] = stat.st_size
+                entry["mtime"] = stat.st_mtime
+                continue
+            
+            changed[key] = {
+                "file_path": file_path,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha256": sha256
+            }
+        
+        deleted = [key for key in self.files if key not in seen]
+        return changed, deleted
+    
+    def save(self):
+        """先寫入暫存檔再替換，避免中斷時留下損毀的清單"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.files}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+class QueryRejectedError(Exception):
+    """查詢在進入查詢引擎前就被拒絕（輸入不合法或系統滿載）"""
+    
+    def __init__(self, message: str, status_code: int, reason: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+
+class _AdmissionWaiter:
+    """排隊中的請求，被放行時呼叫 notify"""
+    
+    def __init__(self, deadline: float, notify):
+        self.deadline = deadline
+        self.notify = notify
+        self.granted = False
+
+class AdmissionController:
+    """限制同時執行的查詢數，超出時進入有上限的等待佇列，佇列滿則立即拒絕"""
+    
+    def __init__(self, max_in_flight: int = 64, max_queue_depth: int = 128):
+        """初始化並行上限與佇列深度"""
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.in_flight = 0
+        self._waiting = deque()
+        self._lock = threading.Lock()
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+    
+    def _try_enter(self, deadline: float, notify) -> Optional[_AdmissionWaiter]:
+        """有空位就直接進入（回傳 None），否則排隊，佇列已滿則拒絕"""
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._waiting:
+                self.in_flight += 1
+                return None
+            if len(self._waiting) >= self.max_queue_depth:
+                raise QueryRejectedError("系統忙碌中，請稍後再試", 429, "queue_full")
+            waiter = _AdmissionWaiter(deadline, notify)
+            self._waiting.append(waiter)
+            return waiter
+    
+    def _abandon(self, waiter: _AdmissionWaiter) -> bool:
+        """放棄排隊；若剛好已被放行則回傳 True，呼叫端須自行 release"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            # 逾期的等待者可能已被 release 略過並移出佇列
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            return False
+    
+    def acquire(self, deadline: float):
+        """同步取得執行名額，超過期限仍未輪到則拒絕"""
+        event = threading.Event()
+        waiter = self._try_enter(deadline, event.set)
+        if waiter is None:
+            return
+        
+        if not event.wait(timeout=max(0.0, deadline - time.time())) and not self._abandon(waiter):
+            raise QueryRejectedError("排隊等待逾時", 429, "queue_timeout")
+    
+    async def aacquire(self, deadline: float):
+        """acquire 的非同步版本"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+        
+        waiter = self._try_enter(deadline, notify)
+        if waiter is None:
+            return
+        
+        try:
+            await asyncio.wait_for(future, timeout=max(0.0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                raise QueryRejectedError("排隊等待逾時", 429, "queue_timeout")
+        except asyncio.CancelledError:
+            if self._abandon(waiter):
+                self.release()
+            raise
+    
+    def release(self):
+        """釋放名額，依序交給第一個尚未逾期的等待者"""
+        with self._lock:
+            now = time.time()
+            while self._waiting:
+                waiter = self._waiting.popleft()
+                # 已逾期的等待者會自行逾時返回，不值得再為它執行查詢
+                if waiter.deadline <= now:
+                    continue
+                waiter.granted = True
+                waiter.notify()
+                return
+            self.in_flight -= 1
+
+class _InFlightCall:
+    """正在執行中的一次查詢，供等待者取得同一份結果"""
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """相同鍵值的請求同時抵達時只執行一次，其他請求等待並共用結果"""
+    
+    def __init__(self):
+        """初始化同步與非同步的執行中請求表"""
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _InFlightCall] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+    
+    def do(self, key: str, fn, deadline: Optional[float] = None) -> Tuple[Any, bool]:
+        """同步執行，回傳 (結果, 是否共用了他人的結果)；等待他人的結果超過 deadline 時丟出 TimeoutError"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlightCall()
+        
+        if not leader:
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            if not call.event.wait(timeout=timeout):
+                raise TimeoutError("等待進行中的相同查詢逾時")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+    
+    async def ado(self, key: str, coro_fn) -> Tuple[Any, bool]:
+        """非同步執行，回傳 (結果, 是否共用了他人的結果)"""
+        task = self._tasks.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(coro_fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget_task(key, done))
+        
+        # 個別等待者逾時或取消時不中斷共用的工作；最後一位離開才取消
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task), shared
+        finally:
+            self._waiters[task] -= 1
+            if self._waiters[task] == 0:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+    
+    def _forget_task(self, key: str, task: asyncio.Task):
+        """工作完成後移出執行中表"""
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # 取出例外，避免沒有等待者時出現未處理例外的警告
+            task.exception()
+
+class _PendingEmbedding:
+    """等待批次嵌入結果的一筆查詢"""
+    
+    def __init__(self, text: str):
+        self.text = text
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class QueryEmbeddingBatcher:
+    """將短時間內抵達的查詢嵌入合併成一次上游呼叫，再把向量分送回各請求"""
+    
+    def __init__(self, batch_fn, abatch_fn, max_batch_size: int = 32, max_wait: float = 0.005, on_flush=None):
+        """
+        初始化批次器
+        
+        Args:
+            batch_fn: 同步批次嵌入函式 texts -> vectors
+            abatch_fn: 非同步批次嵌入函式
+            max_batch_size: 每批最多幾筆，滿了立即送出
+            max_wait: 第一筆抵達後最多等待多久（秒）就送出
+            on_flush: 每送出一批時以批次大小呼叫，用於記錄指標
+        """
+        self.batch_fn = batch_fn
+        self.abatch_fn = abatch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.on_flush = on_flush
+        self._cond = threading.Condition()
+        self._pending: List[_PendingEmbedding] = []
+        # 非同步批次綁定建立它的事件迴圈
+        self._async_loop = None
+        self._async_pending: List[Tuple[str, asyncio.Future]] = []
+        self._async_timer = None
+        self._async_tasks = set()
+    
+    def embed(self, text: str) -> List[float]:
+        """同步取得查詢嵌入；每批的第一位呼叫者負責等待視窗結束並送出"""
+        item = _PendingEmbedding(text)
+        with self._cond:
+            batch = self._pending
+            batch.append(item)
+            leader = len(batch) == 1
+            if len(batch) >= self.max_batch_size:
+                # 批次已滿：換上新的批次並叫醒負責送出的呼叫者
+                self._pending = []
+                self._cond.notify_all()
+        
+        if leader:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not batch, timeout=self.max_wait)
+                if self._pending is batch:
+                    self._pending = []
+            self._flush(batch)
+        
+        item.event.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+    
+    def _flush(self, batch: List[_PendingEmbedding]):
+        """送出一批並喚醒所有等待者"""
+        if self.on_flush is not None:
+            self.on_flush(len(batch))
+        try:
+            vectors = self.batch_fn([item.text for item in batch])
+            for item, vector in zip(batch, vectors):
+                item.result = vector
+        except Exception as e:
+            for item in batch:
+                item.error = e
+        finally:
+            for item in batch:
+                item.event.set()
+    
+    async def aembed(self, text: str) -> List[float]:
+        """非同步取得查詢嵌入"""
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_loop = loop
+            self._async_pending = []
+        
+        future = loop.create_future()
+        self._async_pending.append((text, future))
+        if len(self._async_pending) >= self.max_batch_size:
+            # 批次已滿（包括 max_batch_size=1）立即送出，不等待視窗
+            if self._async_timer is not None:
+                self._async_timer.cancel()
+                self._async_timer = None
+            self._aflush()
+        elif len(self._async_pending) == 1:
+            self._async_timer = loop.call_later(self.max_wait, self._aflush)
+        return await future
+    
+    def _aflush(self):
+        """取出目前的非同步批次並在背景送出"""
+        batch, self._async_pending = self._async_pending, []
+        if not batch:
+            return
+        if self.on_flush is not None:
+            self.on_flush(len(batch))
+        task = asyncio.ensure_future(self._arun(batch))
+        self._async_tasks.add(task)
+        task.add_done_callback(self._async_tasks.discard)
+    
+    async def _arun(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            vectors = await self.abatch_fn([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            # 個別請求可能已逾時取消，只回填仍在等待的
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+class IndexVersion:
+    """一個可服務的索引版本：索引、檢索器、後處理器、合成器與查詢引擎，以及它的儲存位置
+    
+    藍綠重建時新版本建立在旁邊的集合或目錄，驗證後才取代服務中的版本；
+    被取代的版本保留在記憶體中供回滾。index 為 None 表示只剩磁碟上的資料（重啟前的舊版本）。
+    查詢路徑的所有元件都從同一個版本物件讀取，建立中的新版本不會影響正在服務的查詢。
+    """
+    
+    def __init__(
+        self,
+        version: Optional[str],
+        location: Dict[str, Any],
+        index=None,
+        retriever=None,
+        node_postprocessors: Optional[List[Any]] = None,
+        response_synthesizer=None,
+        query_engine=None
+    ):
+        self.version = version
+        self.location = location
+        self.index = index
+        self.retriever = retriever
+        self.node_postprocessors = node_postprocessors or []
+        self.response_synthesizer = response_synthesizer
+        self.query_engine = query_engine
+        self.created_at = time.time()
+        self.retired_at: Optional[float] = None
+    
+    @property
+    def name(self) -> str:
+        """版本名稱（初始位置沒有版本號）"""
+        return self.version or "initial"
+
 class ProductionRAGSystem:
     """生產環境 RAG 系統"""
     
     def __init__(self, config: Dict[str, Any]):
         """初始化生產環境系統"""
         self.config = config
-        self.index = None
-        self.query_engine = None
-        self.metrics = {
-            "total_queries": 0,
-            "successful_queries": 0,
-            "failed_queries": 0,
-            "average_response_time": 0.0
+        self.embed_model = None
+        self.query_embed_model = None
+        self._adaptive_embed_model = None
+        
+        # 藍綠重建：服務中的版本、可回滾的舊版本，以及只在重建與回滾時使用的鎖（查詢路徑不碰它）
+        self.active_version: Optional[IndexVersion] = None
+        self._previous_versions: deque = deque()
+        self._rebuild_lock = threading.Lock()
+        # 已移出回滾佇列、等待查詢期限過後刪除儲存的版本名稱
+        self._draining_versions: set = set()
+        self._drain_threads: List[threading.Thread] = []
+        self.last_rebuild: Optional[Dict[str, Any]] = None
+        
+        self.metrics = MetricsRegistry()
+        self.metrics.describe("rag_queries_total", "counter", "查詢總數")
+        self.metrics.describe("rag_queries_succeeded_total", "counter", "成功的查詢數")
+        self.metrics.describe("rag_queries_failed_total", "counter", "失敗的查詢數")
+        self.metrics.describe("rag_queries_timeout_total", "counter", "逾時的查詢數")
+        self.metrics.describe("rag_answer_cache_hits_total", "counter", "語意快取命中數")
+        self.metrics.describe("rag_answer_cache_misses_total", "counter", "語意快取未命中數")
+        self.metrics.describe("rag_answer_cache_entries", "gauge", "語意快取目前的項目數")
+        self.metrics.describe("rag_queries_coalesced_total", "counter", "與進行中相同查詢合併的請求數")
+        self.metrics.describe("rag_queries_rejected_total", "counter", "在准入階段被拒絕的查詢數")
+        self.metrics.describe("rag_queries_in_flight", "gauge", "正在執行的查詢數")
+        self.metrics.describe("rag_admission_queue_depth", "gauge", "等待執行名額的查詢數")
+        self.metrics.describe("rag_query_stage_seconds", "summary", "查詢各階段耗時（秒）")
+        self.metrics.describe("rag_query_embed_batches_total", "counter", "送出的查詢嵌入批次數")
+        self.metrics.describe("rag_query_embed_batched_queries_total", "counter", "經由批次嵌入的查詢數")
+        self.metrics.describe("rag_query_embed_batch_fill_ratio", "summary", "查詢嵌入批次的填滿比例")
+        self.metrics.describe("rag_index_rebuilds_total", "counter", "藍綠重建次數（依結果分類）")
+        self.metrics.describe("rag_index_rollbacks_total", "counter", "回滾到舊索引版本的次數")
+        
+        # 依實際請求結果追蹤外部依賴是否可連線，供就緒探針使用
+        self.dependency_status = {
+            name: {"last_success": None, "last_failure": None, "last_error": None}
+            for name in ("embedding", "llm")
         }
+        self._probe_embedding = None
+        
+        # 准入控制：輸入長度檢查、並行上限與有上限的等待佇列
+        self.admission = AdmissionController(
+            max_in_flight=self.config.get("max_concurrent_queries", 64),
+            max_queue_depth=self.config.get("max_queue_depth", 128)
+        )
+        self._tokenizer = get_tokenizer()
+        
+        # 語意答案快取（串流回應無法重複使用，因此不快取）
+        self.answer_cache = None
+        if self.config.get("semantic_cache", False) and not self.config.get("streaming", False):
+            self.answer_cache = SemanticAnswerCache(
+                similarity_threshold=self.config.get("cache_similarity_threshold", 0.95),
+                max_entries=self.config.get("cache_max_entries", 1000),
+                ttl=self.config.get("cache_ttl", 3600.0)
+            )
+        
+        self.metrics.set_gauge(
+            "rag_answer_cache_entries",
+            lambda: len(self.answer_cache) if self.answer_cache is not None else 0
+        )
+        self.metrics.set_gauge("rag_queries_in_flight", lambda: self.admission.in_flight)
+        self.metrics.set_gauge("rag_admission_queue_depth", lambda: self.admission.queue_depth)
+        
+        # 相同查詢同時抵達時合併為一次執行
+        self._single_flight = SingleFlight() if self.config.get("coalesce_queries", True) else None
+        
+        # 查詢嵌入微批次：短時間內抵達的查詢合併為一次嵌入呼叫
+        self._query_embed_batcher = None
+        if self.config.get("query_embed_batching", False):
+            self._query_embed_batcher = QueryEmbeddingBatcher(
+                self._embed_query_batch,
+                self._aembed_query_batch,
+                max_batch_size=self.config.get("query_embed_max_batch", 32),
+                max_wait=self.config.get("query_embed_max_wait", 0.005),
+                on_flush=self._record_embed_batch
+            )
         
         logger.info("初始化生產環境 RAG 系統...")
         self._setup_system()
@@ -50,27 +820,64 @@ class ProductionRAGSystem:
     def _setup_system(self):
         """設定系統組件"""
         try:
-            # 設定嵌入模型
-            embed_model = OpenAIEmbedding(
-                model=self.config.get("embedding_model", "text-embedding-3-small"),
-                embed_batch_size=self.config.get("embed_batch_size", 10)
-            )
-            Settings.embed_model = embed_model
+            # 設定嵌入模型（"settings" 表示沿用呼叫端放在 Settings 的模型，例如基準測試的替身）
+            if self.config.get("embedding_provider", "openai") == "settings":
+                embed_model = query_embed_model = Settings.embed_model
+            else:
+                adaptive_batching = self.config.get("adaptive_ingest_batching", True)
+                embed_model = OpenAIEmbedding(
+                    model=self.config.get("embedding_model", "text-embedding-3-small"),
+                    embed_batch_size=self.config.get("embed_batch_size", 10),
+                    # 自適應批次自行重試並依 429 降速，內建重試會把限流藏起來
+                    max_retries=0 if adaptive_batching else 10
+                )
+                # 查詢使用獨立的模型：保留內建重試，不經過匯入的自適應批次與嵌入快取，
+                # 查詢流量不計入匯入進度，也不與匯入共用 AIMD 並行數
+                query_embed_model = OpenAIEmbedding(
+                    model=self.config.get("embedding_model", "text-embedding-3-small"),
+                    max_retries=self.config.get("query_embed_max_retries", 3)
+                ) if adaptive_batching else embed_model
+                # 依 token 預算打包匯入批次，並以 AIMD 調整同時送出的批次數
+                if adaptive_batching:
+                    embed_model = self._adaptive_embed_model = AdaptiveBatchEmbedding(
+                        embed_model,
+                        max_batch_tokens=self.config.get("ingest_max_batch_tokens", 50000),
+                        max_concurrency=self.config.get("ingest_max_concurrency", 8)
+                    )
+                # 持久化嵌入快取：重建索引時未變動的切塊不必再呼叫 API
+                if self.config.get("embedding_cache", True):
+                    embed_model = CachedEmbedding(
+                        embed_model,
+                        cache_path=self.config.get("embedding_cache_path", DEFAULT_CACHE_PATH),
+                        max_bytes=int(self.config.get("embedding_cache_max_mb", 512) * 1024 * 1024)
+                    )
+                Settings.embed_model = embed_model
+            self.embed_model = embed_model
+            self.query_embed_model = query_embed_model
             
-            # 設定節點解析器
-            node_parser = SentenceSplitter(
-                chunk_size=self.config.get("chunk_size", 1024),
-                chunk_overlap=self.config.get("chunk_overlap", 200)
-            )
+            # 上次藍綠重建切換到的版本（沒有版本指標時使用設定中的原始位置）
+            pointer = self._read_version_pointer()
+            version = pointer.get("version")
+            location = self._storage_location(version)
             
-            # 載入文件
-            documents = self._load_documents()
+            # 載入文件（增量匯入時由清單決定要讀取哪些檔案）
+            documents = [] if self._use_incremental_ingest() else self._load_documents()
             
-            # 建立索引
-            self.index = self._create_index(documents, node_parser)
+            # 建立索引與查詢引擎
+            index = self._create_index(documents, self._create_node_parser(), location)
+            self._activate(self._create_version(version, location, index))
+            
+            # 重啟前保留的舊版本只剩磁碟上的資料，無法回滾，但仍依保留數量清理
+            for previous in pointer.get("previous", []):
+                retired = IndexVersion(previous, self._storage_location(previous))
+                retired.retired_at = 0.0
+                self._previous_versions.append(retired)
             
-            # 建立查詢引擎
-            self.query_engine = self._create_query_engine()
+            # 預先計算探針嵌入，之後的就緒檢查不必再呼叫嵌入 API
+            try:
+                self._get_probe_embedding()
+            except Exception as e:
+                logger.warning(f"探針嵌入計算失敗，將於就緒檢查時重試: {e}")
             
             logger.info("系統設定完成")
             
@@ -78,160 +885,1117 @@ class ProductionRAGSystem:
             logger.error(f"系統設定失敗: {e}")
             raise
     
+    def _create_node_parser(self) -> SentenceSplitter:
+        """設定節點解析器"""
+        return SentenceSplitter(
+            chunk_size=self.config.get("chunk_size", 1024),
+            chunk_overlap=self.config.get("chunk_overlap", 200)
+        )
+    
     def _load_documents(self):
-        """載入文件"""
+        """載入文件；開啟 parallel_ingest 時回傳 None，由 _build_index 以平行匯入管線串流處理"""
         documents_dir = self.config.get("documents_dir", "sample_documents")
         
         if not os.path.exists(documents_dir):
             logger.warning(f"文件目錄不存在: {documents_dir}")
             return []
         
+        if self.config.get("parallel_ingest", True):
+            return None
+        
         reader = SimpleDirectoryReader(input_dir=documents_dir)
         documents = reader.load_data()
         
         logger.info(f"載入了 {len(documents)} 個文件")
         return documents
     
-    def _create_index(self, documents, node_parser):
-        """建立索引"""
-        if self.config.get("use_chroma", False):
-            return self._create_chroma_index(documents, node_parser)
+    def _use_incremental_ingest(self) -> bool:
+        """持久化的 ChromaDB 集合才需要增量匯入"""
+        return self._vector_backend() == "chroma" and self.config.get("incremental_ingest", True)
+    
+    def _vector_backend(self) -> str:
+        """向量儲存後端：simple / numpy / faiss / chroma（未指定時沿用 use_chroma）"""
+        return self.config.get("vector_backend", "chroma" if self.config.get("use_chroma", False) else "simple")
+    
+    def _storage_location(self, version: Optional[str] = None) -> Dict[str, Any]:
+        """索引版本的儲存位置；version 為 None 時是設定中的原始位置
+        
+        藍綠重建的新版本寫入加上版本號的 Chroma 集合、匯入清單與 FAISS 持久化目錄，
+        不會碰到正在服務的版本。記憶體內的後端（simple / numpy）不需要位置。
+        """
+        chroma_path = self.config.get("chroma_path", "./chroma_production")
+        collection_name = self.config.get("collection_name", "production_kb")
+        manifest_path = self.config.get("manifest_path", f"{chroma_path.rstrip('/')}.manifest.json")
+        docstore_path = self.config.get("docstore_path", "./docstore_production.db")
+        persist_dir = self.config.get("vector_persist_dir")
+        rescore_path = self.config.get("vector_rescore_path")
+        
+        if version is None:
+            return {
+                "chroma_path": chroma_path,
+                "collection_name": collection_name,
+                "manifest_path": manifest_path,
+                "docstore_path": docstore_path,
+                "vector_persist_dir": persist_dir,
+                "vector_rescore_path": rescore_path
+            }
+        
+        manifest_root, manifest_ext = os.path.splitext(manifest_path)
+        docstore_root, docstore_ext = os.path.splitext(docstore_path)
+        rescore_root, rescore_ext = os.path.splitext(rescore_path or "")
+        return {
+            "chroma_path": chroma_path,
+            "collection_name": f"{collection_name}_{version}",
+            "manifest_path": f"{manifest_root}.{version}{manifest_ext}",
+            "docstore_path": f"{docstore_root}.{version}{docstore_ext}",
+            "vector_persist_dir": f"{persist_dir.rstrip('/')}_{version}" if persist_dir else None,
+            "vector_rescore_path": f"{rescore_root}.{version}{rescore_ext}" if rescore_path else None
+        }
+    
+    def _create_index(self, documents, node_parser, location: Dict[str, Any], fallback: bool = True):
+        """在 location 建立索引；fallback 為 False 時（藍綠重建）後端失敗直接丟出例外，不改用記憶體索引"""
+        backend = self._vector_backend()
+        if backend == "chroma":
+            return self._create_chroma_index(documents, node_parser, location, fallback=fallback)
+        elif backend == "numpy":
+            return self._create_numpy_index(documents, node_parser, location)
+        elif backend == "faiss":
+            return self._create_faiss_index(documents, node_parser, location)
         else:
-            return self._create_simple_index(documents, node_parser)
+            return self._create_simple_index(documents, node_parser, location)
+    
+    def _docstore_path(self, location: Dict[str, Any]) -> str:
+        """FAISS 持久化時 docstore 放在持久化目錄中一起載入；其他後端每次啟動都重建索引"""
+        if self._vector_backend() == "faiss" and location["vector_persist_dir"]:
+            return os.path.join(location["vector_persist_dir"], "docstore.db")
+        return location["docstore_path"]
+    
+    def _create_docstore(self, location: Dict[str, Any], fresh: bool = True) -> Optional[LazyDocumentStore]:
+        """lazy_docstore 開啟時節點內容存在 SQLite，檢索回傳後才讀取；否則回傳 None（框架預設的記憶體內 docstore）
+        
+        fresh 為 True 時先刪除舊檔：重建的節點 ID 與上次不同，沿用舊檔只會累積用不到的節點。
+        """
+        if not self.config.get("lazy_docstore", False):
+            return None
+        
+        path = self._docstore_path(location)
+        if fresh:
+            remove_database(path)
+        return LazyDocumentStore(path, cache_size=self.config.get("docstore_cache_size", 1024))
+    
+    def _ingest_pipeline(self, node_parser, **kwargs) -> ParallelIngestPipeline:
+        """以 node_parser 的切塊設定建立平行匯入管線"""
+        return ParallelIngestPipeline(
+            chunk_size=node_parser.chunk_size,
+            chunk_overlap=node_parser.chunk_overlap,
+            max_workers=self.config.get("ingest_workers"),
+            file_timeout=self.config.get("ingest_file_timeout", 120.0),
+            **kwargs
+        )
+    
+    def _build_index(self, documents, node_parser, storage_context=None):
+        """由文件建立索引；documents 為 None 時串流匯入 documents_dir
+        
+        行程池平行解析與切塊，每完成 ingest_stream_batch 個節點就交給嵌入與寫入，
+        此時行程池繼續處理後面的檔案，解析、切塊與嵌入互相重疊。
+        """
+        if documents is not None:
+            return VectorStoreIndex.from_documents(
+                documents,
+                storage_context=storage_context,
+                transformations=[node_parser]
+            )
+        
+        index = VectorStoreIndex(nodes=[], storage_context=storage_context)
+        pipeline = self._ingest_pipeline(
+            node_parser,
+            input_dir=self.config.get("documents_dir", "sample_documents")
+        )
+        for batch in pipeline.iter_batches(self.config.get("ingest_stream_batch", 1024)):
+            index.insert_nodes(batch)
+        
+        stats = pipeline.stats
+        logger.info(
+            f"平行匯入完成: {stats['files']} 個檔案、{stats['items']} 個節點，"
+            f"失敗 {stats['failed']}、逾時 {stats['timed_out']}，耗時 {stats['seconds']:.1f} 秒"
+        )
+        return index
     
-    def _create_simple_index(self, documents, node_parser):
+    def _create_simple_index(self, documents, node_parser, location: Dict[str, Any]):
         """建立簡單索引"""
-        index = VectorStoreIndex.from_documents(
+        docstore = self._create_docstore(location)
+        index = self._build_index(
             documents,
-            transformations=[node_parser]
+            node_parser,
+            StorageContext.from_defaults(docstore=docstore) if docstore is not None else None
         )
         logger.info("簡單索引建立完成")
         return index
     
-    def _create_chroma_index(self, documents, node_parser):
-        """建立 ChromaDB 索引"""
+    def _create_numpy_index(self, documents, node_parser, location: Dict[str, Any]):
+        """建立以連續 NumPy 陣列（可量化）儲存向量的索引
+        
+        重新計分的 float32 向量寫在 vector_rescore_path（未設定時為暫存檔）並以記憶體映射讀取；
+        每個版本使用自己的檔案，重建時不會清空服務中版本的向量。
+        """
+        vector_store = NumpyVectorStore(
+            dtype=self.config.get("vector_dtype", "float16"),
+            rescore=self.config.get("vector_rescore", True),
+            full_precision_path=location["vector_rescore_path"]
+        )
+        index = self._build_index(
+            documents,
+            node_parser,
+            StorageContext.from_defaults(vector_store=vector_store, docstore=self._create_docstore(location))
+        )
+        logger.info(f"NumPy 索引建立完成，向量型別: {vector_store.dtype}，節點數: {vector_store.node_count}")
+        return index
+    
+    def _create_faiss_index(self, documents, node_parser, location: Dict[str, Any]):
+        """建立以 FAISS 近似最近鄰搜尋的索引；設定 vector_persist_dir 時與 docstore 一起持久化"""
+        # 查詢參數不影響索引內容，載入既有索引時也以目前的設定為準
+        search_params = {
+            "nprobe": self.config.get("faiss_nprobe", 16),
+            "ef_search": self.config.get("faiss_ef_search", 64)
+        }
+        persist_dir = location["vector_persist_dir"]
+        
+        if persist_dir and os.path.exists(os.path.join(persist_dir, "index_store.json")):
+            try:
+                vector_store = FaissANNVectorStore.from_persist_dir(persist_dir, **search_params)
+                docstore = self._create_docstore(location, fresh=False)
+                if docstore is not None and docstore.node_count == 0:
+                    raise FileNotFoundError(f"{docstore.path} 沒有節點（索引以記憶體內 docstore 建立）")
+                index = load_index_from_storage(
+                    StorageContext.from_defaults(
+                        persist_dir=persist_dir,
+                        vector_store=vector_store,
+                        docstore=docstore
+                    )
+                )
+                logger.info(f"已載入持久化的 FAISS 索引（{vector_store.index_type}），節點數: {vector_store.node_count}；刪除 {persist_dir} 可重建")
+                return index
+            except (FileNotFoundError, ValueError) as e:
+                logger.warning(f"無法載入持久化的 FAISS 索引，重新建立: {e}")
+        
+        vector_store = FaissANNVectorStore(
+            index_type=self.config.get("faiss_index_type", "hnsw"),
+            nlist=self.config.get("faiss_nlist"),
+            train_size=self.config.get("faiss_train_size", 20000),
+            hnsw_m=self.config.get("faiss_hnsw_m", 32),
+            ef_construction=self.config.get("faiss_ef_construction", 200),
+            **search_params
+        )
+        index = self._build_index(
+            documents,
+            node_parser,
+            StorageContext.from_defaults(vector_store=vector_store, docstore=self._create_docstore(location))
+        )
+        if persist_dir:
+            index.storage_context.persist(persist_dir=persist_dir)
+        logger.info(f"FAISS 索引建立完成，類型: {type(vector_store.client).__name__}，節點數: {vector_store.node_count}")
+        return index
+    
+    def _create_chroma_index(self, documents, node_parser, location: Dict[str, Any], fallback: bool = True):
+        """建立 ChromaDB 索引（chroma_shards > 1 時雜湊分片到多個集合）
+        
+        啟動時 ChromaDB 無法使用會改用記憶體索引讓服務先起來；重建時（fallback=False）
+        則讓重建失敗，避免以版本名稱切換到一個重啟後就消失的記憶體索引。
+        """
         try:
-            # 初始化 ChromaDB
-            chroma_client = chromadb.PersistentClient(
-                path=self.config.get("chroma_path", "./chroma_production")
-            )
-            
-            collection = chroma_client.get_or_create_collection(
-                name=self.config.get("collection_name", "production_kb"),
-                metadata={"description": "生產環境知識庫"}
-            )
+            collections = self._open_chroma_collections(location)
             
             # 建立向量儲存
-            vector_store = ChromaVectorStore(chroma_collection=collection)
+            shards = [ChromaVectorStore(chroma_collection=collection) for collection in collections]
+            vector_store = shards[0] if len(shards) == 1 else ShardedVectorStore(shards)
             storage_context = StorageContext.from_defaults(vector_store=vector_store)
             
             # 建立索引
-            index = VectorStoreIndex.from_documents(
-                documents,
-                storage_context=storage_context,
-                transformations=[node_parser]
-            )
+            if self._use_incremental_ingest():
+                index = self._sync_chroma_index(collections, vector_store, storage_context, node_parser, location)
+            else:
+                index = self._build_index(documents, node_parser, storage_context)
             
-            logger.info(f"ChromaDB 索引建立完成，集合: {collection.name}")
+            logger.info(f"ChromaDB 索引建立完成，集合: {', '.join(collection.name for collection in collections)}")
             return index
             
         except Exception as e:
             logger.error(f"ChromaDB 索引建立失敗: {e}")
-            return self._create_simple_index(documents, node_parser)
+            if not fallback:
+                raise
+            return self._create_simple_index(documents or self._load_documents(), node_parser, location)
     
-    def _create_query_engine(self):
-        """建立查詢引擎"""
-        query_engine = self.index.as_query_engine(
-            similarity_top_k=self.config.get("similarity_top_k", 3),
+    def _chroma_collection_specs(self, location: Dict[str, Any]) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """ChromaDB 集合的 (持久化路徑, 集合名稱, 元數據)
+        
+        chroma_shards 為分片數；chroma_shard_layout 為 "collections" 時分片是同一資料庫中的
+        多個集合，為 "paths" 時每個分片各有獨立的持久化目錄（寫入時不共用同一個 SQLite 檔）。
+        分片數決定節點落在哪個分片，建立後不可更改。
+        """
+        chroma_path = location["chroma_path"]
+        collection_name = location["collection_name"]
+        num_shards = self.config.get("chroma_shards", 1)
+        metadata = {"description": "生產環境知識庫"}
+        
+        if num_shards <= 1:
+            return [(chroma_path, collection_name, metadata)]
+        
+        if self.config.get("chroma_shard_layout", "collections") == "paths":
+            return [
+                (os.path.join(chroma_path, f"shard_{shard}"), collection_name, {**metadata, "shard": shard, "num_shards": num_shards})
+                for shard in range(num_shards)
+            ]
+        
+        return [
+            (chroma_path, f"{collection_name}_shard{shard}", {**metadata, "shard": shard, "num_shards": num_shards})
+            for shard in range(num_shards)
+        ]
+    
+    def _open_chroma_collections(self, location: Dict[str, Any]) -> List[Any]:
+        """開啟（或建立）ChromaDB 集合"""
+        return [
+            chromadb.PersistentClient(path=path).get_or_create_collection(name=name, metadata=metadata)
+            for path, name, metadata in self._chroma_collection_specs(location)
+        ]
+    
+    def _sync_chroma_index(self, collections, vector_store, storage_context, node_parser, location: Dict[str, Any]):
+        """依照匯入清單只處理新增、變更與刪除的檔案"""
+        manifest = IngestManifest(location["manifest_path"])
+        
+        # 集合被清空或重建時，清單已不可信，改為完整匯入
+        if manifest.files and sum(collection.count() for collection in collections) == 0:
+            logger.warning("向量集合為空但清單存在，將重新匯入所有檔案")
+            manifest.files = {}
+        
+        index = VectorStoreIndex.from_vector_store(
+            vector_store,
+            transformations=[node_parser]
+        )
+        
+        documents_dir = self.config.get("documents_dir", "sample_documents")
+        if not os.path.exists(documents_dir):
+            logger.warning(f"文件目錄不存在: {documents_dir}")
+            return index
+        
+        file_paths = [str(path) for path in SimpleDirectoryReader(input_dir=documents_dir).input_files]
+        changed, deleted = manifest.diff(documents_dir, file_paths)
+        
+        # 移除已刪除檔案的向量
+        for key in deleted:
+            for doc_id in manifest.files.pop(key)["doc_ids"]:
+                vector_store.delete(doc_id)
+        
+        # 在行程池中平行重新解析與切塊新增或變更的檔案，完成一個就嵌入一個；
+        # 解析失敗或逾時的檔案保留舊向量且不寫入清單，下次啟動時重試
+        key_of = {entry["file_path"]: key for key, entry in changed.items()}
+        pipeline = self._ingest_pipeline(node_parser, input_files=list(key_of), filename_as_id=True)
+        for file_path, nodes in pipeline:
+            key = key_of[file_path]
+            entry = changed[key]
+            old_entry = manifest.files.get(key)
+            if old_entry:
+                for doc_id in old_entry["doc_ids"]:
+                    vector_store.delete(doc_id)
+            
+            index.insert_nodes(nodes)
+            
+            manifest.files[key] = {
+                "size": entry["size"],
+                "mtime": entry["mtime"],
+                "sha256": entry["sha256"],
+                "doc_ids": list(dict.fromkeys(node.ref_doc_id for node in nodes))
+            }
+        
+        manifest.save()
+        logger.info(
+            f"增量匯入完成: 新增/變更 {len(changed)} 個檔案，刪除 {len(deleted)} 個檔案，"
+            f"未變更 {len(file_paths) - len(changed)} 個檔案，"
+            f"解析失敗或逾時 {pipeline.stats['failed'] + pipeline.stats['timed_out']} 個檔案"
+        )
+        return index
+    
+    def _create_query_engine(self, index) -> Tuple[Any, List[Any], Any, RetrieverQueryEngine]:
+        """建立查詢引擎（各階段元件分開保存，以便逐段計時）
+        
+        回傳 (檢索器, 後處理器, 合成器, 查詢引擎)；不修改系統屬性，重建時建立新版本的元件
+        不會影響正在服務的查詢。
+        """
+        retriever = BatchVectorIndexRetriever.from_index(
+            index,
+            similarity_top_k=self.config.get("similarity_top_k", 3)
+        )
+        
+        node_postprocessors = []
+        if self.config.get("similarity_cutoff") is not None:
+            node_postprocessors.append(
+                SimilarityPostprocessor(similarity_cutoff=self.config["similarity_cutoff"])
+            )
+        
+        response_synthesizer = get_response_synthesizer(
             response_mode=self.config.get("response_mode", "compact"),
             streaming=self.config.get("streaming", False)
         )
         
+        query_engine = RetrieverQueryEngine(
+            retriever=retriever,
+            response_synthesizer=response_synthesizer,
+            node_postprocessors=node_postprocessors
+        )
+        
         logger.info("查詢引擎建立完成")
-        return query_engine
+        return retriever, node_postprocessors, response_synthesizer, query_engine
+    
+    def _create_version(self, version: Optional[str], location: Dict[str, Any], index) -> IndexVersion:
+        """由索引建立可服務的版本"""
+        retriever, node_postprocessors, response_synthesizer, query_engine = self._create_query_engine(index)
+        return IndexVersion(version, location, index, retriever, node_postprocessors, response_synthesizer, query_engine)
+    
+    def _activate(self, version: IndexVersion):
+        """切換服務中的版本
+        
+        每個查詢只在開始時讀取一次 self.active_version，並從這個版本取用檢索器、後處理器與合成器；
+        切換是單一屬性指派（GIL 下不可分割），因此查詢路徑不需要鎖：
+        已開始的查詢在舊版本上完成，之後的查詢使用新版本。
+        """
+        self.active_version = version
+        
+        # 索引內容改變後，快取中的答案可能已過時
+        if self.answer_cache is not None:
+            self.answer_cache.clear()
+    
+    # 查詢元件唯一的來源是服務中的版本；以下唯讀屬性方便外部檢視，替換檢索器請用 replace_retriever
+    @property
+    def index(self):
+        return self.active_version.index if self.active_version else None
+    
+    @property
+    def retriever(self):
+        return self.active_version.retriever if self.active_version else None
+    
+    @property
+    def node_postprocessors(self) -> List[Any]:
+        return self.active_version.node_postprocessors if self.active_version else []
+    
+    @property
+    def response_synthesizer(self):
+        return self.active_version.response_synthesizer if self.active_version else None
+    
+    @property
+    def query_engine(self):
+        return self.active_version.query_engine if self.active_version else None
+    
+    def replace_retriever(self, retriever: BaseRetriever) -> IndexVersion:
+        """以另一個檢索器服務目前的版本（例如預先分叉工作行程的記憶體映射檢索器）
+        
+        建立共用索引、儲存位置、後處理器與合成器的新版本物件並切換過去，
+        查詢、就緒探針與冒煙檢索都會改用這個檢索器。
+        """
+        if not self._rebuild_lock.acquire(blocking=False):
+            raise RuntimeError("已有重建或回滾在進行中")
+        
+        try:
+            current = self.active_version
+            if current is None:
+                raise RuntimeError("尚無服務中的索引版本")
+            
+            version = IndexVersion(
+                current.version,
+                current.location,
+                current.index,
+                retriever,
+                current.node_postprocessors,
+                current.response_synthesizer,
+                RetrieverQueryEngine(
+                    retriever=retriever,
+                    response_synthesizer=current.response_synthesizer,
+                    node_postprocessors=current.node_postprocessors
+                )
+            )
+            self._activate(version)
+            return version
+        finally:
+            self._rebuild_lock.release()
+    
+    def _version_pointer_path(self) -> Optional[str]:
+        """記錄服務中版本的指標檔，重啟後開啟同一個版本；記憶體內的後端沒有指標"""
+        if self.config.get("version_pointer_path"):
+            return self.config["version_pointer_path"]
+        
+        backend = self._vector_backend()
+        if backend == "chroma":
+            return f"{self.config.get('chroma_path', './chroma_production').rstrip('/')}.active.json"
+        if backend == "faiss" and self.config.get("vector_persist_dir"):
+            return f"{self.config['vector_persist_dir'].rstrip('/')}.active.json"
+        return None
+    
+    def _read_version_pointer(self) -> Dict[str, Any]:
+        """讀取版本指標；不存在或損毀時使用原始位置"""
+        path = self._version_pointer_path()
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"版本指標讀取失敗，使用原始位置: {e}")
+            return {}
+    
+    def _write_version_pointer(self):
+        """以暫存檔加 os.replace 原子更新版本指標"""
+        path = self._version_pointer_path()
+        if not path:
+            return
+        
+        pointer = {
+            "version": self.active_version.version,
+            "previous": [version.version for version in self._previous_versions],
+            "updated_at": time.time()
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(pointer, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    def _drop_storage(self, location: Dict[str, Any]):
+        """刪除某個版本在磁碟上的集合、匯入清單或持久化目錄"""
+        backend = self._vector_backend()
+        if backend == "chroma":
+            for path, name, _ in self._chroma_collection_specs(location):
+                try:
+                    chromadb.PersistentClient(path=path).delete_collection(name)
+                except Exception as e:
+                    logger.debug(f"集合 {name} 無法刪除（可能不存在）: {e}")
+            if os.path.exists(location["manifest_path"]):
+                os.remove(location["manifest_path"])
+        elif backend == "faiss" and location["vector_persist_dir"]:
+            shutil.rmtree(location["vector_persist_dir"], ignore_errors=True)
+        elif backend == "numpy" and location["vector_rescore_path"] and os.path.exists(location["vector_rescore_path"]):
+            os.remove(location["vector_rescore_path"])
+        
+        if self.config.get("lazy_docstore", False) and backend != "chroma":
+            remove_database(self._docstore_path(location))
+    
+    def _new_version_name(self) -> str:
+        """以時間戳記命名新版本，與現有版本重複時加上序號"""
+        existing = {version.version for version in self._previous_versions} | self._draining_versions
+        existing.add(self.active_version.version if self.active_version else None)
+        base = time.strftime("%Y%m%d%H%M%S")
+        name, suffix = base, 1
+        while name in existing:
+            suffix += 1
+            name = f"{base}-{suffix}"
+        return name
+    
+    def _smoke_test(self, version: IndexVersion) -> Dict[str, Any]:
+        """以探針查詢（與 rebuild_smoke_queries）檢索新版本，每個查詢至少要取回 rebuild_min_nodes 個節點"""
+        probe_query = self.config.get("probe_query", "健康檢查")
+        queries = self.config.get("rebuild_smoke_queries") or [probe_query]
+        min_nodes = self.config.get("rebuild_min_nodes", 1)
+        
+        checks = []
+        for query in queries:
+            embedding = self._get_probe_embedding() if query == probe_query else self.query_embed_model.get_query_embedding(query)
+            nodes = version.retriever.retrieve(QueryBundle(query_str=query, embedding=embedding))
+            checks.append({"query": query, "nodes": len(nodes)})
+        
+        return {
+            "passed": all(check["nodes"] >= min_nodes for check in checks),
+            "min_nodes": min_nodes,
+            "checks": checks
+        }
+    
+    def _retire(self, version: IndexVersion) -> List[IndexVersion]:
+        """把被取代的版本放入回滾佇列，移出超過 index_keep_previous 的最舊版本
+        
+        在重建鎖內呼叫，只更新佇列與版本指標；回傳需要刪除儲存的版本，由呼叫端釋放鎖後交給 _drop_retired。
+        """
+        version.retired_at = time.time()
+        self._previous_versions.append(version)
+        
+        expired = []
+        keep = self.config.get("index_keep_previous", 1)
+        while len(self._previous_versions) > keep:
+            oldest = self._previous_versions.popleft()
+            self._draining_versions.add(oldest.version)
+            expired.append(oldest)
+        self._write_version_pointer()
+        return expired
+    
+    def _start_drain(self, versions: List[IndexVersion]) -> threading.Thread:
+        """在背景執行緒等待舊版本的查詢期限後刪除儲存，rebuild() 切換完成即可返回"""
+        self._drain_threads = [thread for thread in self._drain_threads if thread.is_alive()]
+        thread = threading.Thread(target=self._drop_retired, args=(versions,), name="index-drain", daemon=True)
+        thread.start()
+        self._drain_threads.append(thread)
+        return thread
+    
+    def _drop_retired(self, versions: List[IndexVersion]):
+        """刪除已移出回滾佇列的版本儲存；在背景執行緒執行，等待期間不阻擋查詢、回滾與下一次重建"""
+        for version in versions:
+            try:
+                # 剛被取代的版本可能仍有查詢在執行；查詢都有期限，等期限過後再刪除儲存
+                grace = version.retired_at + self.config.get("query_timeout", 30.0) - time.time()
+                if grace > 0:
+                    time.sleep(grace)
+                self._drop_storage(version.location)
+                logger.info(f"已清理舊索引版本: {version.name}")
+            except Exception as e:
+                logger.error(f"舊索引版本 {version.name} 清理失敗: {e}")
+            finally:
+                self._draining_versions.discard(version.version)
+    
+    def rebuild(self) -> Dict[str, Any]:
+        """藍綠重建：在旁邊的集合或目錄建立新版本，通過冒煙檢索後原子切換
+        
+        重建期間目前的版本繼續服務查詢；建立或驗證失敗時刪除新版本的資料，服務不受影響。
+        被取代的版本保留在記憶體中（index_keep_previous 個），可用 rollback() 切回。
+        """
+        if not self._rebuild_lock.acquire(blocking=False):
+            raise RuntimeError("已有重建或回滾在進行中")
+        
+        start_time = time.time()
+        version_name = self._new_version_name()
+        location = self._storage_location(version_name)
+        previous = self.active_version
+        result = {"version": version_name, "previous_version": previous.name if previous else None}
+        expired: List[IndexVersion] = []
+        
+        try:
+            try:
+                logger.info(f"開始藍綠重建索引版本 {version_name}，目前服務版本: {result['previous_version']}")
+                documents = [] if self._use_incremental_ingest() else self._load_documents()
+                index = self._create_index(documents, self._create_node_parser(), location, fallback=False)
+                candidate = self._create_version(version_name, location, index)
+                
+                result["smoke"] = self._smoke_test(candidate)
+                if not result["smoke"]["passed"]:
+                    raise RuntimeError(f"冒煙檢索未通過: {result['smoke']['checks']}")
+            except Exception as e:
+                logger.error(f"索引版本 {version_name} 重建失敗，繼續使用 {result['previous_version']}: {e}")
+                self._drop_storage(location)
+                self.metrics.inc("rag_index_rebuilds_total", labels={"result": "failed"})
+                result.update({"success": False, "error": str(e)})
+            else:
+                self._activate(candidate)
+                self.metrics.inc("rag_index_rebuilds_total", labels={"result": "success"})
+                result["success"] = True
+                logger.info(f"已切換到索引版本 {version_name}，重建耗時 {time.time() - start_time:.1f} 秒")
+                
+                # 切換已完成，清理舊版本失敗不影響服務
+                try:
+                    if previous is not None:
+                        expired = self._retire(previous)
+                    else:
+                        self._write_version_pointer()
+                except Exception as e:
+                    logger.error(f"舊索引版本清理失敗: {e}")
+        finally:
+            self._rebuild_lock.release()
+        
+        result["seconds"] = time.time() - start_time
+        result["timestamp"] = time.time()
+        self.last_rebuild = result
+        
+        # 舊版本的查詢期限在背景等待，期間可以回滾或開始下一次重建
+        if expired:
+            self._start_drain(expired)
+        return result
+    
+    def start_rebuild(self) -> threading.Thread:
+        """在背景執行緒執行 rebuild()，結果記錄在 last_rebuild"""
+        if self._rebuild_lock.locked():
+            raise RuntimeError("已有重建或回滾在進行中")
+        
+        def run():
+            try:
+                self.rebuild()
+            except Exception as e:
+                logger.error(f"背景重建失敗: {e}")
+        
+        thread = threading.Thread(target=run, name="index-rebuild", daemon=True)
+        thread.start()
+        return thread
+    
+    def rollback(self) -> Dict[str, Any]:
+        """切回最近一個仍在記憶體中的舊版本；目前的版本放回佇列，可再次回滾切回"""
+        if not self._rebuild_lock.acquire(blocking=False):
+            raise RuntimeError("已有重建或回滾在進行中")
+        
+        try:
+            candidates = [version for version in self._previous_versions if version.index is not None]
+            if not candidates:
+                raise RuntimeError("沒有可回滾的索引版本")
+            
+            target = candidates[-1]
+            current = self.active_version
+            self._previous_versions.remove(target)
+            self._activate(target)
+            current.retired_at = time.time()
+            self._previous_versions.append(current)
+            self._write_version_pointer()
+            
+            self.metrics.inc("rag_index_rollbacks_total")
+            logger.warning(f"已回滾索引版本: {current.name} -> {target.name}")
+            return {"version": target.name, "previous_version": current.name, "timestamp": time.time()}
+        finally:
+            self._rebuild_lock.release()
+    
+    def _run_query_pipeline(self, question: str):
+        """依序執行嵌入、檢索、後處理與生成，並記錄各階段耗時"""
+        stage_times = {}
+        
+        stage_start = time.perf_counter()
+        with self._track_dependency("embedding"):
+            embedding = self._embed_query(question)
+        query_bundle = QueryBundle(query_str=question, embedding=embedding)
+        stage_times["embedding"] = time.perf_counter() - stage_start
+        
+        cached_response = self._lookup_answer_cache(embedding)
+        if cached_response is not None:
+            return cached_response, stage_times, True
+        
+        # 只讀取一次，藍綠切換時進行中的查詢留在原本的版本上（檢索、後處理與合成都用同一個版本）
+        version = self.active_version
+        stage_start = time.perf_counter()
+        nodes = version.retriever.retrieve(query_bundle)
+        stage_times["retrieval"] = time.perf_counter() - stage_start
+        
+        stage_start = time.perf_counter()
+        for postprocessor in version.node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        stage_times["postprocess"] = time.perf_counter() - stage_start
+        
+        stage_start = time.perf_counter()
+        with self._track_dependency("llm"):
+            response = version.response_synthesizer.synthesize(query_bundle, nodes)
+        stage_times["synthesis"] = time.perf_counter() - stage_start
+        
+        # 查詢期間已切換到新版本時，舊版本的答案不寫入快取
+        if self.answer_cache is not None and version is self.active_version:
+            self.answer_cache.store(embedding, response)
+        
+        return response, stage_times, False
+    
+    async def _arun_query_pipeline(self, question: str):
+        """_run_query_pipeline 的非同步版本"""
+        stage_times = {}
+        
+        stage_start = time.perf_counter()
+        with self._track_dependency("embedding"):
+            embedding = await self._aembed_query(question)
+        query_bundle = QueryBundle(query_str=question, embedding=embedding)
+        stage_times["embedding"] = time.perf_counter() - stage_start
+        
+        cached_response = self._lookup_answer_cache(embedding)
+        if cached_response is not None:
+            return cached_response, stage_times, True
+        
+        # 只讀取一次，藍綠切換時進行中的查詢留在原本的版本上（檢索、後處理與合成都用同一個版本）
+        version = self.active_version
+        stage_start = time.perf_counter()
+        nodes = await version.retriever.aretrieve(query_bundle)
+        stage_times["retrieval"] = time.perf_counter() - stage_start
+        
+        stage_start = time.perf_counter()
+        for postprocessor in version.node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        stage_times["postprocess"] = time.perf_counter() - stage_start
+        
+        stage_start = time.perf_counter()
+        with self._track_dependency("llm"):
+            response = await version.response_synthesizer.asynthesize(query_bundle, nodes)
+        stage_times["synthesis"] = time.perf_counter() - stage_start
+        
+        # 查詢期間已切換到新版本時，舊版本的答案不寫入快取
+        if self.answer_cache is not None and version is self.active_version:
+            self.answer_cache.store(embedding, response)
+        
+        return response, stage_times, False
+    
+    def _embed_query(self, question: str) -> List[float]:
+        """取得查詢嵌入，開啟微批次時交給批次器"""
+        if self._query_embed_batcher is not None:
+            return self._query_embed_batcher.embed(question)
+        return self.query_embed_model.get_query_embedding(question)
+    
+    async def _aembed_query(self, question: str) -> List[float]:
+        """_embed_query 的非同步版本"""
+        if self._query_embed_batcher is not None:
+            return await self._query_embed_batcher.aembed(question)
+        return await self.query_embed_model.aget_query_embedding(question)
+    
+    def _embed_query_batch(self, questions: List[str]) -> List[List[float]]:
+        """以一次文字嵌入呼叫處理整批查詢，查詢不寫入持久化嵌入快取"""
+        return embed_query_batch(self.query_embed_model, questions)
+    
+    async def _aembed_query_batch(self, questions: List[str]) -> List[List[float]]:
+        """_embed_query_batch 的非同步版本"""
+        return await aembed_query_batch(self.query_embed_model, questions)
+    
+    def _record_embed_batch(self, size: int):
+        """記錄一次查詢嵌入批次的大小與填滿比例"""
+        self.metrics.inc("rag_query_embed_batches_total")
+        self.metrics.inc("rag_query_embed_batched_queries_total", size)
+        self.metrics.observe("rag_query_embed_batch_fill_ratio", size / self._query_embed_batcher.max_batch_size)
+    
+    @contextmanager
+    def _track_dependency(self, name: str):
+        """記錄外部依賴呼叫的成功或失敗"""
+        status = self.dependency_status[name]
+        try:
+            yield
+        except Exception as e:
+            status["last_failure"] = time.time()
+            status["last_error"] = str(e)
+            raise
+        status["last_success"] = time.time()
+    
+    def _lookup_answer_cache(self, embedding):
+        """查詢語意快取並更新命中指標"""
+        if self.answer_cache is None:
+            return None
+        
+        cached_response = self.answer_cache.lookup(embedding)
+        if cached_response is not None:
+            self.metrics.inc("rag_answer_cache_hits_total")
+        else:
+            self.metrics.inc("rag_answer_cache_misses_total")
+        return cached_response
     
     def query(self, question: str) -> Dict[str, Any]:
         """執行查詢"""
         start_time = time.time()
-        self.metrics["total_queries"] += 1
+        self.metrics.inc("rag_queries_total")
         
         try:
+            self._validate_question(question)
             logger.info(f"執行查詢: {question}")
             
-            response = self.query_engine.query(question)
+            (response, stage_times, cache_hit), coalesced = self._query_coalesced(
+                question,
+                deadline=time.time() + self.config.get("query_timeout", 30.0)
+            )
             
-            end_time = time.time()
-            response_time = end_time - start_time
+            return self._build_success_result(response, time.time() - start_time, stage_times, cache_hit, coalesced)
             
-            # 更新指標
-            self.metrics["successful_queries"] += 1
-            self._update_average_response_time(response_time)
+        except TimeoutError as e:
+            # 與 aquery 相同：等待中的合併請求逾時以 504 回應並計入逾時指標
+            self.metrics.inc("rag_queries_timeout_total")
+            return self._build_failure_result(e, time.time() - start_time)
             
-            result = {
-                "success": True,
-                "response": response.response,
-                "response_time": response_time,
-                "source_nodes": len(response.source_nodes),
-                "timestamp": time.time()
-            }
+        except Exception as e:
+            return self._build_failure_result(e, time.time() - start_time)
+    
+    async def aquery(self, question: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """非同步執行查詢（受並行上限與逾時限制）"""
+        if timeout is None:
+            timeout = self.config.get("query_timeout", 30.0)
+        
+        start_time = time.time()
+        self.metrics.inc("rag_queries_total")
+        
+        try:
+            self._validate_question(question)
+            logger.info(f"執行非同步查詢: {question}")
             
-            logger.info(f"查詢成功，回應時間: {response_time:.2f}秒")
-            return result
+            # 逾時涵蓋排隊等待名額的時間，確保每個請求都有明確期限
+            (response, stage_times, cache_hit), coalesced = await asyncio.wait_for(
+                self._aquery_coalesced(question, deadline=start_time + timeout),
+                timeout=timeout
+            )
             
-        except Exception as e:
-            end_time = time.time()
-            response_time = end_time - start_time
+            return self._build_success_result(response, time.time() - start_time, stage_times, cache_hit, coalesced)
             
-            self.metrics["failed_queries"] += 1
-            logger.error(f"查詢失敗: {e}")
+        except asyncio.TimeoutError:
+            self.metrics.inc("rag_queries_timeout_total")
+            return self._build_failure_result(
+                TimeoutError(f"查詢逾時 ({timeout} 秒)"),
+                time.time() - start_time
+            )
             
-            return {
-                "success": False,
-                "error": str(e),
-                "response_time": response_time,
-                "timestamp": time.time()
-            }
+        except Exception as e:
+            return self._build_failure_result(e, time.time() - start_time)
+    
+    async def aquery_many(self, questions: List[str], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """非同步批次查詢，結果順序與輸入一致"""
+        return await asyncio.gather(
+            *(self.aquery(question, timeout=timeout) for question in questions)
+        )
     
-    def _update_average_response_time(self, response_time: float):
-        """更新平均回應時間"""
-        total_successful = self.metrics["successful_queries"]
-        current_avg = self.metrics["average_response_time"]
+    def retrieve_many(self, questions: List[str], top_k: Optional[int] = None) -> List[List[Any]]:
+        """批次檢索（離線評估、大量問題）：一次嵌入呼叫、一次矩陣計分，不經過 LLM
+        
+        結果為每個問題經過後處理的節點，順序與輸入一致。
+        """
+        for question in questions:
+            self._validate_question(question)
+        
+        with self._track_dependency("embedding"):
+            embeddings = self._embed_query_batch(questions) if questions else []
+        query_bundles = [
+            QueryBundle(query_str=question, embedding=embedding)
+            for question, embedding in zip(questions, embeddings)
+        ]
         
-        # 計算新的平均值
-        new_avg = ((current_avg * (total_successful - 1)) + response_time) / total_successful
-        self.metrics["average_response_time"] = new_avg
+        version = self.active_version
+        results = version.retriever.retrieve_many(query_bundles, top_k=top_k)
+        for i, query_bundle in enumerate(query_bundles):
+            for postprocessor in version.node_postprocessors:
+                results[i] = postprocessor.postprocess_nodes(results[i], query_bundle=query_bundle)
+        return results
+    
+    def _validate_question(self, question: str):
+        """在花費任何嵌入或 LLM token 之前拒絕不合法的輸入"""
+        if not question or not question.strip():
+            raise QueryRejectedError("查詢內容不可為空", 400, "empty")
+        
+        max_tokens = self.config.get("max_query_tokens", 512)
+        token_count = len(self._tokenizer(question))
+        if token_count > max_tokens:
+            raise QueryRejectedError(
+                f"查詢過長: {token_count} tokens（上限 {max_tokens}）", 400, "too_long"
+            )
+    
+    def _query_coalesced(self, question: str, deadline: float):
+        """與進行中的相同查詢合併，回傳 (管線結果, 是否共用)"""
+        if self._single_flight is None:
+            return self._query_with_limit(question, deadline), False
+        return self._single_flight.do(
+            self._normalize_query(question),
+            lambda: self._query_with_limit(question, deadline),
+            deadline=deadline
+        )
+    
+    async def _aquery_coalesced(self, question: str, deadline: float):
+        """_query_coalesced 的非同步版本，共用的請求不佔用並行名額"""
+        if self._single_flight is None:
+            return await self._aquery_with_limit(question, deadline), False
+        return await self._single_flight.ado(
+            self._normalize_query(question),
+            lambda: self._aquery_with_limit(question, deadline)
+        )
+    
+    def _query_with_limit(self, question: str, deadline: float):
+        """取得准入名額後執行查詢管線"""
+        self.admission.acquire(deadline)
+        try:
+            return self._run_query_pipeline(question)
+        finally:
+            self.admission.release()
+    
+    async def _aquery_with_limit(self, question: str, deadline: float):
+        """取得准入名額後執行非同步查詢管線"""
+        await self.admission.aacquire(deadline)
+        try:
+            return await self._arun_query_pipeline(question)
+        finally:
+            self.admission.release()
+    
+    @staticmethod
+    def _normalize_query(question: str) -> str:
+        """正規化查詢字串（全形/半形、空白與大小寫），作為合併請求的鍵"""
+        return " ".join(unicodedata.normalize("NFKC", question).split()).casefold()
+    
+    def _build_success_result(self, response, response_time: float, stage_times: Dict[str, float], cache_hit: bool = False, coalesced: bool = False) -> Dict[str, Any]:
+        """更新成功指標並組成查詢結果"""
+        self.metrics.inc("rag_queries_succeeded_total")
+        if coalesced:
+            # 各階段耗時已由實際執行的請求記錄，這裡只記端到端延遲
+            self.metrics.inc("rag_queries_coalesced_total")
+            stage_times = {}
+        self._record_latency(stage_times, response_time)
+        
+        logger.info(f"查詢成功，回應時間: {response_time:.2f}秒")
+        return {
+            "success": True,
+            "response": response.response,
+            "response_time": response_time,
+            "source_nodes": len(response.source_nodes),
+            "stage_times": stage_times,
+            "cache_hit": cache_hit,
+            "coalesced": coalesced,
+            "timestamp": time.time()
+        }
+    
+    def _build_failure_result(self, error: Exception, response_time: float) -> Dict[str, Any]:
+        """更新失敗指標並組成錯誤結果"""
+        if isinstance(error, QueryRejectedError):
+            # 准入階段的拒絕是預期中的降級行為，不算查詢失敗
+            status_code = error.status_code
+            self.metrics.inc("rag_queries_rejected_total", labels={"reason": error.reason})
+            logger.warning(f"查詢被拒絕: {error}")
+        else:
+            status_code = 504 if isinstance(error, TimeoutError) else 500
+            self.metrics.inc("rag_queries_failed_total")
+            logger.error(f"查詢失敗: {error}")
+        
+        return {
+            "success": False,
+            "error": str(error),
+            "status_code": status_code,
+            "response_time": response_time,
+            "timestamp": time.time()
+        }
+    
+    def _record_latency(self, stage_times: Dict[str, float], response_time: float):
+        """將各階段與端到端耗時寫入直方圖"""
+        for stage, elapsed in stage_times.items():
+            self.metrics.observe("rag_query_stage_seconds", elapsed, {"stage": stage})
+        self.metrics.observe("rag_query_stage_seconds", response_time, {"stage": "total"})
     
     def get_metrics(self) -> Dict[str, Any]:
         """獲取系統指標"""
+        counters = {key: self.metrics.counter(name) for key, name in QUERY_COUNTERS.items()}
+        latency = {
+            stage: self.metrics.histogram("rag_query_stage_seconds", {"stage": stage})
+            for stage in QUERY_STAGES
+        }
+        
+        query_embed_batching = None
+        if self._query_embed_batcher is not None:
+            batches = self.metrics.counter("rag_query_embed_batches_total")
+            batched = self.metrics.counter("rag_query_embed_batched_queries_total")
+            query_embed_batching = {
+                "batches": batches,
+                "mean_batch_size": batched / batches if batches else 0.0,
+                "fill_ratio": self.metrics.histogram("rag_query_embed_batch_fill_ratio").snapshot()
+            }
+        
         success_rate = 0
-        if self.metrics["total_queries"] > 0:
-            success_rate = self.metrics["successful_queries"] / self.metrics["total_queries"]
+        if counters["total_queries"] > 0:
+            success_rate = counters["successful_queries"] / counters["total_queries"]
         
         return {
-            **self.metrics,
+            **counters,
+            "average_response_time": latency["total"].mean(),
+            "latency": {stage: histogram.snapshot() for stage, histogram in latency.items()},
+            "cache_size": self.metrics.gauge("rag_answer_cache_entries"),
+            "embedding_cache": self.embed_model.cache_stats() if isinstance(self.embed_model, CachedEmbedding) else None,
+            "docstore": self.index.docstore.cache_stats() if isinstance(self.index.docstore, LazyDocumentStore) else None,
+            "query_embed_batching": query_embed_batching,
+            "ingest": self._adaptive_embed_model.ingest_stats() if self._adaptive_embed_model is not None else None,
+            "index_version": {
+                "active": self.active_version.name if self.active_version else None,
+                "previous": [version.name for version in self._previous_versions],
+                "rebuilds": self.metrics.counter("rag_index_rebuilds_total", {"result": "success"}),
+                "failed_rebuilds": self.metrics.counter("rag_index_rebuilds_total", {"result": "failed"}),
+                "last_rebuild": self.last_rebuild
+            },
             "success_rate": success_rate,
             "system_status": "healthy" if success_rate > 0.9 else "degraded"
         }
     
-    def health_check(self) -> Dict[str, Any]:
-        """健康檢查"""
-        try:
-            # 執行簡單查詢測試
-            test_result = self.query("測試查詢")
+    def start_metrics_server(self, host: str = "127.0.0.1", port: int = 9100) -> ThreadingHTTPServer:
+        """在背景執行緒提供 /metrics、/livez 與 /readyz 端點"""
+        rag_system = self
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    status, content_type = 200, "text/plain; version=0.0.4; charset=utf-8"
+                    body = rag_system.metrics.render_prometheus()
+                elif self.path in ("/livez", "/readyz"):
+                    probe = rag_system.liveness() if self.path == "/livez" else rag_system.readiness()
+                    status = 200 if probe["status"] in ("alive", "ready") else 503
+                    content_type = "application/json; charset=utf-8"
+                    body = json.dumps(probe, ensure_ascii=False, default=str)
+                else:
+                    status, content_type, body = 404, "text/plain; charset=utf-8", "not found\n"
+                
+                payload = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
             
-            return {
-                "status": "healthy" if test_result["success"] else "unhealthy",
-                "response_time": test_result.get("response_time", 0),
-                "timestamp": time.time()
-            }
+            def log_message(self, format, *args):
+                # 抓取請求很頻繁，不寫入應用程式日誌
+                pass
+        
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"指標端點已啟動: http://{host}:{server.server_port}/metrics")
+        return server
+    
+    def _get_probe_embedding(self):
+        """取得快取的探針嵌入（只在第一次計算）"""
+        if self._probe_embedding is None:
+            self._probe_embedding = self.query_embed_model.get_query_embedding(
+                self.config.get("probe_query", "健康檢查")
+            )
+        return self._probe_embedding
+    
+    def _dependency_report(self) -> Dict[str, Any]:
+        """根據最近的請求結果判斷嵌入與 LLM 是否可連線"""
+        window = self.config.get("dependency_failure_window", 60.0)
+        now = time.time()
+        report = {}
+        
+        for name, status in self.dependency_status.items():
+            last_success = status["last_success"]
+            last_failure = status["last_failure"]
+            
+            if last_failure is None and last_success is None:
+                state = "unknown"
+            elif last_failure is not None and now - last_failure <= window and (
+                last_success is None or last_failure > last_success
+            ):
+                state = "unreachable"
+            else:
+                state = "reachable"
             
+            report[name] = {**status, "state": state}
+        return report
+    
+    def liveness(self) -> Dict[str, Any]:
+        """存活探針：只確認行程可回應且元件已載入"""
+        alive = self.index is not None and self.query_engine is not None
+        return {
+            "status": "alive" if alive else "dead",
+            "timestamp": time.time()
+        }
+    
+    def readiness(self) -> Dict[str, Any]:
+        """就緒探針：以快取的探針嵌入檢索一次，不呼叫 LLM 也不計入查詢指標"""
+        start_time = time.perf_counter()
+        
+        try:
+            query_bundle = QueryBundle(
+                query_str=self.config.get("probe_query", "健康檢查"),
+                embedding=self._get_probe_embedding()
+            )
+            # 與查詢路徑讀取同一個服務中的版本，就緒狀態反映查詢實際使用的檢索器
+            nodes = self.active_version.retriever.retrieve(query_bundle)
+            vector_store = {"status": "ok", "nodes": len(nodes)}
         except Exception as e:
-            logger.error(f"健康檢查失敗: {e}")
-            return {
-                "status": "unhealthy",
-                "error": str(e),
-                "timestamp": time.time()
-            }
+            logger.error(f"就緒檢查失敗: {e}")
+            vector_store = {"status": "error", "error": str(e)}
+        
+        dependencies = self._dependency_report()
+        ready = vector_store["status"] == "ok" and all(
+            dependency["state"] != "unreachable" for dependency in dependencies.values()
+        )
+        
+        return {
+            "status": "ready" if ready else "not_ready",
+            "vector_store": vector_store,
+            "index_version": self.active_version.name if self.active_version else None,
+            "dependencies": dependencies,
+            "response_time": time.perf_counter() - start_time,
+            "timestamp": time.time()
+        }
+    
+    def health_check(self) -> Dict[str, Any]:
+        """健康檢查（相容舊介面，內部使用就緒探針）"""
+        readiness = self.readiness()
+        
+        return {
+            "status": "healthy" if readiness["status"] == "ready" else "unhealthy",
+            "response_time": readiness["response_time"],
+            "details": readiness,
+            "timestamp": time.time()
+        }
 
 def demonstrate_production_setup():
     """示範生產環境設定"""
@@ -240,7 +2004,10 @@ def demonstrate_production_setup():
     # 生產環境配置
     production_config = {
         "embedding_model": "text-embedding-3-small",
-        "embed_batch_size": 10,
+        "embed_batch_size": 10,  # 關閉 adaptive_ingest_batching 時使用的固定批次
+        "adaptive_ingest_batching": True,
+        "ingest_max_batch_tokens": 50000,
+        "ingest_max_concurrency": 8,
         "chunk_size": 1024,
         "chunk_overlap": 200,
         "similarity_top_k": 3,
@@ -249,7 +2016,20 @@ def demonstrate_production_setup():
         "use_chroma": True,
         "chroma_path": "./chroma_production",
         "collection_name": "production_kb",
-        "documents_dir": "sample_documents"
+        "chroma_shards": 1,  # >1 時雜湊分片到多個集合，匯入與查詢並行扇出（建立後不可更改）
+        "documents_dir": "sample_documents",
+        "semantic_cache": True,  # 近似問題直接回傳快取答案
+        "cache_similarity_threshold": 0.95,
+        "cache_max_entries": 1000,
+        "cache_ttl": 3600.0,
+        "embedding_cache": True,  # 切塊嵌入持久化於 SQLite，重建索引時重複使用
+        "embedding_cache_path": "./embedding_cache.db",
+        "embedding_cache_max_mb": 512,
+        "query_embed_batching": True,  # 同時抵達的查詢合併為一次嵌入呼叫
+        "query_embed_max_batch": 32,
+        "query_embed_max_wait": 0.005,
+        "index_keep_previous": 1,  # 藍綠重建後保留一個舊版本供回滾
+        "rebuild_smoke_queries": ["什麼是人工智慧？"]  # 新版本必須能檢索到節點才會切換
     }
     
     # 建立生產環境系統
@@ -265,7 +2045,8 @@ def demonstrate_monitoring(rag_system):
     test_queries = [
         "什麼是人工智慧？",
         "雲端運算的優勢有哪些？",
-        "機器學習和深度學習的差異？"
+        "機器學習和深度學習的差異？",
+        "什麼是人工智慧?"  # 近似重複的問題，應命中語意快取
     ]
     
     for query in test_queries:
@@ -276,21 +2057,70 @@ def demonstrate_monitoring(rag_system):
             print(f"✅ 查詢成功")
             print(f"   回應時間: {result['response_time']:.2f}秒")
             print(f"   來源節點: {result['source_nodes']}個")
+            print(f"   命中快取: {'是' if result['cache_hit'] else '否'}")
             print(f"   回應: {result['response'][:100]}...")
         else:
             print(f"❌ 查詢失敗: {result['error']}")
     
+    # 離線評估：所有問題一次嵌入、一次計分，只取檢索結果不呼叫 LLM
+    print(f"\n📚 批次檢索 {len(test_queries)} 個問題:")
+    start_time = time.perf_counter()
+    batch_results = rag_system.retrieve_many(test_queries)
+    print(f"   耗時: {(time.perf_counter() - start_time) * 1000:.1f}毫秒")
+    for query, nodes in zip(test_queries, batch_results):
+        top_score = f"{nodes[0].score:.3f}" if nodes else "-"
+        print(f"   {query} -> {len(nodes)} 個節點，最高分 {top_score}")
+    
     # 顯示系統指標
     print(f"\n📈 系統指標:")
     metrics = rag_system.get_metrics()
     for key, value in metrics.items():
-        print(f"   {key}: {value}")
+        if key != "latency":
+            print(f"   {key}: {value}")
+    
+    # 顯示各階段延遲分佈
+    print(f"\n⏱️ 各階段延遲 (秒):")
+    for stage, stats in metrics["latency"].items():
+        print(f"   {stage:<12} p50={stats['p50']:.3f} p90={stats['p90']:.3f} "
+              f"p99={stats['p99']:.3f} max={stats['max']:.3f}")
+    
+    # Prometheus 匯出格式（可透過 start_metrics_server 提供給抓取端）
+    print(f"\n📤 Prometheus 指標:")
+    for line in rag_system.metrics.render_prometheus().splitlines():
+        if line.startswith("rag_queries"):
+            print(f"   {line}")
     
     # 健康檢查
     print(f"\n🏥 健康檢查:")
     health = rag_system.health_check()
     print(f"   狀態: {health['status']}")
-    print(f"   回應時間: {health.get('response_time', 0):.2f}秒")
+    print(f"   回應時間: {health.get('response_time', 0) * 1000:.1f}毫秒")
+    print(f"   存活探針: {rag_system.liveness()['status']}")
+    for name, dependency in health["details"]["dependencies"].items():
+        print(f"   {name}: {dependency['state']}")
+
+def demonstrate_blue_green_rebuild(rag_system):
+    """示範藍綠重建：背景建立新索引版本時查詢不中斷"""
+    print("\n🔄 藍綠重建示範...")
+    
+    rebuild_thread = rag_system.start_rebuild()
+    
+    # 重建期間每秒查詢一次（最多 10 次），確認仍由目前的版本回答；每次查詢都會呼叫嵌入與 LLM
+    results = []
+    while rebuild_thread.is_alive() and len(results) < 10:
+        results.append(rag_system.query("雲端運算的優勢有哪些？"))
+        rebuild_thread.join(timeout=1.0)
+    rebuild_thread.join()
+    
+    rebuild = rag_system.last_rebuild
+    print(f"   重建期間查詢: {len(results)} 次，失敗 {sum(1 for r in results if not r['success'])} 次")
+    print(f"   重建結果: {'成功' if rebuild['success'] else '失敗'}，耗時 {rebuild['seconds']:.1f}秒")
+    print(f"   服務版本: {rebuild['previous_version']} -> {rag_system.active_version.name}")
+    
+    # 新版本有問題時可立即切回舊版本
+    if rebuild["success"]:
+        rollback = rag_system.rollback()
+        print(f"   回滾: {rollback['previous_version']} -> {rollback['version']}")
 
 def demonstrate_error_handling():
     """示範錯誤處理"""
@@ -299,7 +2129,10 @@ def demonstrate_error_handling():
     # 建立系統
     config = {
         "documents_dir": "sample_documents",
-        "use_chroma": False
+        "use_chroma": False,
+        "max_query_tokens": 512,  # 超過此長度直接拒絕，不花費嵌入與 LLM token
+        "max_concurrent_queries": 16,
+        "max_queue_depth": 32  # 佇列滿時立即回傳 429
     }
     
     rag_system = ProductionRAGSystem(config)
@@ -318,7 +2151,8 @@ def demonstrate_error_handling():
         if result["success"]:
             print(f"✅ 處理成功")
         else:
-            print(f"❌ 處理失敗: {result['error']}")
+            print(f"❌ 處理失敗 ({result['status_code']}): {result['error']}")
+            print(f"   耗時: {result['response_time'] * 1000:.1f}毫秒")
 
 def demonstrate_scalability():
     """示範可擴展性"""
@@ -328,28 +2162,21 @@ def demonstrate_scalability():
     config = {
         "documents_dir": "sample_documents",
         "use_chroma": True,
-        "chroma_path": "./chroma_scalable"
+        "chroma_path": "./chroma_scalable",
+        "max_concurrent_queries": 100,  # 同時進行中的查詢上限
+        "query_timeout": 30.0  # 每個查詢的期限（秒）
     }
     
     rag_system = ProductionRAGSystem(config)
     
-    # 並行查詢測試
-    import concurrent.futures
-    import threading
-    
-    def query_worker(query_id):
-        """查詢工作函數"""
-        query = f"測試查詢 {query_id}"
-        result = rag_system.query(query)
-        return result
+    # 並行查詢測試：以非同步路徑同時送出所有查詢，由信號量控制實際並行數
+    queries = [f"測試查詢 {query_id}" for query_id in range(10)]
     
     # 執行並行查詢
     print("執行並行查詢測試...")
     start_time = time.time()
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(query_worker, i) for i in range(10)]
-        results = [future.result() for future in concurrent.futures.as_completed(futures)]
+    results = asyncio.run(rag_system.aquery_many(queries))
     
     end_time = time.time()
     total_time = end_time - start_time
@@ -458,6 +2285,9 @@ if __name__ == "__main__":
         # 示範監控功能
         demonstrate_monitoring(rag_system)
         
+        # 示範藍綠重建
+        demonstrate_blue_green_rebuild(rag_system)
+        
         # 示範錯誤處理
         demonstrate_error_handling()
         
@@ -0,0 +1,458 @@
+# adaptive_embedding.py - 依 token 預算打包並以 AIMD 調整並行數的嵌入匯入
+#
+# 固定的 embed_batch_size 不看切塊長度：短切塊時批次太小、長切塊時又容易超過
+# 單次請求的 token 上限。AdaptiveBatchEmbedding 包裝嵌入模型（通常是 OpenAIEmbedding），
+# 依 token 預算把切塊打包成批次，同時送出多個批次，並依 429 與延遲以 AIMD
+# （加法增加、乘法減少）調整並行數，讓大量匯入能用滿配額而不被限流拖垮。
+#
+#   embed_model = AdaptiveBatchEmbedding(OpenAIEmbedding(max_retries=0))
+#   Settings.embed_model = embed_model
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from pydantic import PrivateAttr
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.utils import get_tokenizer
+
+logger = logging.getLogger(__name__)
+
+def is_rate_limited(error: Exception) -> bool:
+    """判斷是否為限流錯誤（HTTP 429）"""
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+def is_retryable(error: Exception) -> bool:
+    """只有限流、伺服器錯誤（5xx）與逾時值得重試；認證或請求格式錯誤（4xx）重試也不會成功"""
+    if is_rate_limited(error) or isinstance(error, TimeoutError) or "Timeout" in type(error).__name__:
+        return True
+    status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and 500 <= status_code < 600
+
+def pack_by_tokens(token_counts: List[int], max_batch_tokens: int, max_batch_size: int) -> List[List[int]]:
+    """依 token 預算與筆數上限把切塊索引依序打包；單一超長切塊自成一批"""
+    batches = []
+    current: List[int] = []
+    current_tokens = 0
+
+    for i, tokens in enumerate(token_counts):
+        if current and (current_tokens + tokens > max_batch_tokens or len(current) >= max_batch_size):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+class AIMDController:
+    """以加法增加、乘法減少調整並行上限"""
+
+    def __init__(
+        self,
+        initial: float = 2.0,
+        minimum: float = 1.0,
+        maximum: float = 16.0,
+        decrease_factor: float = 0.5,
+        latency_target: float = 10.0
+    ):
+        """
+        初始化控制器
+
+        Args:
+            initial: 起始並行數
+            minimum / maximum: 並行數上下限
+            decrease_factor: 遇到限流或延遲過高時的縮減倍率
+            latency_target: 單批延遲超過此值（秒）視為過載
+        """
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        # 平滑後的單批往返時間；一個往返內只縮減一次，避免同一波失敗連續砍半
+        self.round_trip = 0.0
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self) -> int:
+        """目前允許同時進行的批次數"""
+        return max(1, int(self.limit))
+
+    def on_success(self, latency: float):
+        """成功一批：延遲正常時每一輪往返約增加 1"""
+        if latency > self.latency_target:
+            self.on_overload()
+            return
+        with self._lock:
+            self.round_trip = latency if self.round_trip == 0.0 else 0.8 * self.round_trip + 0.2 * latency
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_overload(self, rate_limited: bool = False):
+        """限流或延遲過高：乘法縮減"""
+        with self._lock:
+            if rate_limited:
+                self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_decrease < self.round_trip:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+
+class IngestProgress:
+    """累計匯入進度並定期輸出吞吐量"""
+
+    def __init__(self, report_interval: float = 5.0, callback: Optional[Callable[[Dict[str, Any]], None]] = None):
+        """report_interval 秒輸出一次；callback 會收到與 snapshot() 相同的字典"""
+        self.report_interval = report_interval
+        self.callback = callback
+        self.chunks = 0
+        self.tokens = 0
+        self.batches = 0
+        self.retries = 0
+        self.concurrency = 0
+        self._started = None
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """第一次送出批次時開始計時"""
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+                self._last_report = self._started
+
+    def update(self, chunks: int, tokens: int, concurrency: int):
+        """記錄完成的一批"""
+        with self._lock:
+            now = time.monotonic()
+            self.chunks += chunks
+            self.tokens += tokens
+            self.batches += 1
+            self.concurrency = concurrency
+            due = now - self._last_report >= self.report_interval
+            if due:
+                self._last_report = now
+        if due:
+            self.report()
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """目前的累計數字與平均吞吐量"""
+        with self._lock:
+            elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+            return {
+                "chunks": self.chunks,
+                "tokens": self.tokens,
+                "batches": self.batches,
+                "retries": self.retries,
+                "concurrency": self.concurrency,
+                "elapsed_seconds": elapsed,
+                "chunks_per_second": self.chunks / elapsed if elapsed > 0 else 0.0,
+                "tokens_per_second": self.tokens / elapsed if elapsed > 0 else 0.0
+            }
+
+    def report(self):
+        """輸出一行進度"""
+        snapshot = self.snapshot()
+        logger.info(
+            f"嵌入進度: {snapshot['chunks']} 個切塊 / {snapshot['tokens']} tokens，"
+            f"{snapshot['chunks_per_second']:.1f} chunks/s，{snapshot['tokens_per_second']:.0f} tokens/s，"
+            f"並行數 {snapshot['concurrency']}，重試 {snapshot['retries']} 次"
+        )
+        if self.callback is not None:
+            self.callback(snapshot)
+
+class _EmbeddingBatch:
+    """一個待送出的批次（texts 中的索引）"""
+
+    def __init__(self, indices: List[int], tokens: int):
+        self.indices = indices
+        self.tokens = tokens
+        self.attempts = 0
+        self.not_before = 0.0
+
+class AdaptiveBatchEmbedding(BaseEmbedding):
+    """依 token 預算打包文字嵌入，並以 AIMD 控制同時進行的批次數"""
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _aimd: AIMDController = PrivateAttr()
+    _progress: IngestProgress = PrivateAttr()
+    _tokenizer: Callable = PrivateAttr()
+    _max_batch_tokens: int = PrivateAttr()
+    _max_batch_size: int = PrivateAttr()
+    _max_retries: int = PrivateAttr()
+    _backoff: float = PrivateAttr()
+    _executor: Optional[ThreadPoolExecutor] = PrivateAttr(default=None)
+    _executor_pid: Optional[int] = PrivateAttr(default=None)
+    _executor_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        max_batch_tokens: int = 50000,
+        max_batch_size: int = 2048,
+        initial_concurrency: int = 2,
+        max_concurrency: int = 16,
+        latency_target: float = 10.0,
+        max_retries: int = 6,
+        backoff: float = 1.0,
+        report_interval: float = 5.0,
+        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **kwargs: Any
+    ):
+        """
+        包裝嵌入模型
+
+        Args:
+            embed_model: 實際產生嵌入的模型；建議關閉其內建重試（OpenAIEmbedding(max_retries=0)），
+                限流才會回報到這裡並觸發降速
+            max_batch_tokens: 每批的 token 預算（OpenAI 單次請求上限為 300k）
+            max_batch_size: 每批最多筆數（OpenAI 上限為 2048）
+            initial_concurrency / max_concurrency: AIMD 的起始與最大並行數
+            latency_target: 單批延遲超過此值（秒）視為過載
+            max_retries: 每批最多重試次數（只重試限流、5xx 與逾時）
+            backoff: 重試的基礎等待秒數，指數成長並加上隨機抖動
+            report_interval: 進度輸出間隔（秒）
+            progress_callback: 每次輸出進度時呼叫
+        """
+        kwargs.setdefault("embed_batch_size", 2048)
+        kwargs.setdefault("callback_manager", embed_model.callback_manager)
+        super().__init__(model_name=embed_model.model_name, **kwargs)
+
+        self._embed_model = embed_model
+        self._aimd = AIMDController(
+            initial=initial_concurrency,
+            maximum=max_concurrency,
+            latency_target=latency_target
+        )
+        self._progress = IngestProgress(report_interval, progress_callback)
+        self._tokenizer = get_tokenizer()
+        self._max_batch_tokens = max_batch_tokens
+        self._max_batch_size = max_batch_size
+        self._max_retries = max_retries
+        self._backoff = backoff
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AdaptiveBatchEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        """被包裝的嵌入模型"""
+        return self._embed_model
+
+    def ingest_stats(self) -> Dict[str, Any]:
+        """累計的匯入進度、吞吐量與目前的並行上限"""
+        return {
+            **self._progress.snapshot(),
+            "concurrency_limit": self._aimd.limit,
+            "rate_limited": self._aimd.throttled
+        }
+
+    def _pool(self) -> ThreadPoolExecutor:
+        """同步嵌入共用的執行緒池；分叉後子行程沒有父行程的執行緒，需重新建立"""
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=int(self._aimd.maximum), thread_name_prefix="adaptive-embed")
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def close(self):
+        """停止同步嵌入用的執行緒池"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _plan(self, texts: List[str]) -> deque:
+        """計算 token 數並打包成批次"""
+        self._progress.start()
+        token_counts = [len(self._tokenizer(text)) for text in texts]
+        return deque(
+            _EmbeddingBatch(indices, sum(token_counts[i] for i in indices))
+            for indices in pack_by_tokens(token_counts, self._max_batch_tokens, self._max_batch_size)
+        )
+
+    def _handle_failure(self, batch: _EmbeddingBatch, error: Exception, pending: deque):
+        """降低並行數並把批次放回佇列前端；不可重試的錯誤或超過重試次數則放棄"""
+        if not is_retryable(error):
+            raise error
+        rate_limited = is_rate_limited(error)
+        self._aimd.on_overload(rate_limited=rate_limited)
+        batch.attempts += 1
+        if batch.attempts > self._max_retries:
+            raise error
+
+        delay = self._backoff * (2 ** (batch.attempts - 1)) * random.uniform(0.5, 1.5)
+        batch.not_before = time.monotonic() + delay
+        pending.appendleft(batch)
+        self._progress.record_retry()
+        # 限流是 AIMD 探測配額的正常結果，其他錯誤才需要警告
+        log = logger.debug if rate_limited else logger.warning
+        log(f"嵌入批次失敗（第 {batch.attempts} 次），{delay:.1f} 秒後重試: {error}")
+
+    def _handle_success(self, batch: _EmbeddingBatch, vectors: List[List[float]], latency: float, results: List):
+        self._aimd.on_success(latency)
+        for i, vector in zip(batch.indices, vectors):
+            results[i] = vector
+        self._progress.update(len(batch.indices), batch.tokens, self._aimd.concurrency)
+
+    def _timed_call(self, texts: List[str]):
+        started = time.perf_counter()
+        vectors = self._embed_model._get_text_embeddings(texts)
+        return vectors, time.perf_counter() - started
+
+    async def _atimed_call(self, texts: List[str]):
+        started = time.perf_counter()
+        vectors = await self._embed_model._aget_text_embeddings(texts)
+        return vectors, time.perf_counter() - started
+
+    def _wait_timeout(self, pending: deque, running: Dict, now: float) -> Optional[float]:
+        """有空的並行名額、下一批卻還在退避時，才等到它的重試時間；
+        名額都在使用中時只能等某批完成（None），否則 wait(timeout=0) 會立刻返回而空轉"""
+        if pending and len(running) < self._aimd.concurrency:
+            return max(0.0, pending[0].not_before - now)
+        return None
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        pending = self._plan(texts)
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        running = {}
+        pool = self._pool()
+
+        try:
+            while pending or running:
+                now = time.monotonic()
+                while pending and len(running) < self._aimd.concurrency and pending[0].not_before <= now:
+                    batch = pending.popleft()
+                    texts_in_batch = [texts[i] for i in batch.indices]
+                    running[pool.submit(self._timed_call, texts_in_batch)] = batch
+
+                timeout = self._wait_timeout(pending, running, now)
+                if not running:
+                    # 沒有進行中的批次時，等到下一批的重試時間
+                    time.sleep(timeout or 0.0)
+                    continue
+
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = running.pop(future)
+                    try:
+                        vectors, latency = future.result()
+                    except Exception as e:
+                        self._handle_failure(batch, e, pending)
+                    else:
+                        self._handle_success(batch, vectors, latency, results)
+        finally:
+            # 放棄時取消還沒開始的批次；執行緒池由所有呼叫共用，不關閉
+            for future in running:
+                future.cancel()
+        return results
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        pending = self._plan(texts)
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        running = {}
+
+        try:
+            while pending or running:
+                now = time.monotonic()
+                while pending and len(running) < self._aimd.concurrency and pending[0].not_before <= now:
+                    batch = pending.popleft()
+                    texts_in_batch = [texts[i] for i in batch.indices]
+                    running[asyncio.ensure_future(self._atimed_call(texts_in_batch))] = batch
+
+                timeout = self._wait_timeout(pending, running, now)
+                if not running:
+                    await asyncio.sleep(timeout or 0.0)
+                    continue
+
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    batch = running.pop(task)
+                    try:
+                        vectors, latency = task.result()
+                    except Exception as e:
+                        self._handle_failure(batch, e, pending)
+                    else:
+                        self._handle_success(batch, vectors, latency, results)
+        finally:
+            # 放棄時取消仍在進行的批次
+            for task in running:
+                task.cancel()
+        return results
+
+    def get_text_embedding_batch(self, texts: List[str], show_progress: bool = False, **kwargs: Any) -> List[List[float]]:
+        """整份清單一次交給 _get_text_embeddings，讓所有批次都能並行，不受 embed_batch_size 切段"""
+        if not texts:
+            return []
+        with self.callback_manager.event(
+            CBEventType.EMBEDDING,
+            payload={EventPayload.SERIALIZED: self.to_dict()}
+        ) as event:
+            embeddings = self._get_text_embeddings(texts)
+            event.on_end(payload={EventPayload.CHUNKS: texts, EventPayload.EMBEDDINGS: embeddings})
+        return embeddings
+
+    async def aget_text_embedding_batch(self, texts: List[str], show_progress: bool = False, **kwargs: Any) -> List[List[float]]:
+        """get_text_embedding_batch 的非同步版本"""
+        if not texts:
+            return []
+        with self.callback_manager.event(
+            CBEventType.EMBEDDING,
+            payload={EventPayload.SERIALIZED: self.to_dict()}
+        ) as event:
+            embeddings = await self._aget_text_embeddings(texts)
+            event.on_end(payload={EventPayload.CHUNKS: texts, EventPayload.EMBEDDINGS: embeddings})
+        return embeddings
+
+    def _retrying(self, fn: Callable[[], Any]) -> Any:
+        """單次呼叫（查詢嵌入）的重試：限流時同樣回報給 AIMD"""
+        for attempt in range(self._max_retries + 1):
+            try:
+                return fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self._aimd.on_overload(rate_limited=is_rate_limited(e))
+                if attempt == self._max_retries:
+                    raise
+                time.sleep(self._backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    async def _aretrying(self, coro_fn: Callable[[], Any]) -> Any:
+        """_retrying 的非同步版本"""
+        for attempt in range(self._max_retries + 1):
+            try:
+                return await coro_fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self._aimd.on_overload(rate_limited=is_rate_limited(e))
+                if attempt == self._max_retries:
+                    raise
+                await asyncio.sleep(self._backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._retrying(lambda: self._embed_model._get_query_embedding(query))
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._aretrying(lambda: self._embed_model._aget_query_embedding(query))
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
@@ -0,0 +1,310 @@
+# batch_retrieval.py - 多個查詢一起嵌入、一起計分的批次檢索
+#
+# 離線評估或大量問題的工作負載若逐一呼叫 retriever.retrieve()，每個查詢都要一次嵌入 API
+# 往返與一次完整的向量掃描。BatchVectorIndexRetriever.retrieve_many() 把所有查詢以一次
+# 批次嵌入呼叫送出，再交給向量儲存的 query_many()：NumpyVectorStore 將查詢向量堆成矩陣，
+# 與向量陣列做一次矩陣乘法後以 argpartition 逐列取 top-k，FaissANNVectorStore 交給 FAISS
+# 批次搜尋。不支援 query_many 的儲存（SimpleVectorStore、Chroma）逐一查詢，結果相同。
+#
+# 帶多個 custom_embedding_strs 的查詢束（查詢擴展、多語言改寫）也走同一條路：所有字串一次嵌入，
+# 再依 embedding_aggregation 合併——mean 把向量平均成一個查詢向量；max（max-sim，節點分數取
+# 與各字串相似度的最大值）與 rrf（各字串排序的倒數排名融合）則把每個字串的向量當成一列，
+# 整個查詢矩陣一起計分後依節點 ID 融合，之後才從 docstore 取回節點。
+#
+#   retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=5)
+#   for question, nodes in zip(questions, retriever.retrieve_many(questions)):
+#       print(question, [node.node_id for node in nodes])
+#
+#   retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=3, embedding_aggregation="max")
+#   nodes = retriever.retrieve(QueryBundle("雲端服務的類型", custom_embedding_strs=["cloud computing", "IaaS", "SaaS"]))
+#
+# 批次路徑使用 VectorIndexRetriever 的內部方法（以 llama-index-core 0.10 ~ 0.14 驗證）；
+# 安裝的版本缺少其中任何一個時，retrieve_many() 退回逐一 retrieve()，結果相同、只是沒有批次化。
+import asyncio
+import dataclasses
+import heapq
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.indices.utils import log_vector_store_query_result
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+from numpy_vector_store import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+QueryLike = Union[str, QueryBundle]
+EMBEDDING_AGGREGATIONS = ("mean", "max", "rrf")
+
+# 批次路徑用到的 VectorIndexRetriever 內部方法
+_RETRIEVER_INTERNALS = (
+    "_needs_embedding",
+    "_build_vector_store_query",
+    "_determine_nodes_to_fetch",
+    "_insert_fetched_nodes_into_query_result",
+    "_convert_nodes_to_scored_nodes",
+    "_handle_recursive_retrieval",
+    "_vector_store",
+    "_docstore",
+    "_embed_model",
+    "_kwargs"
+)
+
+def _query_embed_model(embed_model: BaseEmbedding) -> BaseEmbedding:
+    """查詢直接呼叫最內層的模型：不寫入持久化嵌入快取，也不經過匯入用的自適應批次，
+    查詢流量不會計入匯入進度，也不與匯入共用 AIMD 並行數（查詢端的 429 不會讓匯入降速，反之亦然）"""
+    while isinstance(getattr(embed_model, "embed_model", None), BaseEmbedding):
+        embed_model = embed_model.embed_model
+    return embed_model
+
+def embed_query_batch(embed_model: BaseEmbedding, texts: List[str]) -> List[List[float]]:
+    """以一次文字嵌入呼叫處理整批查詢（OpenAI 的查詢與文字嵌入為同一端點）
+
+    直接呼叫 _get_text_embeddings，避免被 embed_batch_size 再切成多次請求。
+    查詢與文件使用不同指令或端點的模型（例如 instructor 類模型）應改傳 query_embed_fn。
+    """
+    if not texts:
+        return []
+    return _query_embed_model(embed_model)._get_text_embeddings(texts)
+
+async def aembed_query_batch(embed_model: BaseEmbedding, texts: List[str]) -> List[List[float]]:
+    """embed_query_batch 的非同步版本"""
+    if not texts:
+        return []
+    return await _query_embed_model(embed_model)._aget_text_embeddings(texts)
+
+class BatchVectorIndexRetriever(VectorIndexRetriever):
+    """提供 retrieve_many() 的向量索引檢索器；多字串查詢束的字串一次嵌入、一起計分"""
+
+    def __init__(
+        self,
+        *args: Any,
+        query_embed_fn: Optional[Callable[[List[str]], List[List[float]]]] = None,
+        embedding_aggregation: str = "mean",
+        rrf_k: float = 60.0,
+        **kwargs: Any
+    ):
+        """
+        參數同 VectorIndexRetriever
+
+        Args:
+            query_embed_fn: 批次查詢嵌入函式 texts -> vectors，預設以 embed_query_batch 呼叫索引的嵌入模型
+            embedding_aggregation: 多個 custom_embedding_strs 的合併方式：
+                mean（平均向量）/ max（max-sim，分數為最高的餘弦相似度）/ rrf（倒數排名融合，分數為 RRF 分數）
+            rrf_k: RRF 的平滑常數
+        """
+        if embedding_aggregation not in EMBEDDING_AGGREGATIONS:
+            raise ValueError(f"不支援的嵌入合併方式: {embedding_aggregation}")
+        super().__init__(*args, **kwargs)
+        self._query_embed_fn = query_embed_fn
+        self._embedding_aggregation = embedding_aggregation
+        self._rrf_k = rrf_k
+        missing = [name for name in _RETRIEVER_INTERNALS if not hasattr(self, name)]
+        self._batch_supported = not missing
+        if missing:
+            logger.warning(f"此版本的 VectorIndexRetriever 缺少 {', '.join(missing)}，批次檢索改為逐一檢索")
+
+    @classmethod
+    def from_index(cls, index, **kwargs: Any) -> "BatchVectorIndexRetriever":
+        """以與 index.as_retriever() 相同的參數建立"""
+        return cls(
+            index,
+            node_ids=list(index.index_struct.nodes_dict.values()),
+            callback_manager=getattr(index, "_callback_manager", None),
+            object_map=getattr(index, "_object_map", None),
+            **kwargs
+        )
+
+    def _is_multi_string(self, query_bundle: QueryBundle) -> bool:
+        return (
+            self._batch_supported
+            and query_bundle.embedding is None
+            and len(query_bundle.embedding_strs) > 1
+            and self._needs_embedding()
+        )
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # 單一字串的查詢維持原本的查詢嵌入路徑
+        if self._is_multi_string(query_bundle):
+            return self._retrieve_bundles(self._as_bundles([query_bundle]), None)[0]
+        return super()._retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._is_multi_string(query_bundle):
+            return (await self._aretrieve_bundles(self._as_bundles([query_bundle]), None))[0]
+        return await super()._aretrieve(query_bundle)
+
+    def _pending_texts(self, bundles: List[QueryBundle]) -> Tuple[List[str], Dict[int, Tuple[int, int]]]:
+        """把需要嵌入的查詢束的所有字串攤平成一批，回傳 (文字, {查詢束位置: 在批次中的 [start, end)})"""
+        texts: List[str] = []
+        spans: Dict[int, Tuple[int, int]] = {}
+        if not self._needs_embedding():
+            return texts, spans
+        for i, bundle in enumerate(bundles):
+            if bundle.embedding is None:
+                strings = bundle.embedding_strs
+                spans[i] = (len(texts), len(texts) + len(strings))
+                texts.extend(strings)
+        return texts, spans
+
+    def _assign_embeddings(
+        self,
+        bundles: List[QueryBundle],
+        spans: Dict[int, Tuple[int, int]],
+        embeddings: List[List[float]]
+    ) -> Dict[int, np.ndarray]:
+        """單一字串與 mean 合併的查詢束直接得到查詢向量；max / rrf 回傳 {位置: 查詢矩陣}"""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        matrices: Dict[int, np.ndarray] = {}
+        for i, (start, end) in spans.items():
+            if end - start == 1:
+                bundles[i].embedding = embeddings[start]
+            elif self._embedding_aggregation == "mean":
+                # 先正規化再平均，每個字串的權重相同
+                bundles[i].embedding = normalize_rows(vectors[start:end]).mean(axis=0).tolist()
+            else:
+                matrices[i] = vectors[start:end]
+        return matrices
+
+    def _vector_store_queries(
+        self,
+        bundles: List[QueryBundle],
+        matrices: Dict[int, np.ndarray],
+        top_k: Optional[int]
+    ) -> Tuple[List[VectorStoreQuery], List[Tuple[int, int]]]:
+        """每個查詢束對應一段連續的向量儲存查詢：一般查詢一個，max / rrf 每個字串一個"""
+        queries: List[VectorStoreQuery] = []
+        spans: List[Tuple[int, int]] = []
+        for i, bundle in enumerate(bundles):
+            start = len(queries)
+            if i in matrices:
+                for vector in matrices[i]:
+                    queries.append(self._build_vector_store_query(
+                        QueryBundle(query_str=bundle.query_str, embedding=vector.tolist())
+                    ))
+            else:
+                queries.append(self._build_vector_store_query(bundle))
+            if top_k is not None:
+                for query in queries[start:]:
+                    query.similarity_top_k = top_k
+            spans.append((start, len(queries)))
+        return queries, spans
+
+    def _query_many(self, queries: List[VectorStoreQuery]) -> List[VectorStoreQueryResult]:
+        if hasattr(self._vector_store, "query_many"):
+            return self._vector_store.query_many(queries, **self._kwargs)
+        return [self._vector_store.query(query, **self._kwargs) for query in queries]
+
+    def _fuse(self, results: List[VectorStoreQueryResult], top_k: int) -> VectorStoreQueryResult:
+        """依節點 ID 融合同一個查詢束各字串的結果
+
+        max-sim 只需各字串的 top-k：若某節點屬於融合後的 top-k，它在取得最高分的那個字串的排序中
+        也必然在 top-k 內，因此結果與對全部向量計算 max-sim 相同。
+        """
+        scores: Dict[str, float] = {}
+        nodes: Dict[str, Any] = {}
+        for result in results:
+            hits = zip(result.ids, result.similarities, result.nodes or [None] * len(result.ids))
+            for rank, (node_id, similarity, node) in enumerate(hits, 1):
+                if self._embedding_aggregation == "max":
+                    scores[node_id] = max(scores.get(node_id, -np.inf), similarity)
+                else:
+                    scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (self._rrf_k + rank)
+                nodes.setdefault(node_id, node)
+
+        top = heapq.nlargest(top_k, scores, key=scores.get)
+        return VectorStoreQueryResult(
+            nodes=[nodes[node_id] for node_id in top] if any(result.nodes for result in results) else None,
+            similarities=[float(scores[node_id]) for node_id in top],
+            ids=top
+        )
+
+    def _merge_results(
+        self,
+        queries: List[VectorStoreQuery],
+        spans: List[Tuple[int, int]],
+        results: List[VectorStoreQueryResult]
+    ) -> List[VectorStoreQueryResult]:
+        return [
+            results[start] if end - start == 1 else self._fuse(results[start:end], queries[start].similarity_top_k)
+            for start, end in spans
+        ]
+
+    def _to_scored_nodes(self, results: List[VectorStoreQueryResult]) -> List[List[NodeWithScore]]:
+        """所有查詢需要從 docstore 取回的節點合併成一次讀取（延遲載入的 docstore 只查一次 SQLite）"""
+        to_fetch = {
+            node_id: None
+            for result in results
+            for node_id in self._determine_nodes_to_fetch(result)
+        }
+        fetched = self._docstore.get_nodes(node_ids=list(to_fetch), raise_error=False) if to_fetch else []
+
+        scored = []
+        for result in results:
+            if self._determine_nodes_to_fetch(result):
+                result.nodes = self._insert_fetched_nodes_into_query_result(result, fetched)
+            log_vector_store_query_result(result)
+            scored.append(self._convert_nodes_to_scored_nodes(result))
+        return scored
+
+    @staticmethod
+    def _as_bundles(queries: Sequence[QueryLike]) -> List[QueryBundle]:
+        """嵌入寫在複本上，呼叫端的查詢束可以換一種合併方式重複使用"""
+        return [QueryBundle(query) if isinstance(query, str) else dataclasses.replace(query) for query in queries]
+
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        if self._query_embed_fn is not None:
+            return self._query_embed_fn(texts)
+        return embed_query_batch(self._embed_model, texts)
+
+    async def _aembed_texts(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        if self._query_embed_fn is not None:
+            return await asyncio.to_thread(self._query_embed_fn, texts)
+        return await aembed_query_batch(self._embed_model, texts)
+
+    def _retrieve_bundles(self, bundles: List[QueryBundle], top_k: Optional[int]) -> List[List[NodeWithScore]]:
+        """一次嵌入、一次 query_many、一次 docstore 讀取"""
+        texts, embed_spans = self._pending_texts(bundles)
+        matrices = self._assign_embeddings(bundles, embed_spans, self._embed_texts(texts))
+        queries, spans = self._vector_store_queries(bundles, matrices, top_k)
+        results = self._merge_results(queries, spans, self._query_many(queries))
+        return self._to_scored_nodes(results)
+
+    async def _aretrieve_bundles(self, bundles: List[QueryBundle], top_k: Optional[int]) -> List[List[NodeWithScore]]:
+        """_retrieve_bundles 的非同步版本：嵌入以非同步呼叫，計分放到執行緒中"""
+        texts, embed_spans = self._pending_texts(bundles)
+        matrices = self._assign_embeddings(bundles, embed_spans, await self._aembed_texts(texts))
+        queries, spans = self._vector_store_queries(bundles, matrices, top_k)
+        results = await asyncio.to_thread(self._query_many, queries)
+        results = self._merge_results(queries, spans, results)
+        return await asyncio.to_thread(self._to_scored_nodes, results)
+
+    def retrieve_many(self, queries: Sequence[QueryLike], top_k: Optional[int] = None) -> List[List[NodeWithScore]]:
+        """
+        一次檢索多個查詢，回傳與輸入順序相同的結果
+
+        Args:
+            queries: 查詢字串或 QueryBundle（已帶 embedding 的不再嵌入）
+            top_k: 每個查詢的結果數，預設為 similarity_top_k（逐一檢索的退回路徑只能取得更少的結果）
+        """
+        if not self._batch_supported:
+            return [self.retrieve(query)[:top_k] for query in queries]
+        bundles = self._as_bundles(queries)
+        results = self._retrieve_bundles(bundles, top_k)
+        return [self._handle_recursive_retrieval(bundle, nodes) for bundle, nodes in zip(bundles, results)]
+
+    async def aretrieve_many(self, queries: Sequence[QueryLike], top_k: Optional[int] = None) -> List[List[NodeWithScore]]:
+        """retrieve_many 的非同步版本"""
+        if not self._batch_supported:
+            results = await asyncio.gather(*(self.aretrieve(query) for query in queries))
+            return [nodes[:top_k] for nodes in results]
+        bundles = self._as_bundles(queries)
+        results = await self._aretrieve_bundles(bundles, top_k)
+        return [self._handle_recursive_retrieval(bundle, nodes) for bundle, nodes in zip(bundles, results)]
@@ -0,0 +1,178 @@
+# benchmark_ann.py - 近似最近鄰檢索的召回率與延遲基準測試
+#
+# 在分群的合成向量上比較暴力搜尋（NumpyVectorStore float32）與 FaissANNVectorStore
+# 的 flat / IVF / HNSW 索引：對每個 nprobe / efSearch 設定量測 recall@k
+# （以精確搜尋結果為標準答案）與單一查詢的延遲百分位數，輸出 JSON。
+#
+#   python benchmark_ann.py --chunks 100000 1000000 --embed-dim 256
+#   python benchmark_ann.py --chunks 200000 --index-types hnsw --ef-search 16 32 64 128 --output ann.json
+import argparse
+import json
+import os
+import platform
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from faiss_vector_store import INDEX_TYPES, FaissANNVectorStore
+from numpy_vector_store import NumpyVectorStore, normalize_rows
+
+def generate_vectors(num_chunks: int, dim: int, num_clusters: int, seed: int) -> np.ndarray:
+    """產生分群的向量：真實語料的嵌入會聚集在主題附近，純隨機向量無法反映 ANN 的表現"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim), dtype=np.float32)
+    assignments = rng.integers(0, num_clusters, num_chunks)
+    vectors = centers[assignments] + 0.6 * rng.standard_normal((num_chunks, dim), dtype=np.float32)
+    return normalize_rows(vectors)
+
+def generate_queries(vectors: np.ndarray, num_queries: int, seed: int) -> np.ndarray:
+    """在隨機挑選的向量附近產生查詢"""
+    rng = np.random.default_rng(seed + 1)
+    picked = vectors[rng.integers(0, len(vectors), num_queries)]
+    return normalize_rows(picked + 0.3 * rng.standard_normal(picked.shape, dtype=np.float32))
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, top_k: int, block_size: int = 65536) -> np.ndarray:
+    """分塊計算精確的 top-k 列號（標準答案）"""
+    best_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+    best_rows = np.zeros((len(queries), top_k), dtype=np.int64)
+
+    for start in range(0, len(vectors), block_size):
+        scores = queries @ vectors[start:start + block_size].T
+        k = min(top_k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        # 區塊內的候選與目前最佳結果合併，再取一次 top-k
+        scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+        rows = np.concatenate([best_rows, top + start], axis=1)
+        top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_rows = np.take_along_axis(rows, top, axis=1)
+    return best_rows
+
+def build_store(store, vectors: np.ndarray, batch_size: int = 4096) -> float:
+    """分批加入向量，回傳建立耗時（秒）"""
+    started = time.perf_counter()
+    for start in range(0, len(vectors), batch_size):
+        store.add([
+            TextNode(id_=str(row), text="", embedding=vectors[row].tolist())
+            for row in range(start, min(start + batch_size, len(vectors)))
+        ])
+    return time.perf_counter() - started
+
+def measure(store, queries: np.ndarray, truth: np.ndarray, top_k: int) -> Dict[str, Any]:
+    """逐一查詢，量測 recall@k 與延遲"""
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        result = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k))
+        latencies.append(time.perf_counter() - started)
+        hits += len(set(map(int, result.ids)) & set(expected.tolist()))
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "recall": hits / (len(queries) * top_k),
+        "latency_ms": {
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p90": float(np.percentile(latencies_ms, 90)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "mean": float(latencies_ms.mean())
+        }
+    }
+
+def sweep(index_type: str, args) -> List[Optional[Dict[str, int]]]:
+    """各索引類型要掃描的查詢參數"""
+    if index_type == "ivf":
+        return [{"nprobe": nprobe} for nprobe in args.nprobe]
+    if index_type == "hnsw":
+        return [{"ef_search": ef_search} for ef_search in args.ef_search]
+    return [None]
+
+def run_benchmark(args, num_chunks: int) -> List[Dict[str, Any]]:
+    """建立一個語料規模的各索引並掃描查詢參數"""
+    vectors = generate_vectors(num_chunks, args.embed_dim, args.clusters, args.seed)
+    queries = generate_queries(vectors, args.queries, args.seed)
+    truth = exact_top_k(vectors, queries, args.top_k)
+    reports = []
+
+    stores = [("exact", None, lambda: NumpyVectorStore(dtype="float32"))]
+    stores += [
+        (index_type, index_type, lambda index_type=index_type: FaissANNVectorStore(
+            index_type=index_type, nlist=args.nlist, train_size=min(args.train_size, num_chunks)
+        ))
+        for index_type in args.index_types
+    ]
+
+    for name, index_type, factory in stores:
+        store = factory()
+        build_seconds = build_store(store, vectors)
+        for params in (sweep(index_type, args) if index_type else [None]):
+            for key, value in (params or {}).items():
+                setattr(store, key, value)
+            report = {
+                "index": name,
+                "chunks": num_chunks,
+                "params": params or {},
+                "build_seconds": build_seconds,
+                **measure(store, queries, truth, args.top_k)
+            }
+            print_report(report)
+            reports.append(report)
+        del store
+    return reports
+
+def print_report(report: Dict[str, Any]):
+    """在終端機輸出一行摘要"""
+    params = " ".join(f"{key}={value}" for key, value in report["params"].items())
+    latency = report["latency_ms"]
+    print(
+        f"index={report['index']:<6} chunks={report['chunks']:>8} {params:<14} "
+        f"recall@k={report['recall']:.3f} p50={latency['p50']:.2f}ms p99={latency['p99']:.2f}ms "
+        f"build={report['build_seconds']:.1f}s"
+    )
+
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="近似最近鄰檢索的召回率與延遲基準測試")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[100000], help="向量數，可指定多個")
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=1000, help="合成向量的主題群數")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--index-types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument("--nlist", type=int, default=None, help="IVF 群數，預設 4·√N")
+    parser.add_argument("--train-size", type=int, default=100000, help="IVF 的訓練向量數上限")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON 結果輸出路徑")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    reports = []
+    for num_chunks in args.chunks:
+        reports.extend(run_benchmark(args, num_chunks))
+
+    output = {
+        "benchmark": "ann_recall_latency",
+        "timestamp": time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": reports
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# benchmark_batch_retrieval.py - 逐一檢索與批次檢索（retrieve_many）的吞吐量比較
+#
+# 離線評估或大量問題時，逐一呼叫 retriever.retrieve() 每個查詢都要一次嵌入往返與一次向量掃描；
+# BatchVectorIndexRetriever.retrieve_many() 把所有查詢一次嵌入，再以矩陣乘法（NumpyVectorStore）
+# 或 FAISS 批次搜尋一起計分。切塊向量使用分群的合成向量，查詢以 FakeEmbedding 嵌入，
+# 嵌入的 API 往返以 LatencyModel 模擬（逐一檢索每個查詢等待一次，批次檢索整批等待一次）。
+# 量測兩種方式處理整批查詢的總時間與每秒查詢數，並檢查兩者的結果是否相同。
+# 另外比較帶 --expansions 個 custom_embedding_strs 的查詢束（查詢擴展）與單一字串查詢的延遲：
+# 框架預設的逐一嵌入再平均，對上一次批次嵌入後以 mean / max / rrf 合併。輸出 JSON。
+#
+#   python benchmark_batch_retrieval.py --chunks 100000 --queries 500
+#   python benchmark_batch_retrieval.py --chunks 100000 --expansions 8 --expansion-queries 100
+#   python benchmark_batch_retrieval.py --chunks 200000 --stores numpy int8 --query-embed-latency constant:0 --output batch.json
+import argparse
+import json
+import os
+import platform
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.schema import QueryBundle, TextNode
+from benchmark_ann import generate_vectors
+from batch_retrieval import EMBEDDING_AGGREGATIONS, BatchVectorIndexRetriever
+from fake_backends import FakeEmbedding, LatencyModel
+from faiss_vector_store import FaissANNVectorStore
+from numpy_vector_store import NumpyVectorStore
+
+STORES = ("numpy", "int8", "flat", "hnsw")
+
+def new_store(name: str):
+    if name in ("numpy", "int8"):
+        return NumpyVectorStore(dtype="float32" if name == "numpy" else "int8")
+    return FaissANNVectorStore(index_type=name)
+
+def generate_questions(num_queries: int, seed: int) -> List[str]:
+    """由固定詞彙組成的不重複問題"""
+    rng = np.random.default_rng(seed)
+    vocabulary = [f"term{i}" for i in range(2000)]
+    return [f"q{i} " + " ".join(rng.choice(vocabulary, 8)) for i in range(num_queries)]
+
+def measure(retriever: BatchVectorIndexRetriever, questions: List[str], batch_size: int) -> Dict[str, Any]:
+    """分別以逐一檢索與批次檢索處理全部問題"""
+    started = time.perf_counter()
+    sequential = [retriever.retrieve(question) for question in questions]
+    sequential_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batched = []
+    for start in range(0, len(questions), batch_size):
+        batched.extend(retriever.retrieve_many(questions[start:start + batch_size]))
+    batched_seconds = time.perf_counter() - started
+
+    identical = sum(
+        [node.node_id for node in a] == [node.node_id for node in b]
+        for a, b in zip(sequential, batched)
+    )
+    return {
+        "sequential_seconds": sequential_seconds,
+        "batched_seconds": batched_seconds,
+        "sequential_qps": len(questions) / sequential_seconds,
+        "batched_qps": len(questions) / batched_seconds,
+        "speedup": sequential_seconds / batched_seconds,
+        "identical_results": identical / len(questions)
+    }
+
+def measure_expansion(index, questions: List[str], args) -> Dict[str, Any]:
+    """單一字串查詢與擴展查詢束（逐一嵌入 / 批次嵌入後各種合併方式）的單次查詢延遲"""
+    def bundles() -> List[QueryBundle]:
+        # 框架的檢索器會把平均後的嵌入寫回查詢束，每個檢索器都要用新的查詢束，否則之後不會再嵌入
+        return [
+            QueryBundle(query_str=question, custom_embedding_strs=[f"{question} v{j}" for j in range(args.expansions)])
+            for question in questions
+        ]
+
+    retrievers = {
+        "single_string": (VectorIndexRetriever(index, similarity_top_k=args.top_k), questions),
+        "per_string_mean": (VectorIndexRetriever(index, similarity_top_k=args.top_k), bundles())
+    }
+    for aggregation in EMBEDDING_AGGREGATIONS:
+        retriever = BatchVectorIndexRetriever(index, similarity_top_k=args.top_k, embedding_aggregation=aggregation)
+        retrievers[f"batched_{aggregation}"] = (retriever, bundles())
+
+    latency_ms = {}
+    for name, (retriever, queries) in retrievers.items():
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            retriever.retrieve(query)
+            latencies.append(time.perf_counter() - started)
+        latencies_ms = np.asarray(latencies) * 1000
+        latency_ms[name] = {
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "mean": float(latencies_ms.mean())
+        }
+    return {"expansions": args.expansions, "latency_ms": latency_ms}
+
+def run_benchmark(args) -> List[Dict[str, Any]]:
+    vectors = generate_vectors(args.chunks, args.embed_dim, args.clusters, args.seed)
+    questions = generate_questions(args.queries, args.seed)
+    embed_model = FakeEmbedding(
+        embed_dim=args.embed_dim,
+        query_latency=LatencyModel.parse(args.query_embed_latency, seed=args.seed),
+        # 批次查詢嵌入走文字嵌入端點，每批等待一次相同的往返延遲
+        text_latency=LatencyModel.parse(args.query_embed_latency, seed=args.seed + 1)
+    )
+    reports = []
+
+    for name in args.stores:
+        nodes = [
+            TextNode(id_=str(row), text=f"chunk {row}", embedding=vectors[row].tolist())
+            for row in range(len(vectors))
+        ]
+        storage_context = StorageContext.from_defaults(vector_store=new_store(name))
+        started = time.perf_counter()
+        index = VectorStoreIndex(nodes, storage_context=storage_context, embed_model=embed_model, insert_batch_size=4096)
+        build_seconds = time.perf_counter() - started
+        del nodes
+
+        retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=args.top_k)
+        retriever.retrieve_many(questions[:2])
+        report = {
+            "store": name,
+            "chunks": args.chunks,
+            "queries": len(questions),
+            "build_seconds": build_seconds,
+            **measure(retriever, questions, args.batch_size)
+        }
+        if args.expansions > 1:
+            report["expansion"] = measure_expansion(index, questions[:args.expansion_queries], args)
+        print_report(report)
+        reports.append(report)
+        del index, retriever, storage_context
+    return reports
+
+def print_report(report: Dict[str, Any]):
+    """在終端機輸出一行摘要"""
+    print(
+        f"store={report['store']:<6} chunks={report['chunks']:>8} queries={report['queries']:>5} "
+        f"sequential={report['sequential_qps']:.1f}q/s batched={report['batched_qps']:.1f}q/s "
+        f"speedup={report['speedup']:.1f}x identical={report['identical_results']:.3f}"
+    )
+    if "expansion" in report:
+        latency = report["expansion"]["latency_ms"]
+        print("  expansions={} ".format(report["expansion"]["expansions"]) + " ".join(
+            f"{name}={stats['p50']:.1f}ms" for name, stats in latency.items()
+        ))
+
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="逐一檢索與批次檢索的吞吐量比較")
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=1000, help="合成向量的主題群數")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=256, help="每次 retrieve_many 的查詢數")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--stores", nargs="+", choices=STORES, default=["numpy", "int8", "hnsw"])
+    parser.add_argument("--expansions", type=int, default=5, help="擴展查詢束的字串數，1 表示不測")
+    parser.add_argument("--expansion-queries", type=int, default=50, help="擴展查詢的延遲量測使用的查詢數")
+    parser.add_argument(
+        "--query-embed-latency", default="constant:0.02",
+        help="每次嵌入呼叫的延遲，格式為 分佈:平均秒數[:離散度]，例如 lognormal:0.03:0.3"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON 結果輸出路徑")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    reports = run_benchmark(args)
+
+    output = {
+        "benchmark": "batch_retrieval",
+        "timestamp": time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": reports
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
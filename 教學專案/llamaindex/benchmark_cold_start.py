@@ -0,0 +1,253 @@
+# benchmark_cold_start.py - 索引冷啟動基準測試
+#
+# 以隨機向量與合成文字建立索引，分別存成 LlamaIndex 預設的 JSON 格式
+# （SimpleVectorStore + docstore）、NumpyVectorStore 的記憶體映射格式（文字存在向量儲存中），
+# 以及 NumPy 向量 + LazyDocumentStore（文字存在 SQLite，查詢時才讀取），
+# 再於全新的子行程中量測開啟索引、第一次查詢的時間與記憶體用量（JSON）。
+# 量測前會以 posix_fadvise 將索引檔移出頁面快取，模擬重開機後的冷啟動。
+#
+#   python benchmark_cold_start.py --chunks 10000 100000 --embed-dim 1536
+#   python benchmark_cold_start.py --chunks 100000 --formats numpy --vector-dtype int8 --output cold.json
+#   python benchmark_cold_start.py --chunks 100000 --formats json lazy --words-per-chunk 400
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+FORMATS = ("json", "numpy", "lazy")
+
+def directory_size_mb(path: str) -> float:
+    """目錄內所有檔案的大小（MB）"""
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total / (1024 * 1024)
+
+def evict_page_cache(path: str) -> bool:
+    """建議核心丟棄目錄內檔案的快取頁面（不需 root，僅 Linux 有效）"""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for root, _, files in os.walk(path):
+        for name in files:
+            fd = os.open(os.path.join(root, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+def rss_mb() -> float:
+    """目前的常駐記憶體（MB）"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+def build_nodes(num_chunks: int, dim: int, seed: int, words_per_chunk: int = 60):
+    """產生帶隨機向量的文字節點"""
+    from llama_index.core.schema import TextNode
+
+    rng = random.Random(seed)
+    vectors = np.random.default_rng(seed).standard_normal((num_chunks, dim), dtype=np.float32)
+    vocabulary = ["人工智慧", "雲端運算", "向量", "索引", "查詢", "部署", "監控", "資料", "模型", "服務"]
+    return [
+        TextNode(
+            id_=f"node-{i}",
+            text=" ".join(rng.choice(vocabulary) for _ in range(words_per_chunk)),
+            embedding=vectors[i].tolist(),
+            metadata={"chunk": i, "topic": vocabulary[i % len(vocabulary)]}
+        )
+        for i in range(num_chunks)
+    ]
+
+def build_index(storage_format: str, nodes, persist_dir: str, dtype: str) -> float:
+    """建立並持久化索引，回傳耗時（秒）"""
+    from llama_index.core import StorageContext, VectorStoreIndex
+    from llama_index.core.embeddings import MockEmbedding
+    from lazy_docstore import LazyDocumentStore
+    from numpy_vector_store import NumpyVectorStore
+
+    started = time.perf_counter()
+    if storage_format == "numpy":
+        storage_context = StorageContext.from_defaults(
+            vector_store=NumpyVectorStore(dtype=dtype, stores_text=True)
+        )
+    elif storage_format == "lazy":
+        storage_context = StorageContext.from_defaults(
+            vector_store=NumpyVectorStore(dtype=dtype),
+            docstore=LazyDocumentStore(os.path.join(persist_dir, "docstore.db"))
+        )
+    else:
+        storage_context = StorageContext.from_defaults()
+    # 節點已帶向量，嵌入模型只是為了不去建立 OpenAI 用戶端
+    index = VectorStoreIndex(
+        nodes,
+        storage_context=storage_context,
+        embed_model=MockEmbedding(embed_dim=len(nodes[0].embedding))
+    )
+    index.storage_context.persist(persist_dir=persist_dir)
+    return time.perf_counter() - started
+
+def measure_load(storage_format: str, persist_dir: str, dim: int, top_k: int, queries: int) -> Dict[str, Any]:
+    """子行程：開啟索引並執行查詢，回傳各階段耗時與記憶體"""
+    from llama_index.core import QueryBundle, Settings, StorageContext, VectorStoreIndex, load_index_from_storage
+    from llama_index.core.embeddings import MockEmbedding
+    from lazy_docstore import LazyDocumentStore
+    from numpy_vector_store import NumpyVectorStore
+
+    Settings.embed_model = MockEmbedding(embed_dim=dim)
+    # 先建立一個空索引，讓框架的延遲匯入不計入開啟時間（與索引大小無關的固定成本）
+    VectorStoreIndex(nodes=[])
+    baseline_rss = rss_mb()
+
+    started = time.perf_counter()
+    if storage_format == "numpy":
+        index = VectorStoreIndex.from_vector_store(NumpyVectorStore.from_persist_dir(persist_dir))
+    elif storage_format == "lazy":
+        index = load_index_from_storage(StorageContext.from_defaults(
+            persist_dir=persist_dir,
+            vector_store=NumpyVectorStore.from_persist_dir(persist_dir),
+            docstore=LazyDocumentStore(os.path.join(persist_dir, "docstore.db"))
+        ))
+    else:
+        index = load_index_from_storage(StorageContext.from_defaults(persist_dir=persist_dir))
+    open_seconds = time.perf_counter() - started
+    open_rss = rss_mb()
+
+    retriever = index.as_retriever(similarity_top_k=top_k)
+    rng = np.random.default_rng(0)
+    latencies = []
+    for _ in range(queries):
+        embedding = rng.standard_normal(dim, dtype=np.float32).tolist()
+        started = time.perf_counter()
+        retriever.retrieve(QueryBundle(query_str="冷啟動查詢", embedding=embedding))
+        latencies.append(time.perf_counter() - started)
+
+    return {
+        "open_ms": open_seconds * 1000,
+        "first_query_ms": latencies[0] * 1000,
+        "time_to_first_result_ms": (open_seconds + latencies[0]) * 1000,
+        "warm_query_p50_ms": float(np.median(latencies[1:])) * 1000 if len(latencies) > 1 else None,
+        "rss_mb": {
+            "baseline": baseline_rss,
+            "after_open": open_rss,
+            "after_queries": rss_mb(),
+            "open_delta": open_rss - baseline_rss
+        }
+    }
+
+def run_child(args, storage_format: str, persist_dir: str) -> Dict[str, Any]:
+    """在全新的直譯器中量測，避免父行程已載入的模組與資料影響結果"""
+    command = [
+        sys.executable, os.path.abspath(__file__), "--child", storage_format,
+        "--persist-dir", persist_dir, "--embed-dim", str(args.embed_dim),
+        "--top-k", str(args.top_k), "--queries", str(args.queries)
+    ]
+    completed = subprocess.run(
+        command, capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def run_benchmark(args, num_chunks: int) -> List[Dict[str, Any]]:
+    """建立一個語料規模的各格式索引並量測冷啟動"""
+    nodes = build_nodes(num_chunks, args.embed_dim, args.seed, args.words_per_chunk)
+    reports = []
+
+    for storage_format in args.formats:
+        persist_dir = os.path.join(args.work_dir, f"{storage_format}_{num_chunks}")
+        shutil.rmtree(persist_dir, ignore_errors=True)
+        build_seconds = build_index(storage_format, nodes, persist_dir, args.vector_dtype)
+
+        runs = []
+        for _ in range(args.repeat):
+            evicted = not args.warm_cache and evict_page_cache(persist_dir)
+            runs.append(run_child(args, storage_format, persist_dir))
+
+        best = min(runs, key=lambda run: run["time_to_first_result_ms"])
+        reports.append({
+            "format": storage_format,
+            "chunks": num_chunks,
+            "vector_dtype": args.vector_dtype if storage_format != "json" else "float32",
+            "build_seconds": build_seconds,
+            "disk_mb": directory_size_mb(persist_dir),
+            "page_cache_evicted": evicted,
+            "best": best,
+            "runs": runs
+        })
+    return reports
+
+def print_report(report: Dict[str, Any]):
+    """在終端機輸出一行摘要"""
+    best = report["best"]
+    print(
+        f"format={report['format']:<6} chunks={report['chunks']:>8} disk={report['disk_mb']:.0f}MB "
+        f"open={best['open_ms']:.1f}ms first_query={best['first_query_ms']:.1f}ms "
+        f"warm_p50={best['warm_query_p50_ms'] or 0:.2f}ms open_rss=+{best['rss_mb']['open_delta']:.0f}MB"
+    )
+
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="索引冷啟動基準測試")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[10000], help="節點數，可指定多個")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--embed-dim", type=int, default=1536)
+    parser.add_argument("--words-per-chunk", type=int, default=60, help="合成文字的長度，越長越能看出 docstore 的記憶體用量")
+    parser.add_argument("--vector-dtype", choices=["float32", "float16", "int8"], default="float16", help="numpy 格式的向量型別")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=20, help="每次開啟後的查詢數")
+    parser.add_argument("--repeat", type=int, default=3, help="每個格式重複開啟的次數")
+    parser.add_argument("--warm-cache", action="store_true", help="不清除頁面快取（量測熱啟動）")
+    parser.add_argument("--work-dir", default="./cold_start_bench")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON 結果輸出路徑")
+    parser.add_argument("--child", choices=FORMATS, help=argparse.SUPPRESS)
+    parser.add_argument("--persist-dir", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    if args.child:
+        print(json.dumps(measure_load(args.child, args.persist_dir, args.embed_dim, args.top_k, args.queries)))
+        return
+
+    reports = []
+    for num_chunks in args.chunks:
+        for report in run_benchmark(args, num_chunks):
+            print_report(report)
+            reports.append(report)
+
+    output = {
+        "benchmark": "cold_start",
+        "timestamp": time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "child", "persist_dir")},
+        "results": reports
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# benchmark_filtering.py - 元數據過濾查詢的延遲與召回率基準測試
+#
+# 每個向量帶有數個不同基數的元數據欄位（bucket_10 有 10 種值、bucket_1000 有 1000 種值……），
+# 以 EQ 過濾條件控制選擇性（命中 10%、0.1%……的向量）。對 NumpyVectorStore 與
+# FaissANNVectorStore 比較元數據索引預先過濾（metadata_prefilter=True）與逐列判斷、
+# 全部計分後才套用遮罩的舊作法，量測延遲百分位數與 recall@k（以過濾後的精確搜尋為標準答案），輸出 JSON。
+#
+#   python benchmark_filtering.py --chunks 200000 --selectivity 0.5 0.1 0.01 0.001
+#   python benchmark_filtering.py --chunks 100000 --stores numpy hnsw --output filtering.json
+import argparse
+import json
+import os
+import platform
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters, VectorStoreQuery
+from benchmark_ann import generate_queries, generate_vectors
+from faiss_vector_store import FaissANNVectorStore
+from numpy_vector_store import NumpyVectorStore
+
+STORES = ("numpy", "int8", "hnsw", "ivf")
+
+def bucket_sizes(selectivities: List[float]) -> List[int]:
+    """每個選擇性對應的欄位基數（命中比例約為 1 / 基數）"""
+    return sorted({max(1, round(1 / selectivity)) for selectivity in selectivities})
+
+def build_nodes(vectors: np.ndarray, sizes: List[int]) -> List[TextNode]:
+    return [
+        TextNode(
+            id_=str(row),
+            text="",
+            metadata={f"bucket_{size}": row % size for size in sizes},
+            embedding=vectors[row].tolist()
+        )
+        for row in range(len(vectors))
+    ]
+
+def new_store(name: str, prefilter: bool, num_chunks: int, args):
+    if name in ("numpy", "int8"):
+        return NumpyVectorStore(dtype="float32" if name == "numpy" else "int8", metadata_prefilter=prefilter)
+    return FaissANNVectorStore(
+        index_type=name,
+        train_size=min(args.train_size, num_chunks),
+        exact_filter_threshold=args.exact_filter_threshold,
+        metadata_prefilter=prefilter
+    )
+
+def measure(store, vectors: np.ndarray, queries: np.ndarray, size: int, top_k: int, seed: int) -> Dict[str, Any]:
+    """逐一查詢（每次隨機挑一個欄位值），量測延遲與過濾後的 recall@k"""
+    rng = np.random.default_rng(seed)
+    rows = np.arange(len(vectors))
+    latencies = []
+    hits = expected_total = 0
+    for query in queries:
+        value = int(rng.integers(0, size))
+        filters = MetadataFilters(filters=[MetadataFilter(key=f"bucket_{size}", value=value)])
+
+        started = time.perf_counter()
+        result = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k, filters=filters))
+        latencies.append(time.perf_counter() - started)
+
+        matching = rows[rows % size == value]
+        scores = vectors[matching] @ query
+        expected = matching[np.argsort(-scores)[:top_k]]
+        hits += len(set(map(int, result.ids)) & set(expected.tolist()))
+        expected_total += len(expected)
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "recall": hits / expected_total if expected_total else 1.0,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p90": float(np.percentile(latencies_ms, 90)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "mean": float(latencies_ms.mean())
+        }
+    }
+
+def run_benchmark(args, num_chunks: int) -> List[Dict[str, Any]]:
+    vectors = generate_vectors(num_chunks, args.embed_dim, args.clusters, args.seed)
+    queries = generate_queries(vectors, args.queries, args.seed)
+    sizes = bucket_sizes(args.selectivity)
+    nodes = build_nodes(vectors, sizes)
+    reports = []
+
+    for name in args.stores:
+        for prefilter in (True, False):
+            store = new_store(name, prefilter, num_chunks, args)
+            started = time.perf_counter()
+            for start in range(0, len(nodes), 4096):
+                store.add(nodes[start:start + 4096])
+            build_seconds = time.perf_counter() - started
+
+            # 逐列判斷的基準很慢，查詢數減少
+            num_queries = len(queries) if prefilter else max(5, len(queries) // 10)
+            for size in sizes:
+                report = {
+                    "store": name,
+                    "prefilter": prefilter,
+                    "chunks": num_chunks,
+                    "selectivity": 1 / size,
+                    "build_seconds": build_seconds,
+                    **measure(store, vectors, queries[:num_queries], size, args.top_k, args.seed)
+                }
+                print_report(report)
+                reports.append(report)
+            del store
+    return reports
+
+def print_report(report: Dict[str, Any]):
+    """在終端機輸出一行摘要"""
+    latency = report["latency_ms"]
+    print(
+        f"store={report['store']:<6} prefilter={str(report['prefilter']):<5} chunks={report['chunks']:>8} "
+        f"selectivity={report['selectivity']:<7.4f} recall@k={report['recall']:.3f} "
+        f"p50={latency['p50']:.2f}ms p99={latency['p99']:.2f}ms"
+    )
+
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="元數據過濾查詢的延遲與召回率基準測試")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[100000], help="向量數，可指定多個")
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=1000, help="合成向量的主題群數")
+    parser.add_argument("--selectivity", type=float, nargs="+", default=[0.5, 0.1, 0.01, 0.001],
+                        help="過濾條件命中的向量比例")
+    parser.add_argument("--stores", nargs="+", choices=STORES, default=["numpy", "hnsw"])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--train-size", type=int, default=100000, help="IVF 的訓練向量數上限")
+    parser.add_argument("--exact-filter-threshold", type=int, default=20000,
+                        help="FAISS 過濾後候選不超過此數時直接精確計分")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON 結果輸出路徑")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    reports = []
+    for num_chunks in args.chunks:
+        reports.extend(run_benchmark(args, num_chunks))
+
+    output = {
+        "benchmark": "metadata_filtering",
+        "timestamp": time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": reports
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# benchmark_hybrid.py - 向量、BM25 與混合檢索的召回率與延遲基準測試
+#
+# 產生合成語料：每個切塊屬於一個主題，內文由該主題的詞彙組成，並帶一個罕見的識別詞
+# （英數字代碼或中文專名）。稠密向量以「主題中心 + 雜訊」模擬語意嵌入——
+# 能理解主題，但分不出識別詞。查詢分兩種：
+#   keyword  - 識別詞加上主題的改寫用語，正確答案是帶該識別詞的唯一切塊
+#   semantic - 只用主題的改寫用語（與內文沒有共同詞彙），正確答案是該主題的所有切塊
+# 對 vector / bm25 / hybrid（兩者並行、RRF 合併）/ hybrid_sequential（依序執行）
+# 量測各類查詢的 recall@k 與延遲百分位數，輸出 JSON。查詢嵌入的 API 往返以 LatencyModel 模擬。
+#
+#   python benchmark_hybrid.py --chunks 20000 --query-embed-latency lognormal:0.03:0.3
+#   python benchmark_hybrid.py --chunks 100000 --topics 500 --output hybrid.json
+import argparse
+import json
+import os
+import platform
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import TextNode
+from bm25_index import BM25Index, BM25Indexer, BM25Retriever, HybridRetriever, reciprocal_rank_fusion
+from fake_backends import LatencyModel
+from numpy_vector_store import NumpyVectorStore, normalize_rows
+
+class ScriptedEmbedding(BaseEmbedding):
+    """回傳預先產生的向量；查詢嵌入依延遲模型等待，模擬 API 往返"""
+
+    _vectors: Dict[str, np.ndarray] = PrivateAttr()
+    _latency: LatencyModel = PrivateAttr()
+
+    def __init__(self, vectors: Dict[str, np.ndarray], latency: LatencyModel, **kwargs: Any):
+        super().__init__(model_name="scripted-embedding", **kwargs)
+        self._vectors = vectors
+        self._latency = latency
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        delay = self._latency.sample()
+        if delay:
+            time.sleep(delay)
+        return self._vectors[query].tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._vectors[text].tolist()
+
+def random_words(rng: np.random.Generator, count: int, length: int, low: int, high: int) -> List[str]:
+    """以指定 Unicode 範圍的隨機字元組成詞"""
+    codes = rng.integers(low, high, (count, length))
+    return ["".join(map(chr, row)) for row in codes]
+
+def generate_corpus(args) -> Tuple[List[TextNode], List[Tuple[str, str, set]], Dict[str, np.ndarray]]:
+    """產生切塊、查詢（文字, 類型, 正確答案的節點 ID）與所有文字對應的向量"""
+    rng = np.random.default_rng(args.seed)
+    centers = normalize_rows(rng.standard_normal((args.topics, args.embed_dim), dtype=np.float32))
+    # 主題詞彙用常用漢字，改寫用語與內文詞彙互不重疊，識別詞用擴充 A 區的罕用字
+    doc_vocab = [random_words(rng, 40, 2, 0x4E00, 0x7000) for _ in range(args.topics)]
+    query_vocab = [random_words(rng, 10, 2, 0x7000, 0x9FA5) for _ in range(args.topics)]
+
+    topics = rng.integers(0, args.topics, args.chunks)
+    noise = rng.standard_normal((args.chunks, args.embed_dim), dtype=np.float32) / np.sqrt(args.embed_dim)
+    doc_vectors = normalize_rows(centers[topics] + args.doc_noise * noise)
+
+    nodes = []
+    entities = []
+    vectors: Dict[str, np.ndarray] = {}
+    for row, topic in enumerate(topics):
+        if row % 2:
+            entity = random_words(rng, 1, 3, 0x3400, 0x4DB5)[0]
+        else:
+            entity = "".join(rng.choice(list("abcdefghijklmnopqrstuvwxyz0123456789"), 8))
+        words = list(rng.choice(doc_vocab[topic], args.words_per_chunk))
+        words.insert(int(rng.integers(0, len(words))), f" {entity} ")
+        text = "".join(words)
+        nodes.append(TextNode(id_=str(row), text=text, embedding=doc_vectors[row].tolist()))
+        entities.append(entity)
+        vectors[text] = doc_vectors[row]
+
+    topic_members = [set() for _ in range(args.topics)]
+    for row, topic in enumerate(topics):
+        topic_members[topic].add(str(row))
+
+    queries = []
+    for i in range(args.queries):
+        row = int(rng.integers(0, args.chunks))
+        topic = int(topics[row])
+        paraphrase = "".join(rng.choice(query_vocab[topic], 3))
+        query_noise = rng.standard_normal(args.embed_dim).astype(np.float32) / np.sqrt(args.embed_dim)
+        if i % 2 == 0:
+            # 稠密嵌入只略微偏向帶識別詞的切塊
+            text = f"{entities[row]} {paraphrase}"
+            vector = centers[topic] + 0.15 * (doc_vectors[row] - centers[topic]) + args.doc_noise * query_noise
+            queries.append((text, "keyword", {str(row)}))
+        else:
+            text = paraphrase
+            vector = centers[topic] + args.doc_noise * query_noise
+            queries.append((text, "semantic", topic_members[topic]))
+        vectors[text] = normalize_rows(vector[None, :])[0]
+
+    return nodes, queries, vectors
+
+def measure(retrieve: Callable[[str], list], queries: List[Tuple[str, str, set]], top_k: int) -> Dict[str, Any]:
+    """逐一查詢，量測各類查詢的 recall@k 與延遲"""
+    latencies = []
+    recalls: Dict[str, List[float]] = {}
+    for text, kind, relevant in queries:
+        started = time.perf_counter()
+        results = retrieve(text)[:top_k]
+        latencies.append(time.perf_counter() - started)
+        hits = len({result.node.node_id for result in results} & relevant)
+        recalls.setdefault(kind, []).append(hits / min(top_k, len(relevant)))
+
+    latencies_ms = np.asarray(latencies) * 1000
+    recall = {kind: float(np.mean(values)) for kind, values in recalls.items()}
+    recall["all"] = float(np.mean([value for values in recalls.values() for value in values]))
+    return {
+        "recall": recall,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p90": float(np.percentile(latencies_ms, 90)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "mean": float(latencies_ms.mean())
+        }
+    }
+
+def run_benchmark(args) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    nodes, queries, vectors = generate_corpus(args)
+    embed_model = ScriptedEmbedding(vectors, LatencyModel.parse(args.query_embed_latency, seed=args.seed))
+
+    # BM25Indexer 與匯入時放在 transformations 中的效果相同：節點經過時加入關鍵字索引
+    keyword_index = BM25Index()
+    started = time.perf_counter()
+    for start in range(0, len(nodes), 4096):
+        BM25Indexer(keyword_index)(nodes[start:start + 4096])
+    keyword_index.search("", 1)
+    bm25_build_seconds = time.perf_counter() - started
+
+    storage_context = StorageContext.from_defaults(vector_store=NumpyVectorStore())
+    index = VectorStoreIndex(nodes, storage_context=storage_context, embed_model=embed_model)
+
+    candidate_k = args.candidate_k or 2 * args.top_k
+    vector_retriever = index.as_retriever(similarity_top_k=candidate_k)
+    keyword_retriever = BM25Retriever.from_vector_index(index, keyword_index, similarity_top_k=candidate_k)
+    hybrid_retriever = HybridRetriever(vector_retriever, keyword_retriever, similarity_top_k=args.top_k)
+
+    def sequential(text: str) -> list:
+        return reciprocal_rank_fusion(
+            [vector_retriever.retrieve(text), keyword_retriever.retrieve(text)], args.top_k
+        )
+
+    index_stats = {
+        "chunks": len(nodes),
+        "bm25_build_seconds": bm25_build_seconds,
+        "bm25_postings_mb": keyword_index.nbytes / 2 ** 20,
+        "bm25_vocabulary": keyword_index.vocabulary_size
+    }
+    print(
+        f"chunks={len(nodes)} bm25_build={bm25_build_seconds:.2f}s "
+        f"postings={index_stats['bm25_postings_mb']:.1f}MB vocabulary={index_stats['bm25_vocabulary']}"
+    )
+
+    reports = []
+    for name, retrieve in (
+        ("vector", vector_retriever.retrieve),
+        ("bm25", keyword_retriever.retrieve),
+        ("hybrid", hybrid_retriever.retrieve),
+        ("hybrid_sequential", sequential)
+    ):
+        retrieve(queries[0][0])
+        report = {"retriever": name, **measure(retrieve, queries, args.top_k)}
+        print_report(report)
+        reports.append(report)
+    return index_stats, reports
+
+def print_report(report: Dict[str, Any]):
+    """在終端機輸出一行摘要"""
+    recall = report["recall"]
+    latency = report["latency_ms"]
+    print(
+        f"retriever={report['retriever']:<18} recall@k keyword={recall.get('keyword', 0):.3f} "
+        f"semantic={recall.get('semantic', 0):.3f} all={recall['all']:.3f} "
+        f"p50={latency['p50']:.2f}ms p99={latency['p99']:.2f}ms"
+    )
+
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="向量、BM25 與混合檢索的召回率與延遲基準測試")
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--topics", type=int, default=100)
+    parser.add_argument("--words-per-chunk", type=int, default=60, help="每個切塊的主題詞數（每詞兩個字）")
+    parser.add_argument("--embed-dim", type=int, default=128)
+    parser.add_argument("--doc-noise", type=float, default=0.8, help="切塊向量偏離主題中心的程度")
+    parser.add_argument("--queries", type=int, default=200, help="查詢數，keyword 與 semantic 各半")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--candidate-k", type=int, default=None, help="各路檢索的候選數，預設為 top-k 的兩倍")
+    parser.add_argument(
+        "--query-embed-latency", default="constant:0.02",
+        help="查詢嵌入延遲，格式為 分佈:平均秒數[:離散度]，例如 lognormal:0.03:0.3"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON 結果輸出路徑")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    index_stats, reports = run_benchmark(args)
+
+    output = {
+        "benchmark": "hybrid_recall_latency",
+        "timestamp": time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "index": index_stats,
+        "results": reports
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+# benchmark_production.py - ProductionRAGSystem 離線負載測試
+#
+# 使用 fake_backends 的確定性替身取代 OpenAI，在合成語料上以固定並行數或固定 QPS
+# 驅動 ProductionRAGSystem，輸出吞吐量、延遲百分位數與記憶體用量（JSON）。
+#
+#   python benchmark_production.py --chunks 1000 10000 --mode concurrency --concurrency 64
+#   python benchmark_production.py --chunks 100000 --mode qps --qps 200 --output results.json
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import time
+from typing import Any, Dict, List
+
+from llama_index.core import Document
+from fake_backends import LatencyModel, install_fake_backends
+
+production = importlib.import_module("08_production_deployment")
+ProductionRAGSystem = production.ProductionRAGSystem
+
+# 合成語料的主題詞彙
+TOPICS = {
+    "ai": ["人工智慧", "機器學習", "深度學習", "神經網路", "推理", "自然語言處理", "電腦視覺", "model", "training"],
+    "cloud": ["雲端運算", "IaaS", "PaaS", "SaaS", "AWS", "Azure", "GCP", "可擴展性", "成本效益"],
+    "data": ["資料庫", "索引", "查詢", "向量", "嵌入", "檢索", "儲存", "分片", "快取"],
+    "ops": ["監控", "日誌", "告警", "部署", "容器", "負載均衡", "延遲", "吞吐量", "回滾"]
+}
+FILLER = ["系統", "服務", "應用", "效能", "架構", "設計", "資料", "使用者", "平台", "流程"]
+
+class SyntheticCorpusRAGSystem(ProductionRAGSystem):
+    """以記憶體中的合成文件取代 documents_dir 的 ProductionRAGSystem"""
+
+    def __init__(self, config: Dict[str, Any], documents: List[Document]):
+        self._synthetic_documents = documents
+        super().__init__(config)
+
+    def _load_documents(self):
+        return self._synthetic_documents
+
+def generate_corpus(num_chunks: int, seed: int, words_per_chunk: int = 40) -> List[Document]:
+    """產生 num_chunks 份短文件，每份小於一個切塊，因此一份文件正好一個節點"""
+    rng = random.Random(seed)
+    topics = list(TOPICS)
+    documents = []
+
+    for i in range(num_chunks):
+        topic = topics[i % len(topics)]
+        words = [
+            rng.choice(TOPICS[topic]) if rng.random() < 0.6 else rng.choice(FILLER)
+            for _ in range(words_per_chunk)
+        ]
+        documents.append(Document(
+            text=" ".join(words),
+            metadata={"topic": topic, "chunk": i}
+        ))
+    return documents
+
+def generate_queries(num_queries: int, seed: int, distinct: int) -> List[str]:
+    """從有限的問題集合中抽樣，distinct 控制重複程度"""
+    rng = random.Random(seed + 1)
+    pool = []
+    for i in range(distinct):
+        topic = list(TOPICS)[i % len(TOPICS)]
+        terms = rng.sample(TOPICS[topic], 2)
+        pool.append(f"{terms[0]} 和 {terms[1]} 的關係是什麼？ #{i}")
+    return [rng.choice(pool) for _ in range(num_queries)]
+
+def current_rss_mb() -> float:
+    """目前的常駐記憶體（MB），非 Linux 時退回峰值"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+def peak_rss_mb() -> float:
+    """行程啟動以來的峰值常駐記憶體（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 回傳位元組，Linux 回傳 KB
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+async def run_fixed_concurrency(rag_system, queries: List[str], concurrency: int, timeout: float):
+    """固定數量的工作者輪流送出查詢（封閉式負載）"""
+    results = []
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(queries):
+            question = queries[next_index]
+            next_index += 1
+            started = time.perf_counter()
+            result = await rag_system.aquery(question, timeout=timeout)
+            results.append((time.perf_counter() - started, result))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+async def run_fixed_qps(rag_system, queries: List[str], qps: float, timeout: float):
+    """依固定速率送出查詢（開放式負載），延遲從排定時間起算以避免協同遺漏"""
+    results = []
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def fire(question: str, scheduled: float):
+        result = await rag_system.aquery(question, timeout=timeout)
+        results.append((loop.time() - scheduled, result))
+
+    tasks = []
+    for i, question in enumerate(queries):
+        scheduled = start + i / qps
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(fire(question, scheduled)))
+
+    await asyncio.gather(*tasks)
+    return results
+
+def summarize_results(results, elapsed: float) -> Dict[str, Any]:
+    """彙整用戶端觀察到的延遲與錯誤"""
+    histogram = production.LatencyHistogram()
+    status_counts: Dict[str, int] = {}
+
+    for latency, result in results:
+        status = "ok" if result["success"] else str(result.get("status_code", "error"))
+        status_counts[status] = status_counts.get(status, 0) + 1
+        if result["success"]:
+            histogram.record(latency)
+
+    return {
+        "requests": len(results),
+        "elapsed_seconds": elapsed,
+        "throughput_qps": status_counts.get("ok", 0) / elapsed if elapsed > 0 else 0.0,
+        "status_counts": status_counts,
+        "latency_seconds": histogram.snapshot()
+    }
+
+def run_benchmark(args, num_chunks: int) -> Dict[str, Any]:
+    """建立一個語料規模的系統並執行負載"""
+    gc.collect()
+    rss_before = current_rss_mb()
+
+    build_start = time.perf_counter()
+    rag_system = SyntheticCorpusRAGSystem(
+        {
+            "embedding_provider": "settings",
+            "similarity_top_k": args.top_k,
+            "response_mode": args.response_mode,
+            "max_concurrent_queries": args.max_in_flight,
+            "max_queue_depth": args.max_queue_depth,
+            "query_timeout": args.timeout,
+            "coalesce_queries": not args.no_coalesce,
+            "semantic_cache": args.semantic_cache,
+            "vector_backend": args.vector_backend,
+            "vector_dtype": args.vector_dtype,
+            "faiss_index_type": args.faiss_index_type,
+            "faiss_nprobe": args.faiss_nprobe,
+            "faiss_ef_search": args.faiss_ef_search,
+            "query_embed_batching": args.query_embed_batching,
+            "query_embed_max_batch": args.query_embed_max_batch,
+            "query_embed_max_wait": args.query_embed_max_wait
+        },
+        generate_corpus(num_chunks, args.seed)
+    )
+    build_seconds = time.perf_counter() - build_start
+    rss_after_build = current_rss_mb()
+
+    # 批次查詢嵌入走文字嵌入端點，索引建好後改用查詢嵌入的延遲模型
+    if args.query_embed_batching:
+        rag_system.embed_model.set_text_latency(args.query_embed_latency_model)
+
+    queries = generate_queries(args.requests, args.seed, args.distinct_queries)
+    load_start = time.perf_counter()
+    if args.mode == "qps":
+        results = asyncio.run(run_fixed_qps(rag_system, queries, args.qps, args.timeout))
+    else:
+        results = asyncio.run(run_fixed_concurrency(rag_system, queries, args.concurrency, args.timeout))
+    elapsed = time.perf_counter() - load_start
+
+    server_metrics = rag_system.get_metrics()
+    report = {
+        "chunks": num_chunks,
+        "build_seconds": build_seconds,
+        "memory_mb": {
+            "before_build": rss_before,
+            "after_build": rss_after_build,
+            "index_delta": rss_after_build - rss_before,
+            "after_load": current_rss_mb(),
+            "peak": peak_rss_mb()
+        },
+        "client": summarize_results(results, elapsed),
+        "server": {
+            "latency": server_metrics["latency"],
+            "coalesced_queries": server_metrics["coalesced_queries"],
+            "rejected_queries": server_metrics["rejected_queries"],
+            "cache_hits": server_metrics["cache_hits"],
+            "query_embed_batching": server_metrics["query_embed_batching"]
+        }
+    }
+
+    del rag_system
+    return report
+
+def print_report(report: Dict[str, Any]):
+    """在終端機輸出一行摘要"""
+    client = report["client"]
+    latency = client["latency_seconds"]
+    print(
+        f"chunks={report['chunks']:>8} build={report['build_seconds']:.1f}s "
+        f"qps={client['throughput_qps']:.1f} p50={latency['p50'] * 1000:.1f}ms "
+        f"p90={latency['p90'] * 1000:.1f}ms p99={latency['p99'] * 1000:.1f}ms "
+        f"max={latency['max'] * 1000:.1f}ms index_mem={report['memory_mb']['index_delta']:.0f}MB "
+        f"status={client['status_counts']}"
+    )
+
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="ProductionRAGSystem 離線負載測試")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000], help="合成語料的切塊數，可指定多個")
+    parser.add_argument("--mode", choices=["concurrency", "qps"], default="concurrency")
+    parser.add_argument("--concurrency", type=int, default=64, help="固定並行數模式的工作者數")
+    parser.add_argument("--qps", type=float, default=100.0, help="固定 QPS 模式的送出速率")
+    parser.add_argument("--requests", type=int, default=1000, help="每個語料規模的查詢數")
+    parser.add_argument("--distinct-queries", type=int, default=200, help="不重複問題的數量")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--response-mode", default="compact")
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--query-embed-latency", default="lognormal:0.03:0.4", help="分佈:平均值[:離散度]")
+    parser.add_argument("--ingest-embed-latency", default="constant:0")
+    parser.add_argument("--llm-latency", default="lognormal:0.5:0.5")
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--max-queue-depth", type=int, default=1024)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--no-coalesce", action="store_true", help="關閉相同查詢合併")
+    parser.add_argument("--semantic-cache", action="store_true", help="開啟語意答案快取")
+    parser.add_argument("--vector-backend", choices=["simple", "numpy", "faiss"], default="simple")
+    parser.add_argument("--vector-dtype", choices=["float32", "float16", "int8"], default="float16", help="numpy 後端的向量型別")
+    parser.add_argument("--faiss-index-type", choices=["flat", "ivf", "hnsw"], default="hnsw", help="faiss 後端的索引類型")
+    parser.add_argument("--faiss-nprobe", type=int, default=16)
+    parser.add_argument("--faiss-ef-search", type=int, default=64)
+    parser.add_argument("--query-embed-batching", action="store_true", help="開啟查詢嵌入微批次")
+    parser.add_argument("--query-embed-max-batch", type=int, default=32)
+    parser.add_argument("--query-embed-max-wait", type=float, default=0.005, help="批次等待視窗（秒）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON 結果輸出路徑")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    # 每個查詢的 INFO 日誌會主導量測結果
+    logging.getLogger(production.__name__).setLevel(logging.WARNING)
+
+    latency_models = {
+        "query_embed_latency": LatencyModel.parse(args.query_embed_latency, args.seed),
+        "ingest_embed_latency": LatencyModel.parse(args.ingest_embed_latency, args.seed + 1),
+        "llm_latency": LatencyModel.parse(args.llm_latency, args.seed + 2)
+    }
+    install_fake_backends(embed_dim=args.embed_dim, **latency_models)
+    args.query_embed_latency_model = latency_models["query_embed_latency"]
+
+    reports = []
+    for num_chunks in args.chunks:
+        report = run_benchmark(args, num_chunks)
+        print_report(report)
+        reports.append(report)
+
+    output = {
+        "benchmark": "production_rag",
+        "timestamp": time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {
+            **{key: value for key, value in vars(args).items() if key not in ("output", "query_embed_latency_model")},
+            **{name: model.describe() for name, model in latency_models.items()}
+        },
+        "results": reports
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+# bm25_index.py - 支援中日韓文字的 BM25 倒排索引與混合檢索
+#
+# 稠密向量檢索對「IaaS」、「AI 應用領域」這類關鍵字查詢常漏掉字面完全相符的切塊。
+# BM25Index 在匯入時（BM25Indexer 放在 transformations 中切塊器之後）建立本地倒排索引：
+# 英數字以單字為詞元、中日韓文字以重疊的二字組（bigram）為詞元，不需要斷詞字典；
+# 倒排串列以 CSR 形式存成連續的 NumPy 陣列（int32 節點列號 + uint16 詞頻），
+# 查詢時以向量化運算計算 BM25 分數。HybridRetriever 同時執行向量檢索與 BM25 檢索，
+# 再以倒數排名融合（RRF）合併兩邊的排序。
+#
+#   keyword_index = BM25Index()
+#   index = VectorStoreIndex.from_documents(documents, transformations=[splitter, BM25Indexer(keyword_index)])
+#   retriever = HybridRetriever(
+#       index.as_retriever(similarity_top_k=10),
+#       BM25Retriever.from_vector_index(index, keyword_index, similarity_top_k=10),
+#       similarity_top_k=5
+#   )
+import asyncio
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle, TransformComponent
+from record_file import RecordFile, write_records
+
+PERSIST_FORMAT = "bm25-csr"
+PERSIST_VERSION = 1
+
+# 英數字詞，或連續的中日韓文字（平假名、片假名、漢字、諺文）
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+|[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]+")
+
+def tokenize(text: str) -> List[str]:
+    """正規化（NFKC、大小寫）後切成詞元：英數字整個詞，中日韓文字切成重疊的二字組"""
+    tokens = []
+    for run in TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold()):
+        if run[0] < "぀" or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class BM25Index:
+    """以 CSR 倒排串列儲存、向量化計分的 BM25 索引"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._vocab: Optional[Dict[str, int]] = {}
+        self._terms: Optional[List[str]] = []
+        # (詞的起始位移, 節點列號, 詞頻, 節點長度, 刪除標記)，整組替換，查詢端取得的是一致的快照
+        self._postings = (
+            np.zeros(1, dtype=np.int64),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.uint16),
+            np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=bool)
+        )
+        self._node_ids: Optional[List[str]] = []
+        self._ref_doc_ids: Optional[List[Optional[str]]] = []
+        self._row_of: Optional[Dict[str, int]] = {}
+        self._pending: List[Tuple[int, Counter]] = []
+        self._live_docs = 0
+        self._live_length = 0.0
+        # 從持久化檔開啟時，詞彙表與節點列延遲到第一次用到才讀取
+        self._terms_file: Optional[RecordFile] = None
+        self._rows_file: Optional[RecordFile] = None
+
+    @property
+    def node_count(self) -> int:
+        return self._live_docs
+
+    @property
+    def vocabulary_size(self) -> int:
+        with self._lock:
+            self._flush()
+            return len(self._vocabulary())
+
+    @property
+    def nbytes(self) -> int:
+        """倒排陣列的位元組數（不含詞彙表與節點 ID）"""
+        with self._lock:
+            self._flush()
+        return sum(array.nbytes for array in self._postings)
+
+    def _vocabulary(self) -> Dict[str, int]:
+        if self._vocab is None:
+            self._terms = [term.decode("utf-8") for term in self._terms_file]
+            self._vocab = {term: term_id for term_id, term in enumerate(self._terms)}
+        return self._vocab
+
+    def _load_rows(self):
+        if self._node_ids is None:
+            rows = [json.loads(row) for row in self._rows_file]
+            self._node_ids = [row["node_id"] for row in rows]
+            self._ref_doc_ids = [row["ref_doc_id"] for row in rows]
+            self._row_of = {node_id: row for row, node_id in enumerate(self._node_ids)}
+
+    def node_id(self, row: int) -> str:
+        if self._node_ids is not None:
+            return self._node_ids[row]
+        return json.loads(self._rows_file[row])["node_id"]
+
+    def add(self, nodes: Sequence[BaseNode]):
+        """加入節點（同一個節點 ID 再次加入時取代舊內容）；倒排串列在下次查詢前才合併"""
+        with self._lock:
+            self._load_rows()
+            self._vocabulary()
+            for node in nodes:
+                old_row = self._row_of.get(node.node_id)
+                if old_row is not None:
+                    self._mark_deleted(old_row)
+
+                counts = Counter(tokenize(node.get_content()))
+                row = len(self._node_ids)
+                self._node_ids.append(node.node_id)
+                self._ref_doc_ids.append(node.ref_doc_id)
+                self._row_of[node.node_id] = row
+                self._pending.append((row, counts))
+                self._live_docs += 1
+                self._live_length += sum(counts.values())
+
+    def _mark_deleted(self, row: int):
+        """呼叫端需持有鎖"""
+        offsets, doc_ids, tfs, doc_len, deleted = self._postings
+        if row < len(deleted):
+            if deleted[row]:
+                return
+            deleted[row] = True
+            self._live_length -= float(doc_len[row])
+        else:
+            # 尚未合併的節點：直接從待合併清單移除
+            for i, (pending_row, counts) in enumerate(self._pending):
+                if pending_row == row:
+                    self._live_length -= sum(counts.values())
+                    del self._pending[i]
+                    break
+            else:
+                return
+        self._live_docs -= 1
+        self._row_of.pop(self._node_ids[row], None)
+
+    def delete(self, ref_doc_id: str):
+        """刪除某份文件的所有節點"""
+        with self._lock:
+            self._load_rows()
+            for row, owner in enumerate(self._ref_doc_ids):
+                if owner == ref_doc_id and self._row_of.get(self._node_ids[row]) == row:
+                    self._mark_deleted(row)
+
+    def delete_nodes(self, node_ids: Iterable[str]):
+        with self._lock:
+            self._load_rows()
+            for node_id in node_ids:
+                row = self._row_of.get(node_id)
+                if row is not None:
+                    self._mark_deleted(row)
+
+    def _flush(self):
+        """把待合併的節點併入 CSR 倒排串列（呼叫端需持有鎖）"""
+        if not self._pending:
+            return
+
+        vocab = self._vocabulary()
+        term_ids, rows, tfs = [], [], []
+        for row, counts in self._pending:
+            for term, tf in counts.items():
+                term_id = vocab.get(term)
+                if term_id is None:
+                    term_id = vocab[term] = len(self._terms)
+                    self._terms.append(term)
+                term_ids.append(term_id)
+                rows.append(row)
+                tfs.append(tf)
+
+        offsets, doc_ids, old_tfs, doc_len, deleted = self._postings
+        # 新增的節點列號接在既有列之後；中間被刪除的待合併列以長度 0 且已刪除的空列佔位
+        num_rows = len(self._node_ids)
+        new_len = np.zeros(num_rows - len(doc_len), dtype=np.float32)
+        new_deleted = np.ones(num_rows - len(doc_len), dtype=bool)
+        for row, counts in self._pending:
+            new_len[row - len(doc_len)] = sum(counts.values())
+            new_deleted[row - len(doc_len)] = False
+
+        old_terms = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        all_terms = np.concatenate([old_terms, np.asarray(term_ids, dtype=np.int64)])
+        all_docs = np.concatenate([doc_ids, np.asarray(rows, dtype=np.int32)])
+        all_tfs = np.concatenate([old_tfs, np.minimum(tfs, np.iinfo(np.uint16).max).astype(np.uint16)])
+        order = np.argsort(all_terms, kind="stable")
+        counts_per_term = np.bincount(all_terms, minlength=len(self._terms))
+
+        self._postings = (
+            np.concatenate([[0], np.cumsum(counts_per_term)]).astype(np.int64),
+            all_docs[order],
+            all_tfs[order],
+            np.concatenate([doc_len, new_len]),
+            np.concatenate([deleted, new_deleted])
+        )
+        self._pending = []
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[int, float]]:
+        """回傳分數最高的 (節點列號, BM25 分數)，依分數遞減排序"""
+        if self._pending:
+            with self._lock:
+                self._flush()
+
+        offsets, doc_ids, tfs, doc_len, deleted = self._postings
+        if not self._live_docs:
+            return []
+
+        vocab = self._vocabulary()
+        num_docs = self._live_docs
+        avg_len = self._live_length / num_docs or 1.0
+        scores = np.zeros(len(doc_len), dtype=np.float32)
+        length_norm = None
+
+        for term in set(tokenize(query)):
+            term_id = vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = int(offsets[term_id]), int(offsets[term_id + 1])
+            if start == end:
+                continue
+            if length_norm is None:
+                length_norm = self.k1 * (1.0 - self.b + self.b * doc_len / avg_len)
+
+            docs = doc_ids[start:end]
+            tf = tfs[start:end].astype(np.float32)
+            # 文件頻率包含已刪除的節點，在壓縮前略為低估 IDF，不影響排序的穩定性
+            idf = math.log(1.0 + (num_docs - (end - start) + 0.5) / ((end - start) + 0.5))
+            # 同一個詞的倒排串列中節點列號不重複，可直接以索引累加
+            scores[docs] += idf * tf * (self.k1 + 1.0) / (tf + length_norm[docs])
+
+        scores[deleted] = 0.0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(row), float(scores[row])) for row in candidates]
+
+    def persist(self, persist_dir: str):
+        """寫出倒排陣列、詞彙表與節點列，最後寫入標頭 JSON"""
+        with self._lock:
+            self._load_rows()
+            self._flush()
+            if self._live_docs < len(self._node_ids):
+                self._compact()
+
+            os.makedirs(persist_dir, exist_ok=True)
+            paths = self._paths(persist_dir)
+            offsets, doc_ids, tfs, doc_len, deleted = self._postings
+            for name, array in (("offsets", offsets), ("doc_ids", doc_ids), ("tfs", tfs), ("doc_len", doc_len)):
+                tmp_path = f"{paths[name]}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, paths[name])
+            write_records(paths["terms"], (term.encode("utf-8") for term in self._terms))
+            write_records(paths["rows"], (
+                json.dumps({"node_id": node_id, "ref_doc_id": ref_doc_id}, ensure_ascii=False).encode("utf-8")
+                for node_id, ref_doc_id in zip(self._node_ids, self._ref_doc_ids)
+            ))
+
+            header = {
+                "format": PERSIST_FORMAT,
+                "version": PERSIST_VERSION,
+                "k1": self.k1,
+                "b": self.b,
+                "num_docs": self._live_docs,
+                "total_length": self._live_length
+            }
+            tmp_path = f"{paths['header']}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(header, f)
+            os.replace(tmp_path, paths["header"])
+
+    def _compact(self):
+        """移除已刪除的節點列並重新編號（呼叫端需持有鎖，且已合併待處理節點）"""
+        offsets, doc_ids, tfs, doc_len, deleted = self._postings
+        keep = ~deleted
+        new_row = np.cumsum(keep) - 1
+        posting_keep = keep[doc_ids]
+        term_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))[posting_keep]
+
+        self._postings = (
+            np.concatenate([[0], np.cumsum(np.bincount(term_of, minlength=len(offsets) - 1))]).astype(np.int64),
+            new_row[doc_ids[posting_keep]].astype(np.int32),
+            tfs[posting_keep],
+            doc_len[keep],
+            np.zeros(int(keep.sum()), dtype=bool)
+        )
+        kept_rows = np.flatnonzero(keep).tolist()
+        self._node_ids = [self._node_ids[row] for row in kept_rows]
+        self._ref_doc_ids = [self._ref_doc_ids[row] for row in kept_rows]
+        self._row_of = {node_id: row for row, node_id in enumerate(self._node_ids)}
+
+    @staticmethod
+    def _paths(persist_dir: str) -> Dict[str, str]:
+        stem = os.path.join(persist_dir, "bm25")
+        return {
+            "header": f"{stem}.json",
+            "offsets": f"{stem}.offsets.npy",
+            "doc_ids": f"{stem}.doc_ids.npy",
+            "tfs": f"{stem}.tfs.npy",
+            "doc_len": f"{stem}.doc_len.npy",
+            "terms": f"{stem}.terms",
+            "rows": f"{stem}.rows"
+        }
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "BM25Index":
+        """以記憶體映射開啟持久化的索引；詞彙表與節點列在第一次用到時才讀取"""
+        paths = cls._paths(persist_dir)
+        with open(paths["header"], "r", encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != PERSIST_FORMAT or header.get("version") != PERSIST_VERSION:
+            raise ValueError(f"不支援的 BM25 索引格式: {header.get('format')} v{header.get('version')}")
+
+        index = cls(k1=header["k1"], b=header["b"])
+        doc_len = np.load(paths["doc_len"], mmap_mode="r")
+        index._postings = (
+            np.load(paths["offsets"], mmap_mode="r"),
+            np.load(paths["doc_ids"], mmap_mode="r"),
+            np.load(paths["tfs"], mmap_mode="r"),
+            doc_len,
+            np.zeros(len(doc_len), dtype=bool)
+        )
+        index._live_docs = header["num_docs"]
+        index._live_length = header["total_length"]
+        index._vocab = index._terms = None
+        index._node_ids = index._ref_doc_ids = index._row_of = None
+        index._terms_file = RecordFile(paths["terms"])
+        index._rows_file = RecordFile(paths["rows"])
+        return index
+
+class BM25Indexer(TransformComponent):
+    """放在匯入 transformations 的切塊器之後，節點經過時加入 BM25 索引（原樣傳回）"""
+
+    _index: BM25Index = PrivateAttr()
+
+    def __init__(self, index: BM25Index, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._index = index
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: Any) -> Sequence[BaseNode]:
+        self._index.add(nodes)
+        return nodes
+
+class BM25Retriever(BaseRetriever):
+    """以 BM25Index 檢索，節點內容向 docstore（或儲存文字的向量儲存）取回"""
+
+    def __init__(self, index: BM25Index, docstore=None, vector_store=None, similarity_top_k: int = 10, **kwargs: Any):
+        """
+        初始化檢索器
+
+        Args:
+            index: BM25 索引
+            docstore: 節點內容來源；為 None 時改用 vector_store.get_nodes（例如 Chroma）
+            similarity_top_k: 回傳的節點數
+        """
+        if docstore is None and vector_store is None:
+            raise ValueError("docstore 與 vector_store 至少需要一個")
+        super().__init__(**kwargs)
+        self._index = index
+        self._docstore = docstore
+        self._vector_store = vector_store
+        self.similarity_top_k = similarity_top_k
+
+    @classmethod
+    def from_vector_index(cls, vector_index, index: BM25Index, similarity_top_k: int = 10) -> "BM25Retriever":
+        """與 VectorStoreIndex 共用節點來源：向量儲存存放文字時向它取，否則向 docstore 取"""
+        if vector_index.vector_store.stores_text:
+            return cls(index, vector_store=vector_index.vector_store, similarity_top_k=similarity_top_k)
+        return cls(index, docstore=vector_index.docstore, similarity_top_k=similarity_top_k)
+
+    def _fetch(self, node_ids: List[str]) -> Dict[str, BaseNode]:
+        if self._docstore is not None:
+            nodes = self._docstore.get_nodes(node_ids, raise_error=False)
+        else:
+            nodes = self._vector_store.get_nodes(node_ids=node_ids)
+        return {node.node_id: node for node in nodes}
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        hits = self._index.search(query_bundle.query_str, self.similarity_top_k)
+        if not hits:
+            return []
+        node_ids = [self._index.node_id(row) for row, _ in hits]
+        nodes = self._fetch(node_ids)
+        return [
+            NodeWithScore(node=nodes[node_id], score=score)
+            for node_id, (_, score) in zip(node_ids, hits)
+            if node_id in nodes
+        ]
+
+def reciprocal_rank_fusion(
+    result_lists: Sequence[List[NodeWithScore]],
+    top_k: int,
+    k: float = 60.0
+) -> List[NodeWithScore]:
+    """倒數排名融合：每個節點的分數為各排序中 1 / (k + 名次) 的總和
+
+    只使用名次而不使用原始分數，因此餘弦相似度與 BM25 分數的尺度不同也不影響合併。
+    """
+    fused: Dict[str, float] = {}
+    nodes: Dict[str, BaseNode] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, 1):
+            node_id = result.node.node_id
+            fused[node_id] = fused.get(node_id, 0.0) + 1.0 / (k + rank)
+            nodes.setdefault(node_id, result.node)
+
+    ranked = sorted(fused.items(), key=lambda item: -item[1])[:top_k]
+    return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in ranked]
+
+class HybridRetriever(BaseRetriever):
+    """同時執行向量與關鍵字檢索，以 RRF 合併
+
+    關鍵字檢索在背景執行緒中與向量檢索（主要時間花在查詢嵌入的 API 往返）重疊，
+    因此混合檢索的延遲約等於兩者中較慢的一方，而不是兩者相加。
+    融合分數是 RRF 分數（約 0.01～0.03），不能再接以餘弦相似度為門檻的後處理器。
+    """
+
+    def __init__(
+        self,
+        vector_retriever: BaseRetriever,
+        keyword_retriever: BaseRetriever,
+        similarity_top_k: int = 5,
+        rrf_k: float = 60.0,
+        **kwargs: Any
+    ):
+        super().__init__(**kwargs)
+        self._vector_retriever = vector_retriever
+        self._keyword_retriever = keyword_retriever
+        self.similarity_top_k = similarity_top_k
+        self.rrf_k = rrf_k
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+
+    def _pool(self) -> ThreadPoolExecutor:
+        """關鍵字檢索用的執行緒池；分叉後子行程沒有父行程的執行緒，需重新建立"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-keyword")
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        keyword_future = self._pool().submit(self._keyword_retriever.retrieve, query_bundle)
+        vector_nodes = self._vector_retriever.retrieve(query_bundle)
+        return reciprocal_rank_fusion([vector_nodes, keyword_future.result()], self.similarity_top_k, self.rrf_k)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        loop = asyncio.get_running_loop()
+        vector_nodes, keyword_nodes = await asyncio.gather(
+            self._vector_retriever.aretrieve(query_bundle),
+            loop.run_in_executor(self._pool(), self._keyword_retriever.retrieve, query_bundle)
+        )
+        return reciprocal_rank_fusion([vector_nodes, keyword_nodes], self.similarity_top_k, self.rrf_k)
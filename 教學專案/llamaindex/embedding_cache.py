@@ -0,0 +1,372 @@
+# embedding_cache.py - 以內容定址的持久化嵌入快取
+#
+# 03 ~ 08 的範例都會對同一批 sample_documents 建立索引，相同的切塊被一再送去嵌入。
+# CachedEmbedding 包裝任何嵌入模型（預設為 OpenAIEmbedding），以
+# (模型名稱, 維度, 文字雜湊) 為鍵，把 float32 向量存在 SQLite 檔中：
+# 命中的部分一次批次讀出，只有未命中的文字才會送往上游 API。
+#
+#   from embedding_cache import install_embedding_cache
+#   install_embedding_cache()  # 之後 Settings.embed_model 即帶有快取
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core import Settings
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.embeddings.openai import OpenAIEmbedding
+from adaptive_embedding import AdaptiveBatchEmbedding
+
+logger = logging.getLogger(__name__)
+
+# 所有範例共用同一個快取檔
+DEFAULT_CACHE_PATH = "./embedding_cache.db"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# SQLite 單一語句可綁定的參數數量有上限，批次查詢時分段進行
+_SQL_BATCH = 500
+
+class EmbeddingCacheStore:
+    """以 SQLite 儲存 float32 向量，依最近使用時間做容量上限淘汰"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        初始化快取儲存（第一次使用時才開啟資料庫）
+
+        Args:
+            path: SQLite 檔案路徑
+            max_bytes: 向量資料的容量上限，超過時淘汰最久未使用的項目至 90%
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._total_bytes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """取得連線；分叉後的子行程不可沿用父行程的連線，需重新開啟"""
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            # WAL 讓多個範例或工作行程可以同時讀取
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " model TEXT NOT NULL,"
+                " dim INTEGER NOT NULL,"
+                " text_hash BLOB NOT NULL,"
+                " vector BLOB NOT NULL,"
+                " last_access REAL NOT NULL,"
+                " PRIMARY KEY (model, dim, text_hash)"
+                ") WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+            conn.commit()
+
+            self._conn = conn
+            self._pid = os.getpid()
+            self._total_bytes = conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()[0]
+        return self._conn
+
+    def get_many(self, model: str, dim: int, text_hashes: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        """批次讀取，回傳 {文字雜湊: 向量}，並更新命中項目的使用時間"""
+        found: Dict[bytes, np.ndarray] = {}
+        if not text_hashes:
+            return found
+
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(text_hashes), _SQL_BATCH):
+                batch = text_hashes[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings"
+                    f" WHERE model = ? AND dim = ? AND text_hash IN ({placeholders})",
+                    (model, dim, *batch)
+                )
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32)
+
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND dim = ? AND text_hash = ?",
+                    [(now, model, dim, text_hash) for text_hash in found]
+                )
+                conn.commit()
+        return found
+
+    def put_many(self, model: str, dim: int, items: Sequence[Tuple[bytes, np.ndarray]]):
+        """批次寫入向量，必要時淘汰舊項目"""
+        if not items:
+            return
+
+        now = time.time()
+        rows = [
+            (model, dim, text_hash, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text_hash, vector in items
+        ]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, dim, text_hash, vector, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+            self._total_bytes += sum(len(row[3]) for row in rows)
+            if self._total_bytes > self.max_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """淘汰最久未使用的項目，直到容量降到上限的 90%"""
+        # 其他行程也可能寫入，淘汰前重新計算實際容量
+        self._total_bytes = conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        if self._total_bytes <= target:
+            return
+
+        victims = []
+        freed = 0
+        rows = conn.execute(
+            "SELECT model, dim, text_hash, LENGTH(vector) FROM embeddings ORDER BY last_access"
+        )
+        for model, dim, text_hash, size in rows:
+            if self._total_bytes - freed <= target:
+                break
+            victims.append((model, dim, text_hash))
+            freed += size
+
+        conn.executemany(
+            "DELETE FROM embeddings WHERE model = ? AND dim = ? AND text_hash = ?",
+            victims
+        )
+        conn.commit()
+        self._total_bytes -= freed
+        logger.info(f"嵌入快取淘汰 {len(victims)} 筆，釋放 {freed / 1024 / 1024:.1f} MB")
+
+    def stats(self) -> Dict[str, Any]:
+        """回傳項目數與向量資料大小"""
+        with self._lock:
+            conn = self._connection()
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+        return {"path": self.path, "entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM embeddings")
+            conn.commit()
+            self._total_bytes = 0
+
+    def close(self):
+        """關閉資料庫連線"""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+class CachedEmbedding(BaseEmbedding):
+    """先查持久化快取，只把未命中的文字交給被包裝的嵌入模型"""
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingCacheStore = PrivateAttr()
+    _cache_model: str = PrivateAttr()
+    _cache_dim: int = PrivateAttr()
+    _stats_lock: threading.Lock = PrivateAttr()
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache_path: str = DEFAULT_CACHE_PATH,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        store: Optional[EmbeddingCacheStore] = None,
+        **kwargs: Any
+    ):
+        """
+        包裝嵌入模型
+
+        Args:
+            embed_model: 實際產生嵌入的模型
+            cache_path: SQLite 快取檔路徑
+            max_bytes: 快取容量上限
+            store: 共用的快取儲存（提供時忽略 cache_path 與 max_bytes）
+        """
+        # 快取查詢很便宜，批次可以比上游 API 大，未命中的部分再由 _upstream_batches 切分
+        kwargs.setdefault("embed_batch_size", max(embed_model.embed_batch_size, 1024))
+        kwargs.setdefault("callback_manager", embed_model.callback_manager)
+        super().__init__(model_name=embed_model.model_name, **kwargs)
+
+        self._embed_model = embed_model
+        self._store = store or EmbeddingCacheStore(cache_path, max_bytes)
+        # 鍵值取自最內層的實際模型，外層的批次或重試包裝不影響向量內容
+        base_model = embed_model
+        while isinstance(getattr(base_model, "embed_model", None), BaseEmbedding):
+            base_model = base_model.embed_model
+        # 鍵中的維度：有明確設定就用設定值，0 代表模型的原生維度
+        self._cache_model = f"{base_model.class_name()}:{base_model.model_name}"
+        self._cache_dim = int(getattr(base_model, "dimensions", None) or getattr(base_model, "embed_dim", None) or 0)
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        """被包裝的嵌入模型"""
+        return self._embed_model
+
+    @property
+    def store(self) -> EmbeddingCacheStore:
+        """底層的快取儲存"""
+        return self._store
+
+    @staticmethod
+    def _hash_text(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _lookup(self, texts: List[str]) -> Tuple[List[Optional[List[float]]], Dict[bytes, str]]:
+        """回傳 (與 texts 對齊、未命中為 None 的結果, 需要計算的 {雜湊: 文字})"""
+        hashes = [self._hash_text(text) for text in texts]
+        found = self._store.get_many(self._cache_model, self._cache_dim, list(dict.fromkeys(hashes)))
+        results = [found[text_hash].tolist() if text_hash in found else None for text_hash in hashes]
+
+        # 同一批內重複的文字只送一次
+        missing = {
+            text_hash: text
+            for text_hash, text, result in zip(hashes, texts, results)
+            if result is None
+        }
+        with self._stats_lock:
+            self._hits += len(texts) - sum(result is None for result in results)
+            self._misses += len(missing)
+        return results, missing
+
+    def _fill(self, texts: List[str], results: List[Optional[List[float]]], missing: Dict[bytes, str], embeddings: List[List[float]]) -> List[List[float]]:
+        """寫入新向量並補齊結果；回傳值一律經過 float32，命中與否結果一致"""
+        vectors = {
+            text_hash: np.asarray(embedding, dtype=np.float32)
+            for text_hash, embedding in zip(missing, embeddings)
+        }
+        self._store.put_many(self._cache_model, self._cache_dim, list(vectors.items()))
+
+        return [
+            result if result is not None else vectors[self._hash_text(text)].tolist()
+            for text, result in zip(texts, results)
+        ]
+
+    def _upstream_batches(self, texts: List[str]) -> List[List[str]]:
+        """切分未命中的文字：AdaptiveBatchEmbedding 自行依 token 預算打包並並行送出，一次交給它全部；
+        其他模型依其批次大小切分"""
+        if isinstance(self._embed_model, AdaptiveBatchEmbedding):
+            return [texts]
+        size = self._embed_model.embed_batch_size
+        return [texts[start:start + size] for start in range(0, len(texts), size)]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        # 查詢通常不重複且需要最新結果，不經過快取
+        return self._embed_model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._embed_model._aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        results, missing = self._lookup(texts)
+        if not missing:
+            return results
+
+        embeddings = []
+        for batch in self._upstream_batches(list(missing.values())):
+            embeddings.extend(self._embed_model._get_text_embeddings(batch))
+        return self._fill(texts, results, missing, embeddings)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        results, missing = await asyncio.to_thread(self._lookup, texts)
+        if not missing:
+            return results
+
+        batches = await asyncio.gather(*(
+            self._embed_model._aget_text_embeddings(batch)
+            for batch in self._upstream_batches(list(missing.values()))
+        ))
+        embeddings = [embedding for batch in batches for embedding in batch]
+        return await asyncio.to_thread(self._fill, texts, results, missing, embeddings)
+
+    def get_text_embedding_batch(self, texts: List[str], show_progress: bool = False, **kwargs: Any) -> List[List[float]]:
+        """整份清單一次查快取，未命中的部分一次交給 _upstream_batches，不受 embed_batch_size 切段
+        （否則包裝的 AdaptiveBatchEmbedding 每段結束時並行的批次都會歸零）"""
+        if not texts:
+            return []
+        with self.callback_manager.event(
+            CBEventType.EMBEDDING,
+            payload={EventPayload.SERIALIZED: self.to_dict()}
+        ) as event:
+            embeddings = self._get_text_embeddings(texts)
+            event.on_end(payload={EventPayload.CHUNKS: texts, EventPayload.EMBEDDINGS: embeddings})
+        return embeddings
+
+    async def aget_text_embedding_batch(self, texts: List[str], show_progress: bool = False, **kwargs: Any) -> List[List[float]]:
+        """get_text_embedding_batch 的非同步版本"""
+        if not texts:
+            return []
+        with self.callback_manager.event(
+            CBEventType.EMBEDDING,
+            payload={EventPayload.SERIALIZED: self.to_dict()}
+        ) as event:
+            embeddings = await self._aget_text_embeddings(texts)
+            event.on_end(payload={EventPayload.CHUNKS: texts, EventPayload.EMBEDDINGS: embeddings})
+        return embeddings
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """本行程的命中統計與快取檔大小"""
+        with self._stats_lock:
+            hits, misses = self._hits, self._misses
+        total = hits + misses
+        return {
+            **self._store.stats(),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0
+        }
+
+def install_embedding_cache(
+    embed_model: Optional[BaseEmbedding] = None,
+    cache_path: str = DEFAULT_CACHE_PATH,
+    max_bytes: int = DEFAULT_MAX_BYTES
+) -> CachedEmbedding:
+    """以帶快取的模型包裝 embed_model（預設 OpenAIEmbedding）並設為 Settings.embed_model"""
+    if isinstance(embed_model, CachedEmbedding):
+        cached = embed_model
+    else:
+        cached = CachedEmbedding(embed_model or OpenAIEmbedding(), cache_path=cache_path, max_bytes=max_bytes)
+
+    Settings.embed_model = cached
+    return cached
@@ -0,0 +1,432 @@
+# faiss_vector_store.py - 以 FAISS 做近似最近鄰搜尋的向量儲存
+#
+# SimpleVectorStore 與 NumpyVectorStore 每次查詢都要掃過全部向量，延遲隨語料線性成長。
+# FaissANNVectorStore 把正規化後的向量放進 FAISS 索引（內積即餘弦相似度）：
+#   flat - 精確搜尋（FAISS 的 SIMD 暴力掃描），作為基準
+#   ivf  - 倒排分群，只掃 nprobe 個群；向量數達 train_size 前先以 flat 提供精確搜尋
+#   hnsw - 階層式小世界圖，efSearch 控制搜尋寬度，延遲幾乎不隨語料成長
+#
+#   vector_store = FaissANNVectorStore(index_type="hnsw", ef_search=64)
+#   storage_context = StorageContext.from_defaults(vector_store=vector_store)
+#   index = VectorStoreIndex.from_documents(documents, storage_context=storage_context)
+#   index.storage_context.persist("./storage")   # .faiss 檔與 docstore.json 放在同一目錄
+import json
+import math
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    DEFAULT_PERSIST_FNAME,
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult
+)
+from llama_index.core.vector_stores.utils import build_metadata_filter_fn, node_to_metadata_dict
+from metadata_index import MetadataIndex
+from numpy_vector_store import normalize_rows
+from record_file import RecordFile, write_records
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+PERSIST_FORMAT = "faiss_ann_vector_store"
+PERSIST_VERSION = 1
+
+class FaissANNVectorStore(BasePydanticVectorStore):
+    """以 FAISS flat / IVF / HNSW 索引搜尋的向量儲存；刪除與過濾以 ID 選擇器在搜尋時排除"""
+
+    stores_text: bool = False
+    index_type: str = "hnsw"
+    nlist: Optional[int] = None
+    nprobe: int = 16
+    train_size: int = 20000
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    # 過濾後的候選列不超過此數時直接精確計分：選擇性高的過濾條件會讓 HNSW / IVF
+    # 在圖或群中繞行許多不合格的節點，反而比只算候選列慢，召回率也較差
+    exact_filter_threshold: int = 20000
+    # 以元數據索引將過濾條件轉為候選列；關閉時逐列判斷且一律走 ANN 索引（比較基準用）
+    metadata_prefilter: bool = True
+
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _index: Any = PrivateAttr(default=None)
+    _live: Optional[np.ndarray] = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0)
+    _num_deleted: int = PrivateAttr(default=0)
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[str] = PrivateAttr(default_factory=list)
+    _metadata: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _row_of: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _version: int = PrivateAttr(default=0)
+    _node_id_mask_cache: Tuple = PrivateAttr(default=(None, -1, None))
+    _metadata_index: MetadataIndex = PrivateAttr(default_factory=MetadataIndex)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, index_type: str = "hnsw", **kwargs: Any):
+        """
+        初始化向量儲存
+
+        Args:
+            index_type: flat / ivf / hnsw
+            nlist: IVF 的群數；未指定時於訓練時取 4·√N
+            nprobe: IVF 每次查詢掃描的群數（越大召回率越高、越慢）
+            train_size: IVF 累積到此向量數才訓練分群，之前以 flat 精確搜尋
+            hnsw_m: HNSW 每個節點的鄰居數
+            ef_construction: HNSW 建圖時的搜尋寬度
+            ef_search: HNSW 查詢時的搜尋寬度（至少為 top_k）
+            exact_filter_threshold: 過濾後候選列數不超過此值時不走 ANN 索引，直接精確計分
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"不支援的 FAISS 索引類型: {index_type}")
+        super().__init__(index_type=index_type, **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FaissANNVectorStore"
+
+    @property
+    def client(self) -> Any:
+        """底層的 FAISS 索引"""
+        return self._index
+
+    @property
+    def node_count(self) -> int:
+        """存活的向量數（不定義 __len__：空儲存會被 StorageContext 當成未提供）"""
+        return self._size - self._num_deleted
+
+    @property
+    def is_approximate(self) -> bool:
+        """目前的索引是否為近似搜尋（IVF 尚未訓練前仍是 flat）"""
+        return self._index is not None and not isinstance(self._index, faiss.IndexFlat)
+
+    def _new_index(self, dim: int, num_vectors: int):
+        """依設定建立空索引；IVF 的群數與訓練時的向量數有關"""
+        if self.index_type == "hnsw":
+            index = faiss.index_factory(dim, f"HNSW{self.hnsw_m},Flat", faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.ef_construction
+            return index
+        if self.index_type == "ivf" and num_vectors >= self.train_size:
+            # FAISS 建議每群至少約 39 個訓練向量
+            nlist = self.nlist or int(4 * math.sqrt(num_vectors))
+            nlist = max(1, min(nlist, num_vectors // 39))
+            return faiss.index_factory(dim, f"IVF{nlist},Flat", faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexFlatIP(dim)
+
+    def _all_vectors(self) -> np.ndarray:
+        """取回索引中全部（含已刪除）列的向量"""
+        if isinstance(self._index, faiss.IndexIVF):
+            self._index.make_direct_map()
+        return self._index.reconstruct_n(0, self._index.ntotal)
+
+    def _rebuild(self, vectors: np.ndarray):
+        """以給定的向量重建索引（IVF 在此時訓練）"""
+        index = self._new_index(self._dim, len(vectors))
+        if not index.is_trained:
+            index.train(vectors)
+        if len(vectors):
+            index.add(vectors)
+        self._index = index
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """加入節點的向量；重複的 node_id 會先刪除舊向量"""
+        if not nodes:
+            return []
+
+        vectors = normalize_rows(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        with self._lock:
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                self._index = self._new_index(self._dim, 0)
+                self._live = np.zeros(0, dtype=bool)
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f"向量維度不一致: {vectors.shape[1]} != {self._dim}")
+
+            row_of = self._row_of
+            replaced = [row_of[node.node_id] for node in nodes if node.node_id in row_of]
+            if replaced:
+                self._delete_rows(replaced)
+
+            self._index.add(vectors)
+            start = self._size
+            self._size += len(nodes)
+            self._live = np.concatenate([self._live, np.ones(len(nodes), dtype=bool)])
+
+            node_ids, ref_doc_ids, all_metadata = self._node_ids, self._ref_doc_ids, self._metadata
+            for row, node in enumerate(nodes, start):
+                metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+                metadata.pop("_node_content", None)
+                node_ids.append(node.node_id)
+                ref_doc_ids.append(node.ref_doc_id or "None")
+                all_metadata.append(metadata)
+                row_of[node.node_id] = row
+            self._version += 1
+            if self.metadata_prefilter:
+                self._metadata_index.sync(all_metadata, self._size)
+
+            # IVF 在向量數足夠時才訓練分群，之後的新增直接指派到既有的群
+            if self.index_type == "ivf" and not self.is_approximate and self._size >= self.train_size:
+                self._compact()
+        return [node.node_id for node in nodes]
+
+    def _delete_rows(self, rows: List[int]):
+        """以墓碑標記刪除（FAISS 的 HNSW 不支援移除），刪除比例過高時重建索引"""
+        self._version += 1
+        for row in rows:
+            if self._live[row]:
+                self._live[row] = False
+                self._num_deleted += 1
+                del self._row_of[self._node_ids[row]]
+
+        if self._num_deleted > 1024 and self._num_deleted > self._size // 4:
+            self._compact()
+
+    def _compact(self):
+        """移除已刪除的列並重建索引（FAISS 的列號即為列索引，因此必須一起重排）"""
+        keep = np.flatnonzero(self._live[:self._size])
+        self._rebuild(self._all_vectors()[keep] if self._size else np.empty((0, self._dim), dtype=np.float32))
+        self._node_ids = [self._node_ids[row] for row in keep]
+        self._ref_doc_ids = [self._ref_doc_ids[row] for row in keep]
+        self._metadata = [self._metadata[row] for row in keep]
+        self._row_of = {node_id: row for row, node_id in enumerate(self._node_ids)}
+        self._size = len(keep)
+        self._live = np.ones(self._size, dtype=bool)
+        self._num_deleted = 0
+        self._metadata_index.clear()
+        self._version += 1
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """刪除某份文件的所有節點"""
+        with self._lock:
+            rows = [
+                row for row in range(self._size)
+                if self._live[row] and self._ref_doc_ids[row] == ref_doc_id
+            ]
+            self._delete_rows(rows)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any
+    ) -> None:
+        """依 node_id 與元數據過濾條件刪除節點"""
+        with self._lock:
+            mask = self._candidate_mask(node_ids, filters)
+            rows = np.flatnonzero(mask if mask is not None else self._live[:self._size])
+            self._delete_rows(rows.tolist())
+
+    def clear(self) -> None:
+        """清空所有向量"""
+        with self._lock:
+            self._dim = self._index = self._live = None
+            self._size = self._num_deleted = 0
+            self._node_ids, self._ref_doc_ids, self._metadata = [], [], []
+            self._row_of = {}
+            self._metadata_index.clear()
+            self._version += 1
+
+    def _candidate_mask(self, node_ids: Optional[List[str]], filters: Optional[MetadataFilters]) -> Optional[np.ndarray]:
+        """依 node_id 限制與元數據過濾產生可用列的遮罩；不需過濾時回傳 None"""
+        if node_ids is None and filters is None:
+            return None if self._num_deleted == 0 else self._live[:self._size].copy()
+
+        mask = self._live[:self._size].copy()
+        if node_ids is not None:
+            mask &= self._node_id_mask(node_ids)
+        if filters is not None:
+            self._apply_filters(mask, filters)
+        elif mask.all():
+            return None
+        return mask
+
+    def _apply_filters(self, mask: np.ndarray, filters: MetadataFilters):
+        """以元數據索引將過濾條件轉為列遮罩並套用（見 NumpyVectorStore）"""
+        metadata = self._metadata
+        if self.metadata_prefilter:
+            self._metadata_index.sync(metadata, len(mask))
+            matches = self._metadata_index.evaluate(filters, len(mask))
+            if matches is not None:
+                mask &= matches
+                return
+
+        # 索引不支援的條件，或關閉預先過濾時，逐列判斷
+        filter_fn = build_metadata_filter_fn(lambda row: metadata[row], filters)
+        for row in np.flatnonzero(mask):
+            mask[row] = filter_fn(row)
+
+    def _node_id_mask(self, node_ids: List[str]) -> np.ndarray:
+        """node_id 清單對應的列遮罩（以串列本身與版本快取，見 NumpyVectorStore）"""
+        cached_ids, cached_version, cached_mask = self._node_id_mask_cache
+        if cached_ids is node_ids and cached_version == self._version and len(cached_mask) == self._size:
+            return cached_mask
+
+        row_of = self._row_of
+        allowed = np.zeros(self._size, dtype=bool)
+        allowed[[row_of[node_id] for node_id in node_ids if node_id in row_of]] = True
+        self._node_id_mask_cache = (node_ids, self._version, allowed)
+        return allowed
+
+    def _search_params(self, selector, top_k: int):
+        """依索引類型組出單次查詢的參數（不修改共用的索引設定，可並行查詢）"""
+        index = self._index
+        if isinstance(index, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=min(self.nprobe, index.nlist))
+        if isinstance(index, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=max(self.ef_search, top_k))
+        return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+    def _reconstruct(self, index, rows: np.ndarray) -> np.ndarray:
+        """取回指定列的向量；IVF 需要先建立列號到群內位置的直接對應"""
+        if isinstance(index, faiss.IndexIVF) and index.direct_map.type == faiss.DirectMap.NoMap:
+            with self._lock:
+                if index.direct_map.type == faiss.DirectMap.NoMap:
+                    index.make_direct_map()
+        return index.reconstruct_batch(rows)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """在 FAISS 索引上搜尋 top-k，已刪除或不符過濾條件的列以 ID 選擇器排除；過濾後候選夠少時直接精確計分"""
+        return self.query_many([query], **kwargs)[0]
+
+    def query_many(self, queries: Sequence[VectorStoreQuery], **kwargs: Any) -> List[VectorStoreQueryResult]:
+        """一次回答多個查詢，結果順序與輸入一致；查詢向量堆成矩陣，一次交給 FAISS 批次搜尋
+
+        node_ids 與過濾條件為同一個物件的查詢（同一個檢索器發出的查詢）共用候選遮罩與 ID 選擇器。
+        """
+        for query in queries:
+            if query.mode != VectorStoreQueryMode.DEFAULT:
+                raise ValueError(f"FaissANNVectorStore 不支援的查詢模式: {query.mode}")
+
+        results: List[Optional[VectorStoreQueryResult]] = [None] * len(queries)
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, query in enumerate(queries):
+            groups.setdefault((id(query.node_ids), id(query.filters)), []).append(i)
+
+        for positions in groups.values():
+            for position, result in zip(positions, self._query_group([queries[i] for i in positions])):
+                results[position] = result
+        return results
+
+    def _query_group(self, queries: List[VectorStoreQuery]) -> List[VectorStoreQueryResult]:
+        """node_ids 與過濾條件相同的一組查詢"""
+        empty = [VectorStoreQueryResult(similarities=[], ids=[]) for _ in queries]
+        index, size = self._index, self._size
+        if index is None or size == 0:
+            return empty
+
+        mask = self._candidate_mask(queries[0].node_ids, queries[0].filters)
+        available = size if mask is None else int(mask.sum())
+        top_ks = [min(query.similarity_top_k, available) for query in queries]
+        max_top_k = max(top_ks)
+        if max_top_k == 0:
+            return empty
+
+        query_vectors = normalize_rows(np.asarray([query.query_embedding for query in queries], dtype=np.float32))
+        node_ids = self._node_ids
+        if self.metadata_prefilter and mask is not None and available <= self.exact_filter_threshold:
+            rows = np.flatnonzero(mask)
+            scores = query_vectors @ self._reconstruct(index, rows).T
+            picked = np.argpartition(-scores, max_top_k - 1, axis=1)[:, :max_top_k]
+            picked_scores = np.take_along_axis(scores, picked, axis=1)
+            order = np.argsort(-picked_scores, axis=1)
+            labels = rows[np.take_along_axis(picked, order, axis=1)]
+            scores = np.take_along_axis(picked_scores, order, axis=1)
+        else:
+            # 位元圖必須在搜尋期間保持存活，選擇器只持有指標
+            bitmap = np.packbits(mask, bitorder="little") if mask is not None else None
+            selector = faiss.IDSelectorBitmap(size, faiss.swig_ptr(bitmap)) if bitmap is not None else None
+            scores, labels = index.search(query_vectors, max_top_k, params=self._search_params(selector, max_top_k))
+
+        results = []
+        for top_k, row_scores, row_labels in zip(top_ks, scores, labels):
+            hits = [(float(score), int(label)) for score, label in zip(row_scores[:top_k], row_labels[:top_k]) if label >= 0]
+            results.append(VectorStoreQueryResult(
+                similarities=[score for score, _ in hits],
+                ids=[node_ids[label] for _, label in hits]
+            ))
+        return results
+
+    def export_float32(self) -> Tuple[List[str], np.ndarray]:
+        """回傳存活節點的 (node_id, 正規化 float32 向量矩陣)"""
+        if not self._size:
+            return [], np.empty((0, self._dim or 0), dtype=np.float32)
+        keep = np.flatnonzero(self._live[:self._size])
+        return [self._node_ids[row] for row in keep], self._all_vectors()[keep]
+
+    @staticmethod
+    def _companion_paths(persist_path: str) -> Dict[str, str]:
+        stem = os.path.splitext(persist_path)[0]
+        return {"index": f"{stem}.faiss", "rows": f"{stem}.rows"}
+
+    def persist(self, persist_path: str = os.path.join("./storage", DEFAULT_PERSIST_FNAME), fs=None) -> None:
+        """寫出 .faiss 索引、逐列紀錄檔，最後寫入標頭 JSON（只支援本機檔案系統）"""
+        with self._lock:
+            if self._num_deleted:
+                self._compact()
+            os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+            paths = self._companion_paths(persist_path)
+
+            if self._index is not None:
+                tmp_path = f"{paths['index']}.tmp"
+                faiss.write_index(self._index, tmp_path)
+                os.replace(tmp_path, paths["index"])
+            write_records(paths["rows"], (
+                json.dumps(
+                    {"node_id": node_id, "ref_doc_id": ref_doc_id, "metadata": metadata},
+                    ensure_ascii=False
+                ).encode("utf-8")
+                for node_id, ref_doc_id, metadata in zip(self._node_ids, self._ref_doc_ids, self._metadata)
+            ))
+
+            header = {
+                "format": PERSIST_FORMAT,
+                "version": PERSIST_VERSION,
+                "dim": self._dim,
+                "count": self._size,
+                "config": self.model_dump(exclude={"stores_text", "is_embedding_query"})
+            }
+            tmp_path = f"{persist_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(header, f)
+            os.replace(tmp_path, persist_path)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, fs=None, **overrides: Any) -> "FaissANNVectorStore":
+        """載入持久化的儲存；overrides 可調整查詢參數（例如 nprobe、ef_search）"""
+        with open(persist_path, encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != PERSIST_FORMAT:
+            raise ValueError(f"{persist_path} 不是 FaissANNVectorStore 的持久化檔")
+        if header.get("version") != PERSIST_VERSION:
+            raise ValueError(f"{persist_path} 的格式版本 {header.get('version')} 不受支援，請重新建立索引")
+
+        store = cls(**{**header["config"], **overrides})
+        if not header["count"]:
+            return store
+
+        paths = cls._companion_paths(persist_path)
+        index = faiss.read_index(paths["index"])
+        if index.ntotal != header["count"]:
+            raise ValueError(f"{paths['index']} 的向量數與標頭不一致")
+
+        store._dim = header["dim"]
+        store._index = index
+        store._size = header["count"]
+        store._live = np.ones(store._size, dtype=bool)
+        for raw in RecordFile(paths["rows"]):
+            row = json.loads(raw)
+            store._node_ids.append(row["node_id"])
+            store._ref_doc_ids.append(row["ref_doc_id"])
+            store._metadata.append(row["metadata"])
+        store._row_of = {node_id: row for row, node_id in enumerate(store._node_ids)}
+        return store
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: str = "default", fs=None, **overrides: Any) -> "FaissANNVectorStore":
+        """從 StorageContext.persist() 的目錄載入"""
+        return cls.from_persist_path(os.path.join(persist_dir, f"{namespace}__{DEFAULT_PERSIST_FNAME}"), **overrides)
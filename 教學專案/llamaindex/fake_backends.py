@@ -0,0 +1,257 @@
+# fake_backends.py - 離線基準測試用的確定性 LLM 與嵌入替身
+import asyncio
+import hashlib
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, List, Optional, Tuple
+
+from pydantic import PrivateAttr
+from llama_index.core import Settings
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.llms import (
+    CustomLLM,
+    CompletionResponse,
+    CompletionResponseGen,
+    LLMMetadata
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+# 英數字詞或單一中日韓字元都視為一個詞元
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]")
+
+class FakeRateLimitError(Exception):
+    """模擬上游回傳 HTTP 429"""
+
+    status_code = 429
+
+class LatencyModel:
+    """模擬外部服務的延遲分佈（秒）"""
+
+    DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+    def __init__(self, distribution: str = "constant", mean: float = 0.0, spread: float = 0.0, seed: int = 0):
+        """
+        初始化延遲模型
+
+        Args:
+            distribution: constant / uniform / exponential / lognormal
+            mean: 平均值（lognormal 時為中位數）
+            spread: uniform 的半寬，或 lognormal 的 sigma
+            seed: 亂數種子
+        """
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"不支援的延遲分佈: {distribution}")
+        self.distribution = distribution
+        self.mean = mean
+        self.spread = spread
+        self._random = random.Random(seed)
+
+    @classmethod
+    def parse(cls, spec: str, seed: int = 0) -> "LatencyModel":
+        """解析 "分佈:平均值[:離散度]" 格式，例如 "lognormal:0.05:0.5" """
+        parts = spec.split(":")
+        mean = float(parts[1]) if len(parts) > 1 else 0.0
+        spread = float(parts[2]) if len(parts) > 2 else 0.0
+        return cls(parts[0], mean, spread, seed)
+
+    def sample(self) -> float:
+        """抽樣一次延遲"""
+        if self.mean <= 0:
+            return 0.0
+        if self.distribution == "uniform":
+            return max(0.0, self._random.uniform(self.mean - self.spread, self.mean + self.spread))
+        if self.distribution == "exponential":
+            return self._random.expovariate(1 / self.mean)
+        if self.distribution == "lognormal":
+            return self._random.lognormvariate(math.log(self.mean), self.spread)
+        return self.mean
+
+    def sleep(self):
+        """同步等待一次延遲"""
+        delay = self.sample()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def asleep(self):
+        """非同步等待一次延遲"""
+        delay = self.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def describe(self) -> dict:
+        """輸出設定，寫入基準測試結果"""
+        return {"distribution": self.distribution, "mean": self.mean, "spread": self.spread}
+
+class FakeEmbedding(BaseEmbedding):
+    """以特徵雜湊產生的確定性嵌入：詞彙重疊越多，向量越相似"""
+
+    embed_dim: int = 256
+
+    _query_latency: LatencyModel = PrivateAttr()
+    _text_latency: LatencyModel = PrivateAttr()
+    _max_concurrent_batches: Optional[int] = PrivateAttr()
+    _active_batches: int = PrivateAttr(default=0)
+    _active_lock: threading.Lock = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_dim: int = 256,
+        query_latency: Optional[LatencyModel] = None,
+        text_latency: Optional[LatencyModel] = None,
+        max_concurrent_batches: Optional[int] = None,
+        **kwargs: Any
+    ):
+        """
+        query_latency 用於查詢嵌入，text_latency 用於每一批文件嵌入；
+        同時進行的文件嵌入批次超過 max_concurrent_batches 時丟出 FakeRateLimitError
+        """
+        kwargs.setdefault("model_name", "fake-embedding")
+        super().__init__(embed_dim=embed_dim, **kwargs)
+        self._query_latency = query_latency or LatencyModel()
+        self._text_latency = text_latency or LatencyModel()
+        self._max_concurrent_batches = max_concurrent_batches
+        self._active_lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    def set_text_latency(self, latency: LatencyModel):
+        """更換文字嵌入的延遲，例如索引建好後改為模擬批次查詢嵌入"""
+        self._text_latency = latency
+
+    def _vector(self, text: str) -> List[float]:
+        """將詞元雜湊到固定維度並正規化"""
+        vector = [0.0] * self.embed_dim
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        if not tokens:
+            tokens = [text]
+
+        for token in tokens:
+            digest = zlib.crc32(token.encode("utf-8"))
+            sign = 1.0 if digest & 1 else -1.0
+            vector[(digest >> 1) % self.embed_dim] += sign
+
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        self._query_latency.sleep()
+        return self._vector(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        await self._query_latency.asleep()
+        return self._vector(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        self._text_latency.sleep()
+        return self._vector(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        await self._text_latency.asleep()
+        return self._vector(text)
+
+    @contextmanager
+    def _text_batch(self):
+        """追蹤同時進行的批次數，超過配額就模擬限流"""
+        with self._active_lock:
+            if self._max_concurrent_batches is not None and self._active_batches >= self._max_concurrent_batches:
+                raise FakeRateLimitError("rate limit exceeded")
+            self._active_batches += 1
+        try:
+            yield
+        finally:
+            with self._active_lock:
+                self._active_batches -= 1
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # 一批只等待一次延遲，模擬單次 HTTP 往返
+        with self._text_batch():
+            self._text_latency.sleep()
+            return [self._vector(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        with self._text_batch():
+            await self._text_latency.asleep()
+            return [self._vector(text) for text in texts]
+
+class FakeLLM(CustomLLM):
+    """回傳由提示詞雜湊決定之固定長度文字的 LLM 替身"""
+
+    context_window: int = 8192
+    num_output: int = 256
+    output_words: int = 64
+
+    _latency: LatencyModel = PrivateAttr()
+
+    def __init__(self, latency: Optional[LatencyModel] = None, **kwargs: Any):
+        """latency 為每次完成呼叫的延遲"""
+        super().__init__(**kwargs)
+        self._latency = latency or LatencyModel()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.num_output,
+            model_name="fake-llm"
+        )
+
+    def _answer(self, prompt: str) -> str:
+        """相同提示詞永遠得到相同回答"""
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        words = [digest[(i * 6) % 60:(i * 6) % 60 + 6] for i in range(self.output_words)]
+        return " ".join(words)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        self._latency.sleep()
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        await self._latency.asleep()
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        self._latency.sleep()
+        answer = self._answer(prompt)
+
+        def gen() -> CompletionResponseGen:
+            text = ""
+            for word in answer.split(" "):
+                delta = word if not text else f" {word}"
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+
+        return gen()
+
+def install_fake_backends(
+    embed_dim: int = 256,
+    query_embed_latency: Optional[LatencyModel] = None,
+    ingest_embed_latency: Optional[LatencyModel] = None,
+    llm_latency: Optional[LatencyModel] = None,
+    embed_batch_size: int = 256
+) -> Tuple[FakeEmbedding, FakeLLM]:
+    """將替身放入全域 Settings，之後建立的索引與查詢引擎都會使用它們"""
+    embed_model = FakeEmbedding(
+        embed_dim=embed_dim,
+        query_latency=query_embed_latency,
+        text_latency=ingest_embed_latency,
+        embed_batch_size=embed_batch_size
+    )
+    llm = FakeLLM(latency=llm_latency)
+
+    Settings.embed_model = embed_model
+    Settings.llm = llm
+    return embed_model, llm
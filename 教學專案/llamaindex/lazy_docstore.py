@@ -0,0 +1,282 @@
+# lazy_docstore.py - 節點內容存在 SQLite、查詢時才讀取的文件儲存
+#
+# VectorStoreIndex 搭配不存文字的向量儲存（SimpleVectorStore、FAISS、NumPy）時，
+# 預設的 SimpleDocumentStore 會把每個節點的完整文字與元數據留在記憶體中，
+# 但一次查詢只需要 top-k 個節點。LazyDocumentStore 把節點寫入 SQLite，
+# 檢索回傳節點 ID 後才以一次批次查詢讀出內容，並以小型 LRU 保留熱門節點，
+# 大型索引的常駐記憶體因此以向量為主，而不是文字。
+#
+#   docstore = LazyDocumentStore("./storage/docstore.db", cache_size=1024)
+#   storage_context = StorageContext.from_defaults(vector_store=vector_store, docstore=docstore)
+#   index = VectorStoreIndex(nodes, storage_context=storage_context)
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.docstore.utils import json_to_doc
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+
+logger = logging.getLogger(__name__)
+
+# SQLite 單一語句可綁定的參數數量有上限，批次查詢時分段進行
+_SQL_BATCH = 500
+
+def remove_database(path: str):
+    """刪除 SQLite 檔與 WAL 模式的附屬檔"""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+class SQLiteKVStore(BaseKVStore):
+    """以 SQLite 儲存 JSON 值的鍵值儲存，(collection, key) 為主鍵"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """取得連線；分叉後的子行程不可沿用父行程的連線，需重新開啟"""
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            # WAL 讓查詢讀取時不會被匯入的寫入擋住
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " collection TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " PRIMARY KEY (collection, key)"
+                ") WITHOUT ROWID"
+            )
+            conn.commit()
+
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put_all([(key, val)], collection=collection)
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put(key, val, collection=collection)
+
+    def put_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION, batch_size: int = 1) -> None:
+        """整批在同一個交易中寫入（batch_size 不影響行為）"""
+        if not kv_pairs:
+            return
+
+        rows = [(collection, key, json.dumps(val, ensure_ascii=False)) for key, val in kv_pairs]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("INSERT OR REPLACE INTO kv (collection, key, value) VALUES (?, ?, ?)", rows)
+            conn.commit()
+
+    async def aput_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION, batch_size: int = 1) -> None:
+        self.put_all(kv_pairs, collection=collection, batch_size=batch_size)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM kv WHERE collection = ? AND key = ?", (collection, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection=collection)
+
+    def get_many(self, keys: Sequence[str], collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        """批次讀取，回傳 {鍵: 值}（不存在的鍵不會出現在結果中）"""
+        found: Dict[str, dict] = {}
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(keys), _SQL_BATCH):
+                batch = keys[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, value FROM kv WHERE collection = ? AND key IN ({placeholders})",
+                    (collection, *batch)
+                )
+                for key, value in rows:
+                    found[key] = json.loads(value)
+        return found
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        """讀出整個集合（會把所有值載入記憶體，只在維護作業中使用）"""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT key, value FROM kv WHERE collection = ?", (collection,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection=collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self._lock:
+            conn = self._connection()
+            deleted = conn.execute("DELETE FROM kv WHERE collection = ? AND key = ?", (collection, key)).rowcount
+            conn.commit()
+        return deleted > 0
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection=collection)
+
+    def count(self, collection: str = DEFAULT_COLLECTION) -> int:
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM kv WHERE collection = ?", (collection,)
+            ).fetchone()[0]
+
+    def close(self):
+        """關閉資料庫連線"""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+class LazyDocumentStore(KVDocumentStore):
+    """節點存在 SQLite，只在檢索回傳時讀取；最近讀取的節點保留在 LRU 中"""
+
+    def __init__(self, path: str, cache_size: int = 1024, namespace: Optional[str] = None):
+        """
+        初始化文件儲存
+
+        Args:
+            path: SQLite 檔案路徑；資料寫入即持久化，persist() 不另外輸出檔案
+            cache_size: 保留在記憶體中的熱門節點數，0 表示不快取
+            namespace: 同一個檔案中區分多個文件儲存
+        """
+        super().__init__(SQLiteKVStore(path), namespace=namespace)
+        self.path = path
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, BaseNode]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _cache_get(self, node_id: str) -> Optional[BaseNode]:
+        with self._cache_lock:
+            node = self._cache.get(node_id)
+            if node is not None:
+                self._cache.move_to_end(node_id)
+                self._hits += 1
+            return node
+
+    def _cache_put(self, nodes: Sequence[BaseNode]):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            for node in nodes:
+                self._cache[node.node_id] = node
+                self._cache.move_to_end(node.node_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _invalidate(self, node_ids: Sequence[str]):
+        with self._cache_lock:
+            for node_id in node_ids:
+                self._cache.pop(node_id, None)
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> Optional[BaseNode]:
+        node = self._cache_get(doc_id)
+        if node is not None:
+            return node
+
+        with self._cache_lock:
+            self._misses += 1
+        node = super().get_document(doc_id, raise_error=raise_error)
+        if node is not None:
+            self._cache_put([node])
+        return node
+
+    async def aget_document(self, doc_id: str, raise_error: bool = True) -> Optional[BaseNode]:
+        return self.get_document(doc_id, raise_error=raise_error)
+
+    def get_nodes(self, node_ids: List[str], raise_error: bool = True) -> List[BaseNode]:
+        """先查 LRU，未命中的節點以一次 SQL 查詢讀出，回傳順序與 node_ids 相同"""
+        found: Dict[str, BaseNode] = {}
+        missing = []
+        for node_id in node_ids:
+            node = self._cache_get(node_id)
+            if node is not None:
+                found[node_id] = node
+            else:
+                missing.append(node_id)
+
+        if missing:
+            with self._cache_lock:
+                self._misses += len(missing)
+            loaded = [json_to_doc(data) for data in self._kvstore.get_many(missing, collection=self._node_collection).values()]
+            self._cache_put(loaded)
+            found.update((node.node_id, node) for node in loaded)
+
+        nodes = []
+        for node_id in node_ids:
+            if node_id in found:
+                nodes.append(found[node_id])
+            elif raise_error:
+                raise ValueError(f"Node {node_id} not found")
+        return nodes
+
+    async def aget_nodes(self, node_ids: List[str], raise_error: bool = True) -> List[BaseNode]:
+        return self.get_nodes(node_ids, raise_error=raise_error)
+
+    def add_documents(self, docs: Sequence[BaseNode], allow_update: bool = True, batch_size: Optional[int] = None, store_text: bool = True) -> None:
+        self._invalidate([doc.node_id for doc in docs])
+        super().add_documents(docs, allow_update=allow_update, batch_size=batch_size, store_text=store_text)
+
+    async def async_add_documents(self, docs: Sequence[BaseNode], allow_update: bool = True, batch_size: Optional[int] = None, store_text: bool = True) -> None:
+        self.add_documents(docs, allow_update=allow_update, batch_size=batch_size, store_text=store_text)
+
+    def delete_document(self, doc_id: str, raise_error: bool = True) -> None:
+        self._invalidate([doc_id])
+        super().delete_document(doc_id, raise_error=raise_error)
+
+    async def adelete_document(self, doc_id: str, raise_error: bool = True) -> None:
+        self.delete_document(doc_id, raise_error=raise_error)
+
+    def delete_ref_doc(self, ref_doc_id: str, raise_error: bool = True) -> None:
+        ref_doc_info = self.get_ref_doc_info(ref_doc_id)
+        if ref_doc_info is not None:
+            self._invalidate(ref_doc_info.node_ids)
+        super().delete_ref_doc(ref_doc_id, raise_error=raise_error)
+
+    async def adelete_ref_doc(self, ref_doc_id: str, raise_error: bool = True) -> None:
+        self.delete_ref_doc(ref_doc_id, raise_error=raise_error)
+
+    def persist(self, persist_path: str = "", fs=None) -> None:
+        """寫入時已提交到 SQLite，不輸出 docstore.json"""
+
+    @property
+    def node_count(self) -> int:
+        return self._kvstore.count(collection=self._node_collection)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """本行程的 LRU 命中統計"""
+        with self._cache_lock:
+            hits, misses, cached = self._hits, self._misses, len(self._cache)
+        total = hits + misses
+        return {
+            "path": self.path,
+            "cached_nodes": cached,
+            "cache_size": self.cache_size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0
+        }
+
+    def close(self):
+        self._kvstore.close()
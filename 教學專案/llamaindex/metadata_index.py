@@ -0,0 +1,188 @@
+# metadata_index.py - 元數據過濾的倒排索引（每個欄位值對應一組列號）
+#
+# build_metadata_filter_fn 逐列以 Python 判斷過濾條件，大型索引上即使條件只命中
+# 少數切塊，每次查詢仍要走過全部元數據，且向量儲存多半先對所有向量計分再套用遮罩。
+# MetadataIndex 為每個「欄位 → 值」維護一組列號，過濾條件在查詢時轉換成列的
+# 點陣圖（布林遮罩）：EQ / IN 為聯集、AND / OR 為位元運算、NE / NIN / NOT 為補集，
+# 向量儲存再只對遮罩內的列計分。NumpyVectorStore 與 FaissANNVectorStore 皆使用此索引。
+#
+#   index = MetadataIndex()
+#   index.sync(all_metadata, len(all_metadata))   # 只處理上次同步之後新增的列
+#   mask = index.evaluate(filters, len(all_metadata))
+#   if mask is None:
+#       ...  # 索引不支援的運算子（例如 IS_EMPTY），改為逐列判斷
+import threading
+from typing import Any, Dict, Hashable, Optional, Sequence
+
+import numpy as np
+from llama_index.core.vector_stores.types import FilterCondition, FilterOperator, MetadataFilter, MetadataFilters
+
+class _Unsupported(Exception):
+    """索引無法回答的過濾條件"""
+
+_COMPARISONS = {
+    FilterOperator.GT: lambda item, value: item > value,
+    FilterOperator.GTE: lambda item, value: item >= value,
+    FilterOperator.LT: lambda item, value: item < value,
+    FilterOperator.LTE: lambda item, value: item <= value
+}
+
+def _hashable(value: Any) -> bool:
+    return isinstance(value, Hashable)
+
+class _RowList:
+    """可附加的列號陣列；擴充時換成新陣列，查詢端持有的舊視圖不受影響"""
+
+    __slots__ = ("rows", "count")
+
+    def __init__(self):
+        self.rows = np.empty(4, dtype=np.int32)
+        self.count = 0
+
+    def append(self, row: int):
+        if self.count == len(self.rows):
+            rows = np.empty(2 * len(self.rows), dtype=np.int32)
+            rows[:self.count] = self.rows
+            self.rows = rows
+        self.rows[self.count] = row
+        self.count += 1
+
+    def view(self) -> np.ndarray:
+        return self.rows[:self.count]
+
+class MetadataIndex:
+    """欄位值 → 列號的倒排索引，將 MetadataFilters 轉為列遮罩
+
+    行為與 build_metadata_filter_fn 相同：欄位不存在或為 None 時只符合 NE / NIN；
+    EQ 以 == 比較（1、1.0 與 True 視為同一個值）。以底線開頭的內部欄位不建立索引。
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Dict[Hashable, _RowList]] = {}
+        # 清單型欄位的元素 → 列號，供 CONTAINS / ANY / ALL 使用
+        self._elements: Dict[str, Dict[Hashable, _RowList]] = {}
+        # 出現過字串值的欄位：CONTAINS 在字串上是子字串比對，無法由元素索引回答
+        self._string_keys = set()
+        # 出現過無法雜湊之值（例如巢狀 dict）的欄位，過濾時改為逐列判斷
+        self._opaque_keys = set()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """已建立索引的列數"""
+        return self._size
+
+    def clear(self):
+        """清空索引（向量儲存壓實、列號重排後呼叫，下次 sync 時重建）"""
+        with self._lock:
+            self._values, self._elements = {}, {}
+            self._string_keys, self._opaque_keys = set(), set()
+            self._size = 0
+
+    def sync(self, all_metadata: Sequence[Dict[str, Any]], size: int):
+        """為 [已索引列數, size) 之間新增的列建立索引"""
+        if self._size >= size:
+            return
+        with self._lock:
+            for row in range(self._size, size):
+                self._add_row(row, all_metadata[row])
+            self._size = size
+
+    def _add_row(self, row: int, metadata: Dict[str, Any]):
+        for key, value in metadata.items():
+            if key.startswith("_") or value is None:
+                continue
+            if isinstance(value, list):
+                if not all(_hashable(item) for item in value):
+                    self._opaque_keys.add(key)
+                    continue
+                elements = self._elements.setdefault(key, {})
+                for element in set(value):
+                    elements.setdefault(element, _RowList()).append(row)
+                continue
+            if not _hashable(value):
+                self._opaque_keys.add(key)
+                continue
+            if isinstance(value, str):
+                self._string_keys.add(key)
+            self._values.setdefault(key, {}).setdefault(value, _RowList()).append(row)
+
+    def evaluate(self, filters: MetadataFilters, size: int) -> Optional[np.ndarray]:
+        """回傳長度為 size 的布林遮罩；含索引不支援的條件時回傳 None"""
+        try:
+            # 與 sync 互斥：比較運算子會走訪欄位的所有值
+            with self._lock:
+                return self._evaluate(filters, size)
+        except (_Unsupported, TypeError):
+            # TypeError：例如字串與數字比較大小，交給逐列判斷以得到相同的錯誤或結果
+            return None
+
+    def _evaluate(self, filters: MetadataFilters, size: int) -> np.ndarray:
+        masks = [
+            self._evaluate(item, size) if isinstance(item, MetadataFilters) else self._match(item, size)
+            for item in filters.filters
+        ]
+        condition = filters.condition or FilterCondition.AND
+        if not masks:
+            return np.ones(size, dtype=bool)
+        if condition == FilterCondition.AND:
+            return np.logical_and.reduce(masks)
+        if condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        if condition == FilterCondition.NOT:
+            return ~np.logical_or.reduce(masks)
+        raise _Unsupported(condition)
+
+    def _rows_mask(self, row_lists, size: int) -> np.ndarray:
+        mask = np.zeros(size, dtype=bool)
+        for row_list in row_lists:
+            rows = row_list.view()
+            # 同步之後才加入的列不在遮罩範圍內
+            mask[rows[rows < size] if len(rows) and rows[-1] >= size else rows] = True
+        return mask
+
+    def _match(self, metadata_filter: MetadataFilter, size: int) -> np.ndarray:
+        key, operator, value = metadata_filter.key, metadata_filter.operator, metadata_filter.value
+        if key.startswith("_") or key in self._opaque_keys:
+            raise _Unsupported(key)
+        values = self._values.get(key, {})
+
+        if operator == FilterOperator.EQ:
+            if not _hashable(value):
+                raise _Unsupported(operator)
+            return self._rows_mask([values[value]] if value in values else [], size)
+        if operator == FilterOperator.NE:
+            return ~self._match(MetadataFilter(key=key, operator=FilterOperator.EQ, value=value), size)
+        if operator == FilterOperator.IN:
+            if not all(_hashable(item) for item in value):
+                raise _Unsupported(operator)
+            return self._rows_mask([values[item] for item in value if item in values], size)
+        if operator == FilterOperator.NIN:
+            return ~self._match(MetadataFilter(key=key, operator=FilterOperator.IN, value=value), size)
+        if operator in _COMPARISONS:
+            compare = _COMPARISONS[operator]
+            return self._rows_mask([rows for item, rows in values.items() if compare(item, value)], size)
+        if operator in (FilterOperator.TEXT_MATCH, FilterOperator.TEXT_MATCH_INSENSITIVE):
+            if not isinstance(value, str) or any(not isinstance(item, str) for item in values):
+                raise _Unsupported(operator)
+            if operator == FilterOperator.TEXT_MATCH_INSENSITIVE:
+                value = value.lower()
+                return self._rows_mask([rows for item, rows in values.items() if value in item.lower()], size)
+            return self._rows_mask([rows for item, rows in values.items() if value in item], size)
+
+        if operator in (FilterOperator.CONTAINS, FilterOperator.ANY, FilterOperator.ALL):
+            # 字串欄位的 CONTAINS 是子字串比對，交給逐列判斷
+            if key in self._string_keys:
+                raise _Unsupported(operator)
+            elements = self._elements.get(key, {})
+            wanted = [value] if operator == FilterOperator.CONTAINS else list(value)
+            if not wanted or not all(_hashable(item) for item in wanted):
+                raise _Unsupported(operator)
+            if operator == FilterOperator.ALL:
+                return np.logical_and.reduce([
+                    self._rows_mask([elements[item]] if item in elements else [], size) for item in wanted
+                ])
+            return self._rows_mask([elements[item] for item in wanted if item in elements], size)
+
+        raise _Unsupported(operator)
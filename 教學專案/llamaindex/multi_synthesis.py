@@ -0,0 +1,215 @@
+# multi_synthesis.py - 檢索一次、以多種回應模式合成的比較工具
+#
+# 比較回應模式時，為每種設定各建一個查詢引擎會讓同一個問題重複嵌入與檢索。
+# MultiSynthesisEngine 對每個查詢束只檢索（與後處理）一次，把帶分數的節點放進 LRU 快取，
+# 再讓多個合成設定（compact、tree_summarize、simple_summarize、不同的 top-k 前綴……）
+# 平行地在同一份檢索結果上產生回答，並分別記錄延遲、LLM 呼叫次數與 token 數。
+#
+#   engine = MultiSynthesisEngine(index.as_retriever(similarity_top_k=5))
+#   for result in engine.compare("什麼是機器學習？", [
+#       {"response_mode": "compact", "top_k": 3},
+#       {"response_mode": "tree_summarize", "top_k": 5}
+#   ]):
+#       print(result["name"], result["latency_seconds"], result["total_tokens"])
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from llama_index.core import Settings, get_response_synthesizer
+from llama_index.core.callbacks import CallbackManager, TokenCountingHandler
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+
+DEFAULT_VARIANTS = [
+    {"response_mode": "compact", "top_k": 3},
+    {"response_mode": "compact", "top_k": 5},
+    {"response_mode": "tree_summarize", "top_k": 3},
+    {"response_mode": "simple_summarize", "top_k": 3}
+]
+
+class MultiSynthesisEngine:
+    """同一次檢索結果供多種合成設定共用的查詢引擎"""
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        node_postprocessors: Optional[Sequence[Any]] = None,
+        llm=None,
+        max_workers: int = 4,
+        cache_size: int = 128
+    ):
+        """
+        初始化引擎
+
+        Args:
+            retriever: 檢索器，similarity_top_k 需不小於各設定中最大的 top_k
+            node_postprocessors: 檢索後只執行一次的後處理器
+            llm: 合成用的 LLM，預設為 Settings.llm
+            max_workers: 同時合成的設定數
+            cache_size: 快取的查詢束數
+        """
+        self._retriever = retriever
+        self._node_postprocessors = list(node_postprocessors or [])
+        self._llm = llm
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple, List[NodeWithScore]]" = OrderedDict()
+        # 同一個查詢束同時被多個呼叫端要求時只檢索一次，其餘等待同一個結果
+        self._inflight: Dict[Tuple, Future] = {}
+        self._lock = threading.Lock()
+        self._tokenizer = get_tokenizer()
+        self._retrievals = 0
+        self._hits = 0
+
+    @staticmethod
+    def _as_bundle(query: Union[str, QueryBundle]) -> QueryBundle:
+        return QueryBundle(query) if isinstance(query, str) else query
+
+    @staticmethod
+    def _cache_key(query_bundle: QueryBundle) -> Tuple:
+        return (query_bundle.query_str, tuple(query_bundle.custom_embedding_strs or ()))
+
+    def retrieve(self, query: Union[str, QueryBundle]) -> List[NodeWithScore]:
+        """檢索並後處理；同一個查詢束在快取中時直接回傳"""
+        query_bundle = self._as_bundle(query)
+        key = self._cache_key(query_bundle)
+
+        with self._lock:
+            nodes = self._cache.get(key)
+            if nodes is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return nodes
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self._hits += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            nodes = self._retriever.retrieve(query_bundle)
+            for postprocessor in self._node_postprocessors:
+                nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[key]
+            self._retrievals += 1
+            self._cache[key] = nodes
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        future.set_result(nodes)
+        return nodes
+
+    async def aretrieve(self, query: Union[str, QueryBundle]) -> List[NodeWithScore]:
+        return await asyncio.to_thread(self.retrieve, query)
+
+    def _synthesizer(self, variant: Dict[str, Any]) -> Tuple[Any, TokenCountingHandler]:
+        """為單一設定建立合成器；LLM 複製一份並掛上自己的 token 計數器，平行合成時計數不會混在一起"""
+        counter = TokenCountingHandler(tokenizer=self._tokenizer)
+        callback_manager = CallbackManager([counter])
+        llm = (self._llm or Settings.llm).model_copy(update={"callback_manager": callback_manager})
+        options = {key: value for key, value in variant.items() if key not in ("name", "top_k")}
+        return get_response_synthesizer(llm=llm, callback_manager=callback_manager, **options), counter
+
+    @staticmethod
+    def _mode_name(variant: Dict[str, Any]) -> str:
+        mode = variant.get("response_mode", "compact")
+        return getattr(mode, "value", mode)
+
+    @classmethod
+    def _variant_name(cls, variant: Dict[str, Any]) -> str:
+        return variant.get("name") or f"{cls._mode_name(variant)}@{variant.get('top_k', 'all')}"
+
+    @classmethod
+    def _result(cls, variant, nodes, started, counter, response=None, error=None) -> Dict[str, Any]:
+        return {
+            "name": cls._variant_name(variant),
+            "response_mode": cls._mode_name(variant),
+            "top_k": len(nodes),
+            "response": response,
+            "error": error,
+            "latency_seconds": time.perf_counter() - started,
+            "llm_calls": len(counter.llm_token_counts),
+            "prompt_tokens": counter.prompt_llm_token_count,
+            "completion_tokens": counter.completion_llm_token_count,
+            "total_tokens": counter.total_llm_token_count
+        }
+
+    def synthesize(self, query: Union[str, QueryBundle], variant: Dict[str, Any]) -> Dict[str, Any]:
+        """以一種設定在共用的檢索結果上產生回答；合成失敗時記錄在 error 欄位"""
+        query_bundle = self._as_bundle(query)
+        nodes = self.retrieve(query_bundle)[:variant.get("top_k")]
+        synthesizer, counter = self._synthesizer(variant)
+
+        started = time.perf_counter()
+        try:
+            response = synthesizer.synthesize(query_bundle, nodes)
+        except Exception as e:
+            return self._result(variant, nodes, started, counter, error=f"{type(e).__name__}: {e}")
+        return self._result(variant, nodes, started, counter, response=response)
+
+    async def asynthesize(self, query: Union[str, QueryBundle], variant: Dict[str, Any]) -> Dict[str, Any]:
+        query_bundle = self._as_bundle(query)
+        nodes = (await self.aretrieve(query_bundle))[:variant.get("top_k")]
+        synthesizer, counter = self._synthesizer(variant)
+
+        started = time.perf_counter()
+        try:
+            response = await synthesizer.asynthesize(query_bundle, nodes)
+        except Exception as e:
+            return self._result(variant, nodes, started, counter, error=f"{type(e).__name__}: {e}")
+        return self._result(variant, nodes, started, counter, response=response)
+
+    def compare(
+        self,
+        query: Union[str, QueryBundle],
+        variants: Optional[Sequence[Dict[str, Any]]] = None
+    ) -> List[Dict[str, Any]]:
+        """檢索一次，再以執行緒池平行執行所有設定，結果順序與 variants 相同"""
+        variants = list(variants or DEFAULT_VARIANTS)
+        query_bundle = self._as_bundle(query)
+        self.retrieve(query_bundle)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(variants)) or 1) as executor:
+            return list(executor.map(lambda variant: self.synthesize(query_bundle, variant), variants))
+
+    async def acompare(
+        self,
+        query: Union[str, QueryBundle],
+        variants: Optional[Sequence[Dict[str, Any]]] = None
+    ) -> List[Dict[str, Any]]:
+        """非同步版本：各設定以 asynthesize 並行，同時進行的數量以 max_workers 限制"""
+        variants = list(variants or DEFAULT_VARIANTS)
+        query_bundle = self._as_bundle(query)
+        await self.aretrieve(query_bundle)
+
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run(variant):
+            async with semaphore:
+                return await self.asynthesize(query_bundle, variant)
+
+        return await asyncio.gather(*(run(variant) for variant in variants))
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """實際檢索次數與快取命中次數"""
+        with self._lock:
+            return {
+                "retrievals": self._retrievals,
+                "hits": self._hits,
+                "cached_queries": len(self._cache),
+                "cache_size": self.cache_size
+            }
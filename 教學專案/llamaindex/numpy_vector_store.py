@@ -0,0 +1,664 @@
+# numpy_vector_store.py - 以連續 NumPy 陣列儲存向量的記憶體內向量儲存
+#
+# SimpleVectorStore 把每個向量存成 Python float 串列（1536 維約 50 KB），
+# 持久化時再寫成 JSON。NumpyVectorStore 把所有向量放在一個連續陣列中，
+# 可選 float16 或 int8 純量量化（每個向量 3 KB / 1.5 KB），查詢時先以量化向量
+# 分塊計分取出候選，再用 float32 原始向量重新計分排序。float32 向量寫在磁碟檔
+# （未指定路徑時為暫存檔）並以記憶體映射讀取，常駐記憶體只有量化向量。
+#
+#   vector_store = NumpyVectorStore(dtype="int8", full_precision_path="./vectors.f32")
+#   storage_context = StorageContext.from_defaults(vector_store=vector_store)
+#   index = VectorStoreIndex.from_documents(documents, storage_context=storage_context)
+#
+# stores_text=True 時節點文字也存在本儲存中，可直接以 VectorStoreIndex.from_vector_store()
+# 使用。持久化格式為小型標頭 JSON、.npy 向量陣列與以位移索引的逐列紀錄檔，
+# 載入時全部以記憶體映射開啟，不解析任何節點，開啟時間與索引大小無關。
+import json
+import os
+import tempfile
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    DEFAULT_PERSIST_FNAME,
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult
+)
+from llama_index.core.vector_stores.utils import (
+    build_metadata_filter_fn,
+    metadata_dict_to_node,
+    node_to_metadata_dict
+)
+from metadata_index import MetadataIndex
+from record_file import RecordFile, write_records
+
+VECTOR_DTYPES = ("float32", "float16", "int8")
+PERSIST_FORMAT = "numpy_vector_store"
+PERSIST_VERSION = 2
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """將每一列正規化為單位向量（內積即為餘弦相似度）"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """量化 float32 向量，回傳 (編碼, int8 的每列縮放係數)"""
+    if dtype == "int8":
+        # 對稱量化：每列以最大絕對值對應到 127
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return vectors.astype(dtype), None
+
+def _remove_file(path: str, pid: int):
+    """刪除暫存檔；分叉出的子行程結束時不刪除父行程仍在使用的檔案"""
+    if os.getpid() == pid:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class _FullPrecisionVectors:
+    """重新計分用的 float32 向量：附加寫入磁碟檔，再以記憶體映射讀取
+
+    未指定路徑時寫入暫存檔（物件回收時刪除）。常駐記憶體只有量化向量，
+    重新計分時只有候選所在的頁面會被讀入。
+    """
+
+    def __init__(self, dim: int, path: Optional[str] = None):
+        self.dim = dim
+        self.path = path
+        self.size = 0
+        self._array = np.empty((0, dim), dtype=np.float32)
+        # _array 是否已全部寫在 path 中；載入的持久化陣列在第一次新增時才複製到可附加的檔案
+        self._on_disk = True
+        self._lock = threading.Lock()
+
+        # 新的儲存一律從空檔開始，避免沿用上次執行留下的向量
+        if path is not None:
+            open(path, "wb").close()
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "_FullPrecisionVectors":
+        """包裝已存在的（通常是記憶體映射的）陣列"""
+        full = cls(array.shape[1])
+        full._array = array
+        full.size = len(array)
+        full._on_disk = False
+        return full
+
+    def _ensure_file(self, copy_existing: bool = True):
+        """需要寫入時才建立暫存檔，並寫入還不在檔案中的既有向量"""
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(prefix="numpy_vector_store_", suffix=".f32")
+            os.close(fd)
+            weakref.finalize(self, _remove_file, self.path, os.getpid())
+        if not self._on_disk:
+            if copy_existing:
+                np.ascontiguousarray(self._array, dtype=np.float32).tofile(self.path)
+            self._on_disk = True
+
+    def append(self, vectors: np.ndarray):
+        with self._lock:
+            self._ensure_file()
+            with open(self.path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            # 下次讀取時重新映射到新的長度
+            self._array = None
+            self.size += len(vectors)
+
+    def matrix(self) -> np.ndarray:
+        with self._lock:
+            if self._array is None or len(self._array) != self.size:
+                self._array = (
+                    np.memmap(self.path, dtype=np.float32, mode="r", shape=(self.size, self.dim))
+                    if self.size else np.empty((0, self.dim), dtype=np.float32)
+                )
+            return self._array
+
+    def compact(self, keep: np.ndarray):
+        """只保留 keep 指定的列（依序）"""
+        kept = np.array(self.matrix()[keep])
+        with self._lock:
+            self._ensure_file(copy_existing=False)
+            self.size = len(kept)
+            tmp_path = f"{self.path}.tmp"
+            kept.tofile(tmp_path)
+            os.replace(tmp_path, self.path)
+            self._array = None
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """所有向量存放於單一連續陣列、支援 float16 / int8 量化與 float32 重新計分的向量儲存"""
+
+    stores_text: bool = False
+    dtype: str = "float32"
+    rescore: bool = True
+    rescore_multiplier: int = 4
+    block_size: int = 1024
+    # 以元數據索引將過濾條件轉為候選列；關閉時逐列判斷並掃描全部向量（比較基準用）
+    metadata_prefilter: bool = True
+    # 過濾後的候選列少於此比例時只取出這些列計分，否則掃描全部再套用遮罩
+    prefilter_fraction: float = 0.5
+    # query_many 每批分數矩陣（查詢數 × 列數）的元素上限，約 64 MB
+    score_block_elements: int = 1 << 24
+
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _codes: Optional[np.ndarray] = PrivateAttr(default=None)
+    _scales: Optional[np.ndarray] = PrivateAttr(default=None)
+    _full: Optional[_FullPrecisionVectors] = PrivateAttr(default=None)
+    _full_precision_path: Optional[str] = PrivateAttr(default=None)
+    _live: Optional[np.ndarray] = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0)
+    _num_deleted: int = PrivateAttr(default=0)
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[str] = PrivateAttr(default_factory=list)
+    _metadata: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _row_of: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _version: int = PrivateAttr(default=0)
+    _node_id_mask_cache: Tuple = PrivateAttr(default=(None, -1, None))
+    _metadata_index: MetadataIndex = PrivateAttr(default_factory=MetadataIndex)
+    _records: Optional[RecordFile] = PrivateAttr(default=None)
+    _rows_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(
+        self,
+        dtype: str = "float32",
+        rescore: bool = True,
+        full_precision_path: Optional[str] = None,
+        stores_text: bool = False,
+        **kwargs: Any
+    ):
+        """
+        初始化向量儲存
+
+        Args:
+            dtype: 常駐記憶體的向量型別：float32 / float16 / int8
+            rescore: 量化時是否保留 float32 向量，對候選重新計分
+            full_precision_path: float32 向量的磁碟檔；未指定時寫入暫存檔。兩者都以記憶體映射讀取，
+                記憶體只保留量化向量，重新計分時才讀取候選所在的頁面
+            stores_text: 是否連同節點文字一起儲存（查詢結果直接帶回節點，不需 docstore）
+        """
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(f"不支援的向量型別: {dtype}")
+        super().__init__(dtype=dtype, rescore=rescore, stores_text=stores_text, **kwargs)
+        self._full_precision_path = full_precision_path
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def uses_rescoring(self) -> bool:
+        """量化且保留了 float32 向量時才需要重新計分"""
+        return self.dtype != "float32" and self._full is not None
+
+    @property
+    def node_count(self) -> int:
+        """存活的向量數（不定義 __len__：空儲存會被 StorageContext 當成未提供）"""
+        return self._size - self._num_deleted
+
+    def _ensure_capacity(self, dim: int, extra: int):
+        """以倍增方式擴充連續陣列"""
+        if self._dim is None:
+            self._dim = dim
+            self._codes = np.empty((0, dim), dtype=self.dtype)
+            self._scales = np.empty(0, dtype=np.float32) if self.dtype == "int8" else None
+            self._live = np.empty(0, dtype=bool)
+            if self.rescore and self.dtype != "float32":
+                self._full = _FullPrecisionVectors(dim, self._full_precision_path)
+        elif dim != self._dim:
+            raise ValueError(f"向量維度不一致: {dim} != {self._dim}")
+
+        needed = self._size + extra
+        if needed <= len(self._codes):
+            return
+        capacity = max(needed, 2 * len(self._codes), 1024)
+
+        codes = np.empty((capacity, dim), dtype=self.dtype)
+        codes[:self._size] = self._codes[:self._size]
+        self._codes = codes
+        live = np.zeros(capacity, dtype=bool)
+        live[:self._size] = self._live[:self._size]
+        self._live = live
+        if self._scales is not None:
+            scales = np.empty(capacity, dtype=np.float32)
+            scales[:self._size] = self._scales[:self._size]
+            self._scales = scales
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """加入節點的向量；重複的 node_id 會先刪除舊向量"""
+        if not nodes:
+            return []
+
+        self._load_rows()
+        row_of = self._row_of
+        replaced = [row_of[node.node_id] for node in nodes if node.node_id in row_of]
+        if replaced:
+            self._delete_rows(replaced)
+
+        vectors = normalize_rows(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        self._ensure_capacity(vectors.shape[1], len(nodes))
+
+        start, end = self._size, self._size + len(nodes)
+        codes, scales = quantize(vectors, self.dtype)
+        self._codes[start:end] = codes
+        if scales is not None:
+            self._scales[start:end] = scales
+        self._live[start:end] = True
+        if self._full is not None:
+            self._full.append(vectors)
+
+        # 壓實後串列會被換掉，因此在刪除之後才取出
+        row_of, node_ids, ref_doc_ids, all_metadata = self._row_of, self._node_ids, self._ref_doc_ids, self._metadata
+        for row, node in enumerate(nodes, start):
+            metadata = node_to_metadata_dict(node, remove_text=not self.stores_text, flat_metadata=False)
+            if not self.stores_text:
+                metadata.pop("_node_content", None)
+            node_ids.append(node.node_id)
+            ref_doc_ids.append(node.ref_doc_id or "None")
+            all_metadata.append(metadata)
+            row_of[node.node_id] = row
+        self._size = end
+        self._version += 1
+        if self.metadata_prefilter:
+            # 匯入時逐批建立元數據索引，第一次過濾查詢不必等待
+            self._metadata_index.sync(all_metadata, end)
+        return [node.node_id for node in nodes]
+
+    def _load_rows(self):
+        """將持久化檔的逐列紀錄解碼為記憶體內串列
+
+        載入後只有查詢結果的列會被解碼；新增、刪除、依 node_id 或元數據過濾
+        需要全部列時才呼叫此方法一次。
+        """
+        if self._records is None:
+            return
+        with self._rows_lock:
+            records = self._records
+            if records is None:
+                return
+            node_ids, ref_doc_ids, all_metadata = [], [], []
+            for raw in records:
+                row = json.loads(raw)
+                node_ids.append(row["node_id"])
+                ref_doc_ids.append(row["ref_doc_id"])
+                all_metadata.append(row["metadata"])
+            self._node_ids, self._ref_doc_ids, self._metadata = node_ids, ref_doc_ids, all_metadata
+            self._row_of = {node_id: row for row, node_id in enumerate(node_ids)}
+            self._records = None
+
+    def _rows(self, rows: Sequence[int]) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """取得指定列的 (node_id, 元數據)；尚未解碼全部列時直接讀取紀錄檔"""
+        records = self._records
+        if records is None:
+            return [self._node_ids[row] for row in rows], [self._metadata[row] for row in rows]
+        decoded = [json.loads(records[int(row)]) for row in rows]
+        return [row["node_id"] for row in decoded], [row["metadata"] for row in decoded]
+
+    def _delete_rows(self, rows: List[int]):
+        """以墓碑標記刪除，刪除比例過高時壓實陣列"""
+        self._version += 1
+        for row in rows:
+            if self._live[row]:
+                self._live[row] = False
+                self._num_deleted += 1
+                del self._row_of[self._node_ids[row]]
+
+        if self._num_deleted > 1024 and self._num_deleted > self._size // 4:
+            self._compact()
+
+    def _compact(self):
+        """移除已刪除的列，重建連續陣列"""
+        keep = np.flatnonzero(self._live[:self._size])
+        self._codes = self._codes[keep]
+        if self._scales is not None:
+            self._scales = self._scales[keep]
+        if self._full is not None:
+            self._full.compact(keep)
+        self._node_ids = [self._node_ids[row] for row in keep]
+        self._ref_doc_ids = [self._ref_doc_ids[row] for row in keep]
+        self._metadata = [self._metadata[row] for row in keep]
+        self._row_of = {node_id: row for row, node_id in enumerate(self._node_ids)}
+        self._size = len(keep)
+        self._live = np.ones(self._size, dtype=bool)
+        self._num_deleted = 0
+        self._metadata_index.clear()
+        self._version += 1
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """刪除某份文件的所有節點"""
+        self._load_rows()
+        rows = [
+            row for row in range(self._size)
+            if self._live[row] and self._ref_doc_ids[row] == ref_doc_id
+        ]
+        self._delete_rows(rows)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any
+    ) -> None:
+        """依 node_id 與元數據過濾條件刪除節點"""
+        mask = self._candidate_mask(node_ids, filters)
+        rows = np.flatnonzero(mask if mask is not None else self._live[:self._size])
+        self._delete_rows(rows.tolist())
+
+    def clear(self) -> None:
+        """清空所有向量"""
+        if self._full is not None and self._full.path is not None and os.path.exists(self._full.path):
+            os.remove(self._full.path)
+        self._records = None
+        self._dim = None
+        self._codes = self._scales = self._full = self._live = None
+        self._size = self._num_deleted = 0
+        self._node_ids, self._ref_doc_ids, self._metadata = [], [], []
+        self._row_of = {}
+        self._metadata_index.clear()
+        self._version += 1
+
+    def _candidate_mask(self, node_ids: Optional[List[str]], filters: Optional[MetadataFilters]) -> Optional[np.ndarray]:
+        """依 node_id 限制與元數據過濾產生可用列的遮罩；不需過濾時回傳 None"""
+        if node_ids is None and filters is None:
+            return None if self._num_deleted == 0 else self._live[:self._size].copy()
+
+        self._load_rows()
+        mask = self._live[:self._size].copy()
+        if node_ids is not None:
+            mask &= self._node_id_mask(node_ids)
+        if filters is not None:
+            self._apply_filters(mask, filters)
+        elif mask.all():
+            return None
+        return mask
+
+    def _apply_filters(self, mask: np.ndarray, filters: MetadataFilters):
+        """以元數據索引將過濾條件轉為列遮罩並套用；索引不支援的條件改為逐列判斷"""
+        metadata = self._metadata
+        if self.metadata_prefilter:
+            self._metadata_index.sync(metadata, self._size)
+            matches = self._metadata_index.evaluate(filters, self._size)
+            if matches is not None:
+                mask &= matches
+                return
+
+        # 索引不支援的條件，或關閉預先過濾時，逐列判斷
+        filter_fn = build_metadata_filter_fn(lambda row: metadata[row], filters)
+        for row in np.flatnonzero(mask):
+            mask[row] = filter_fn(row)
+
+    def _node_id_mask(self, node_ids: List[str]) -> np.ndarray:
+        """node_id 清單對應的列遮罩
+
+        as_retriever() 每次查詢都傳入同一個列出全部節點的串列，
+        因此以串列本身與儲存的版本做快取，避免每次查詢都逐一查表。
+        """
+        cached_ids, cached_version, cached_mask = self._node_id_mask_cache
+        if cached_ids is node_ids and cached_version == self._version and len(cached_mask) == self._size:
+            return cached_mask
+
+        row_of = self._row_of
+        allowed = np.zeros(self._size, dtype=bool)
+        allowed[[row_of[node_id] for node_id in node_ids if node_id in row_of]] = True
+        self._node_id_mask_cache = (node_ids, self._version, allowed)
+        return allowed
+
+    def _scan(self, queries: np.ndarray) -> np.ndarray:
+        """分塊以 float32 計算每個查詢對所有列的分數（查詢數 × 列數），避免一次把整個量化陣列展開"""
+        if self.dtype == "float32":
+            return queries @ self._codes[:self._size].T
+
+        # 小區塊轉成 float32 後留在 CPU 快取中做矩陣乘法，緩衝區在區塊間重複使用
+        scores = np.empty((len(queries), self._size), dtype=np.float32)
+        buffer = np.empty((min(self.block_size, self._size), self._dim), dtype=np.float32)
+        for start in range(0, self._size, self.block_size):
+            end = min(start + self.block_size, self._size)
+            block = buffer[:end - start]
+            np.copyto(block, self._codes[start:end], casting="unsafe")
+            scores[:, start:end] = queries @ block.T
+        if self._scales is not None:
+            scores *= self._scales[:self._size]
+        return scores
+
+    def _score_rows(self, queries: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """只對指定的列計分（記憶體映射時只會讀取這些列所在的頁面）"""
+        scores = queries @ np.asarray(self._codes[rows], dtype=np.float32).T
+        if self._scales is not None:
+            scores *= self._scales[rows]
+        return scores
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """量化向量計分取候選，再以 float32 向量重新排序
+
+        有過濾條件時先以元數據索引算出候選列；候選夠少時只對這些列計分。
+        """
+        return self.query_many([query], **kwargs)[0]
+
+    def query_many(self, queries: Sequence[VectorStoreQuery], **kwargs: Any) -> List[VectorStoreQueryResult]:
+        """一次回答多個查詢，結果順序與輸入一致
+
+        查詢向量堆成矩陣，與向量陣列做一次矩陣乘法，再以 argpartition 逐列取 top-k；
+        node_ids 與過濾條件為同一個物件的查詢（同一個檢索器發出的查詢）共用候選遮罩。
+        """
+        for query in queries:
+            if query.mode != VectorStoreQueryMode.DEFAULT:
+                raise ValueError(f"NumpyVectorStore 不支援的查詢模式: {query.mode}")
+
+        results: List[Optional[VectorStoreQueryResult]] = [None] * len(queries)
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, query in enumerate(queries):
+            groups.setdefault((id(query.node_ids), id(query.filters)), []).append(i)
+
+        for positions in groups.values():
+            for position, result in zip(positions, self._query_group([queries[i] for i in positions])):
+                results[position] = result
+        return results
+
+    def _query_group(self, queries: List[VectorStoreQuery]) -> List[VectorStoreQueryResult]:
+        """node_ids 與過濾條件相同的一組查詢"""
+        empty = [VectorStoreQueryResult(similarities=[], ids=[]) for _ in queries]
+        if self._size == 0:
+            return empty
+
+        # 儲存文字時索引結構不記錄節點，as_retriever() 傳入的是空串列，視為不限制
+        node_ids = (queries[0].node_ids or None) if self.stores_text else queries[0].node_ids
+        mask = self._candidate_mask(node_ids, queries[0].filters)
+        available = self._size if mask is None else int(mask.sum())
+        top_ks = [min(query.similarity_top_k, available) for query in queries]
+        if max(top_ks) == 0:
+            return empty
+
+        if self.metadata_prefilter and mask is not None and available < self._size * self.prefilter_fraction:
+            rows = np.flatnonzero(mask)
+        else:
+            rows = None
+        num_candidates = max(
+            min(top_k * self.rescore_multiplier, available) if self.uses_rescoring else top_k
+            for top_k in top_ks
+        )
+
+        query_vectors = normalize_rows(np.asarray([query.query_embedding for query in queries], dtype=np.float32))
+        results = []
+        # 分數矩陣為 查詢數 × 列數，查詢多時分批以限制暫存記憶體
+        step = max(1, self.score_block_elements // (available if rows is not None else self._size))
+        for start in range(0, len(queries), step):
+            block = query_vectors[start:start + step]
+            if rows is not None:
+                scores = self._score_rows(block, rows)
+            else:
+                scores = self._scan(block)
+                if mask is not None:
+                    scores[:, ~mask] = -np.inf
+
+            picked = np.argpartition(-scores, num_candidates - 1, axis=1)[:, :num_candidates]
+            picked_scores = np.take_along_axis(scores, picked, axis=1)
+            if rows is not None:
+                picked = rows[picked]
+            for query_vector, top_k, candidates, candidate_scores in zip(
+                block, top_ks[start:start + step], picked, picked_scores
+            ):
+                results.append(self._finish_query(query_vector, top_k, candidates, candidate_scores))
+        return results
+
+    def _finish_query(
+        self,
+        query_vector: np.ndarray,
+        top_k: int,
+        candidates: np.ndarray,
+        candidate_scores: np.ndarray
+    ) -> VectorStoreQueryResult:
+        """對單一查詢的候選重新計分（量化時）並排序取 top-k"""
+        if top_k == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        if self.uses_rescoring:
+            # 只讀取候選所在的列，磁碟上的 float32 檔只有這些頁面會被載入
+            candidates = np.sort(candidates)
+            candidate_scores = np.asarray(self._full.matrix()[candidates]) @ query_vector
+
+        order = np.argsort(-candidate_scores)[:top_k]
+        top = candidates[order]
+        ids, metadata = self._rows(top)
+        return VectorStoreQueryResult(
+            nodes=[metadata_dict_to_node(row) for row in metadata] if self.stores_text else None,
+            similarities=[float(score) for score in candidate_scores[order]],
+            ids=ids
+        )
+
+    def get_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **kwargs: Any
+    ) -> List[BaseNode]:
+        """依 node_id 與元數據過濾取回節點（需 stores_text=True）"""
+        if not self.stores_text:
+            raise ValueError("NumpyVectorStore 未儲存節點文字，請改從 docstore 取得節點")
+        if self._size == 0:
+            return []
+        mask = self._candidate_mask(node_ids, filters)
+        rows = np.flatnonzero(mask if mask is not None else self._live[:self._size])
+        return [metadata_dict_to_node(row) for row in self._rows(rows)[1]]
+
+    def export_float32(self) -> Tuple[List[str], np.ndarray]:
+        """回傳存活節點的 (node_id, 正規化 float32 向量矩陣)"""
+        keep = np.flatnonzero(self._live[:self._size]) if self._size else np.empty(0, dtype=int)
+        node_ids = self._rows(keep)[0]
+        if self._full is not None:
+            return node_ids, np.asarray(self._full.matrix()[keep])
+        vectors = self._codes[keep].astype(np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[keep, None]
+        return node_ids, vectors
+
+    def memory_usage(self) -> Dict[str, int]:
+        """常駐記憶體中的向量位元組數；重新計分的 float32 向量在記憶體映射的檔案中，另列為 full_precision_file"""
+        vector_bytes = self._codes.nbytes if self._codes is not None else 0
+        scale_bytes = self._scales.nbytes if self._scales is not None else 0
+        full_bytes = self._full.size * self._full.dim * 4 if self._full is not None else 0
+        return {"vectors": vector_bytes, "scales": scale_bytes, "full_precision_file": full_bytes}
+
+    @staticmethod
+    def _companion_paths(persist_path: str) -> Dict[str, str]:
+        stem = os.path.splitext(persist_path)[0]
+        return {
+            "codes": f"{stem}.codes.npy",
+            "scales": f"{stem}.scales.npy",
+            "full": f"{stem}.f32.npy",
+            "rows": f"{stem}.rows"
+        }
+
+    @staticmethod
+    def _save_array(path: str, array: np.ndarray):
+        """寫到暫存檔再換上，避免覆寫目前正被映射的同名檔"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+    def persist(self, persist_path: str = os.path.join("./storage", DEFAULT_PERSIST_FNAME), fs=None) -> None:
+        """寫出向量 .npy、逐列紀錄檔，最後寫入標頭 JSON（只支援本機檔案系統）"""
+        self._load_rows()
+        if self._num_deleted:
+            self._compact()
+        os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+        paths = self._companion_paths(persist_path)
+
+        if self._size:
+            self._save_array(paths["codes"], self._codes[:self._size])
+            if self._scales is not None:
+                self._save_array(paths["scales"], self._scales[:self._size])
+            if self._full is not None:
+                self._save_array(paths["full"], np.asarray(self._full.matrix()))
+        write_records(paths["rows"], (
+            json.dumps(
+                {"node_id": node_id, "ref_doc_id": ref_doc_id, "metadata": metadata},
+                ensure_ascii=False
+            ).encode("utf-8")
+            for node_id, ref_doc_id, metadata in zip(self._node_ids, self._ref_doc_ids, self._metadata)
+        ))
+
+        # 標頭最後寫入，作為整組檔案的提交點
+        header = {
+            "format": PERSIST_FORMAT,
+            "version": PERSIST_VERSION,
+            "dtype": self.dtype,
+            "dim": self._dim,
+            "count": self._size,
+            "rescore": self._full is not None,
+            "stores_text": self.stores_text
+        }
+        tmp_path = f"{persist_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(header, f)
+        os.replace(tmp_path, persist_path)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, fs=None) -> "NumpyVectorStore":
+        """載入：所有陣列與逐列紀錄都以記憶體映射開啟，頁面在查詢用到時才載入
+
+        映射的陣列為唯讀，第一次新增向量時才複製到記憶體中。
+        """
+        with open(persist_path, encoding="utf-8") as f:
+            header = json.load(f)
+        if header.get("format") != PERSIST_FORMAT:
+            raise ValueError(f"{persist_path} 不是 NumpyVectorStore 的持久化檔")
+        if header.get("version") != PERSIST_VERSION:
+            raise ValueError(f"{persist_path} 的格式版本 {header.get('version')} 不受支援，請重新建立索引")
+
+        store = cls(dtype=header["dtype"], rescore=header["rescore"], stores_text=header["stores_text"])
+        if not header["count"]:
+            return store
+
+        paths = cls._companion_paths(persist_path)
+        records = RecordFile(paths["rows"])
+        if len(records) != header["count"]:
+            raise ValueError(f"{paths['rows']} 的列數與標頭不一致")
+
+        store._dim = header["dim"]
+        store._size = header["count"]
+        store._codes = np.load(paths["codes"], mmap_mode="r")
+        store._scales = np.load(paths["scales"], mmap_mode="r") if header["dtype"] == "int8" else None
+        store._live = np.ones(store._size, dtype=bool)
+        if header["rescore"]:
+            store._full = _FullPrecisionVectors.from_array(np.load(paths["full"], mmap_mode="r"))
+        store._records = records
+        return store
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: str = "default", fs=None) -> "NumpyVectorStore":
+        """從 StorageContext.persist() 的目錄載入"""
+        return cls.from_persist_path(os.path.join(persist_dir, f"{namespace}__{DEFAULT_PERSIST_FNAME}"))
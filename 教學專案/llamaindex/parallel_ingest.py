@@ -0,0 +1,245 @@
+# parallel_ingest.py - 多行程平行解析與切塊的串流匯入管線
+#
+# SimpleDirectoryReader.load_data() 依序解析所有檔案並全部留在記憶體，
+# SentenceSplitter 再以單一核心切塊。ParallelIngestPipeline 惰性地走訪目錄，
+# 在行程池中同時解析（PDF / DOCX / 文字檔由 SimpleDirectoryReader 依副檔名選擇讀取器）
+# 與切塊，每個檔案各有逾時限制；完成的節點立即交給呼叫端嵌入，
+# 行程池同時繼續處理後面的檔案，因此解析、切塊與嵌入互相重疊，
+# 而同時在處理中的檔案數有上限，記憶體用量不隨語料大小成長。
+#
+#   pipeline = ParallelIngestPipeline("sample_documents", chunk_size=1024, chunk_overlap=200)
+#   index = VectorStoreIndex(nodes=[])
+#   for batch in pipeline.iter_batches(1024):
+#       index.insert_nodes(batch)
+#   print(pipeline.stats)
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from llama_index.core import SimpleDirectoryReader
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode
+
+logger = logging.getLogger(__name__)
+
+class FileParseTimeout(TimeoutError):
+    """單一檔案的解析與切塊超過時限"""
+
+# 工作行程內的狀態，由 _init_worker 設定
+_worker_splitter: Optional[SentenceSplitter] = None
+_worker_timeout: Optional[float] = None
+
+def _raise_timeout(signum, frame):
+    raise FileParseTimeout(f"超過 {_worker_timeout} 秒")
+
+def _init_worker(split: bool, chunk_size: int, chunk_overlap: int, file_timeout: Optional[float]):
+    """每個工作行程只建立一次切塊器（分詞器載入成本高）"""
+    global _worker_splitter, _worker_timeout
+    _worker_splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap) if split else None
+    _worker_timeout = file_timeout
+    # 父行程按下 Ctrl+C 時由父行程負責關閉行程池
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if file_timeout and hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+
+def _pool_context():
+    """工作行程的啟動方式
+
+    匯入常在多執行緒的服務中執行（例如查詢持續進行時的藍綠重建）。直接 fork 會把其他執行緒
+    當下持有的鎖（日誌、stdout 緩衝區等）一併複製進子行程，子行程一用到就永遠卡住；
+    改由 forkserver 這個單執行緒的行程分叉。forkserver 預先匯入本模組，工作行程不必各自重新載入 llama_index。
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+def _process_file(path: str, filename_as_id: bool) -> List[BaseNode]:
+    """工作行程：解析單一檔案，需要時再切塊"""
+    use_alarm = bool(_worker_timeout) and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.setitimer(signal.ITIMER_REAL, _worker_timeout)
+    try:
+        documents = SimpleDirectoryReader(input_files=[path], filename_as_id=filename_as_id).load_data()
+        if _worker_splitter is None:
+            return documents
+        return _worker_splitter.get_nodes_from_documents(documents)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+class ParallelIngestPipeline:
+    """惰性走訪檔案、在行程池中平行解析與切塊，並依完成順序串流輸出節點"""
+
+    def __init__(
+        self,
+        input_dir: Optional[str] = None,
+        input_files: Optional[Sequence[str]] = None,
+        required_exts: Optional[Sequence[str]] = None,
+        recursive: bool = True,
+        exclude_hidden: bool = True,
+        split: bool = True,
+        chunk_size: int = 1024,
+        chunk_overlap: int = 200,
+        filename_as_id: bool = False,
+        max_workers: Optional[int] = None,
+        file_timeout: Optional[float] = 120.0,
+        max_in_flight: Optional[int] = None
+    ):
+        """
+        初始化匯入管線
+
+        Args:
+            input_dir: 要走訪的目錄（與 input_files 擇一）
+            input_files: 明確指定的檔案清單
+            required_exts: 只處理這些副檔名，例如 [".txt", ".pdf"]
+            split: 是否在工作行程內切塊；False 時輸出 Document
+            filename_as_id: 以檔名作為文件 ID（增量匯入時需要穩定的 ID）
+            max_workers: 工作行程數，預設為 CPU 核心數
+            file_timeout: 單一檔案的解析與切塊時限（秒），None 表示不限
+            max_in_flight: 同時送進行程池的檔案數上限（預設為工作行程數的兩倍），決定記憶體上限
+        """
+        if (input_dir is None) == (input_files is None):
+            raise ValueError("input_dir 與 input_files 必須擇一指定")
+        self.input_dir = input_dir
+        self.input_files = list(input_files) if input_files is not None else None
+        self.required_exts = {ext.lower() for ext in required_exts} if required_exts else None
+        self.recursive = recursive
+        self.exclude_hidden = exclude_hidden
+        self.split = split
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.filename_as_id = filename_as_id
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.file_timeout = file_timeout
+        self.max_in_flight = max_in_flight or 2 * self.max_workers
+        self.stats: Dict[str, Any] = {}
+        self.errors: List[Tuple[str, str]] = []
+
+    def iter_files(self) -> Iterator[str]:
+        """惰性走訪檔案，不必先列出整個目錄樹"""
+        if self.input_files is not None:
+            yield from self.input_files
+            return
+
+        stack = [self.input_dir]
+        while stack:
+            directory = stack.pop()
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+            subdirectories = []
+            for entry in entries:
+                if self.exclude_hidden and entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive:
+                        subdirectories.append(entry.path)
+                elif entry.is_file():
+                    if self.required_exts is None or os.path.splitext(entry.name)[1].lower() in self.required_exts:
+                        yield entry.path
+            # 反向推入堆疊，使子目錄依名稱順序處理
+            stack.extend(reversed(subdirectories))
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=_pool_context(),
+            initializer=_init_worker,
+            initargs=(self.split, self.chunk_size, self.chunk_overlap, self.file_timeout)
+        )
+
+    @staticmethod
+    def _kill_executor(executor: ProcessPoolExecutor):
+        """工作行程卡在無法被 SIGALRM 中斷的 C 程式碼時，只能終止整個行程池"""
+        # ProcessPoolExecutor 沒有公開終止工作行程的 API
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _record_failure(self, path: str, error: BaseException):
+        timed_out = isinstance(error, (FileParseTimeout, TimeoutError))
+        self.stats["timed_out" if timed_out else "failed"] += 1
+        self.errors.append((path, f"{type(error).__name__}: {error}"))
+        logger.warning(f"{'逾時' if timed_out else '解析失敗'}，略過檔案 {path}: {error}")
+
+    def __iter__(self) -> Iterator[Tuple[str, List[BaseNode]]]:
+        """依完成順序輸出 (檔案路徑, 節點或文件)；失敗或逾時的檔案記錄後略過"""
+        self.stats = {"files": 0, "failed": 0, "timed_out": 0, "items": 0, "seconds": 0.0}
+        self.errors = []
+        started = time.perf_counter()
+
+        # 工作行程內的 SIGALRM 是主要的逾時機制；這是它失效時（卡在 C 擴充中）的保險，
+        # 從送出算起，涵蓋在行程池佇列中等待的時間
+        hard_timeout = (
+            self.file_timeout * 2 * math.ceil(self.max_in_flight / self.max_workers)
+            if self.file_timeout else None
+        )
+
+        files = self.iter_files()
+        executor = self._new_executor()
+        pending: Dict[Any, Tuple[str, float]] = {}
+        try:
+            while True:
+                while len(pending) < self.max_in_flight:
+                    path = next(files, None)
+                    if path is None:
+                        break
+                    future = executor.submit(_process_file, path, self.filename_as_id)
+                    pending[future] = (path, time.monotonic())
+                if not pending:
+                    break
+
+                done, _ = wait(pending, timeout=self.file_timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, _ = pending.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        self._record_failure(path, e)
+                        continue
+                    self.stats["files"] += 1
+                    self.stats["items"] += len(items)
+                    yield path, items
+
+                if hard_timeout is None:
+                    continue
+                now = time.monotonic()
+                overdue = [future for future, (_, submitted) in pending.items() if now - submitted > hard_timeout]
+                if overdue:
+                    # 終止整個行程池，逾時的檔案記為失敗，其餘處理中的檔案重新送出
+                    self._kill_executor(executor)
+                    executor = self._new_executor()
+                    resubmit = []
+                    for future, (path, _) in list(pending.items()):
+                        if future in overdue:
+                            self._record_failure(path, FileParseTimeout(f"超過 {hard_timeout:.0f} 秒且無法中斷"))
+                        else:
+                            resubmit.append(path)
+                    pending = {
+                        executor.submit(_process_file, path, self.filename_as_id): (path, time.monotonic())
+                        for path in resubmit
+                    }
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.stats["seconds"] = time.perf_counter() - started
+
+    def iter_batches(self, batch_size: int = 1024) -> Iterator[List[BaseNode]]:
+        """累積到 batch_size 個節點就輸出一批，最後輸出剩餘的節點"""
+        batch: List[BaseNode] = []
+        for _, items in self:
+            batch.extend(items)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def load(self) -> List[BaseNode]:
+        """一次取得全部結果（小型語料用；大型語料請以迭代方式使用）"""
+        return [item for _, items in self for item in items]
@@ -0,0 +1,73 @@
+# record_file.py - 以位移索引隨機存取的唯讀紀錄檔
+#
+# 變長紀錄（例如節點文字與元數據的 JSON）依序寫入單一資料檔，
+# 另以 int64 .npy 記錄每筆紀錄的起始位移。開啟時只做記憶體映射、不解析內容，
+# 因此開啟時間與檔案大小無關；讀取第 i 筆時才載入該筆所在的頁面。
+#
+#   write_records("nodes.bin", (json.dumps(row).encode("utf-8") for row in rows))
+#   records = RecordFile("nodes.bin")
+#   row = json.loads(records[42])
+import mmap
+import os
+from typing import Iterable, Iterator
+
+import numpy as np
+
+def offsets_path(path: str) -> str:
+    """紀錄檔對應的位移索引檔路徑"""
+    return f"{path}.offsets.npy"
+
+def write_records(path: str, records: Iterable[bytes]) -> int:
+    """寫出紀錄檔與位移索引，回傳紀錄數
+
+    先寫到暫存檔再以 os.replace 換上，正在映射舊檔的讀取者不受影響。
+    """
+    offsets = [0]
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        for record in records:
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+
+    tmp_offsets_path = f"{offsets_path(path)}.tmp"
+    with open(tmp_offsets_path, "wb") as f:
+        np.save(f, np.asarray(offsets, dtype=np.int64))
+    os.replace(tmp_offsets_path, offsets_path(path))
+    os.replace(tmp_path, path)
+    return len(offsets) - 1
+
+class RecordFile:
+    """以記憶體映射開啟的紀錄檔，支援 len()、索引與迭代"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offsets = np.load(offsets_path(path), mmap_mode="r")
+        with open(path, "rb") as f:
+            # 空檔無法映射；映射建立後即可關閉檔案
+            size = os.fstat(f.fileno()).st_size
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        if int(self._offsets[-1]) != size:
+            raise ValueError(f"{path} 與位移索引不一致（{size} != {int(self._offsets[-1])} 位元組）")
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> bytes:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._data[int(self._offsets[index]):int(self._offsets[index + 1])]
+
+    def __iter__(self) -> Iterator[bytes]:
+        # 依序讀取時一次取出全部位移，避免逐筆存取映射陣列
+        offsets = np.asarray(self._offsets).tolist()
+        data = self._data
+        for start, end in zip(offsets, offsets[1:]):
+            yield data[start:end]
+
+    def close(self):
+        """釋放記憶體映射"""
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b""
+        self._offsets = np.zeros(1, dtype=np.int64)
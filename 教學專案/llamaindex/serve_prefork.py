@@ -0,0 +1,276 @@
+# serve_prefork.py - 多行程預先分叉（pre-fork）的 RAG 服務模式
+#
+# 父行程只建立或載入一次索引，將所有向量寫成唯讀的記憶體映射 .npy 檔，
+# 再分叉出 N 個工作行程共用同一個監聽埠提供 HTTP 查詢。
+# 向量頁面由作業系統在行程間共享，記憶體不會隨工作行程數倍增；
+# 相似度計分、節點後處理與回應格式化等 CPU 工作則可分散到多個核心。
+#
+#   python serve_prefork.py --workers 4 --port 8080
+#   curl -X POST localhost:8080/query -d '{"question": "什麼是人工智慧？"}'
+import argparse
+import gc
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from numpy_vector_store import NumpyVectorStore
+from faiss_vector_store import FaissANNVectorStore
+from sharded_vector_store import ShardedVectorStore
+from llama_index.core import QueryBundle, Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeWithScore
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+production = importlib.import_module("08_production_deployment")
+logger = logging.getLogger(__name__)
+
+class MmapVectorRetriever(BaseRetriever):
+    """在唯讀記憶體映射的向量矩陣上做暴力內積檢索"""
+
+    def __init__(self, vectors: np.ndarray, nodes: List[BaseNode], embed_model, similarity_top_k: int = 3):
+        """vectors 的第 i 列對應 nodes[i]，且已正規化為單位向量"""
+        super().__init__()
+        self._vectors = vectors
+        self._nodes = nodes
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+
+        query = np.asarray(query_bundle.embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = self._vectors @ query
+
+        top_k = min(self._similarity_top_k, len(scores))
+        if top_k == 0:
+            return []
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [NodeWithScore(node=self._nodes[i], score=float(scores[i])) for i in top]
+
+def export_index(index, vectors_path: str):
+    """將索引的向量寫成正規化的 float32 .npy，回傳與列順序對應的節點"""
+    vector_store = index.vector_store
+
+    if isinstance(vector_store, (NumpyVectorStore, FaissANNVectorStore)):
+        node_ids, embeddings = vector_store.export_float32()
+        nodes = vector_store.get_nodes(node_ids) if vector_store.stores_text else index.docstore.get_nodes(node_ids)
+    elif vector_store.stores_text:
+        # ChromaDB 等外部儲存：一次取回向量、文字與元數據（分片時逐一讀取各分片）
+        shards = vector_store.shards if isinstance(vector_store, ShardedVectorStore) else [vector_store]
+        nodes, embeddings = [], []
+        for shard in shards:
+            result = shard.client.get(include=["embeddings", "documents", "metadatas"])
+            nodes.extend(
+                metadata_dict_to_node(metadata, text=text)
+                for text, metadata in zip(result["documents"], result["metadatas"])
+            )
+            embeddings.extend(result["embeddings"])
+    else:
+        embedding_dict = vector_store.data.embedding_dict
+        node_ids = list(embedding_dict)
+        nodes = index.docstore.get_nodes(node_ids)
+        embeddings = [embedding_dict[node_id] for node_id in node_ids]
+
+    dim = len(embeddings[0]) if len(embeddings) else 0
+    matrix = np.lib.format.open_memmap(
+        vectors_path, mode="w+", dtype=np.float32, shape=(len(nodes), dim)
+    )
+    for row, embedding in enumerate(embeddings):
+        vector = np.asarray(embedding, dtype=np.float32)
+        matrix[row] = vector / (np.linalg.norm(vector) or 1.0)
+    matrix.flush()
+    del matrix
+
+    return nodes
+
+def _reset_http_clients(rag_system):
+    """分叉後不可沿用父行程的連線池，清掉快取的 API 用戶端讓子行程重新建立"""
+    # 查詢嵌入使用獨立的模型；帶快取或自適應批次的嵌入模型會一層層包著實際的 API 用戶端
+    components = []
+    for model in (Settings.embed_model, rag_system.embed_model, rag_system.query_embed_model):
+        while model is not None:
+            components.append(model)
+            model = getattr(model, "embed_model", None)
+    components.append(Settings.llm)
+
+    for component in components:
+        for attribute in ("_client", "_aclient", "_http_client", "_async_http_client"):
+            if getattr(component, attribute, None) is not None:
+                setattr(component, attribute, None)
+
+def make_handler(rag_system):
+    """建立綁定到此工作行程 rag_system 的請求處理類別"""
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload: Dict[str, Any]):
+            body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != "/query":
+                self._send_json(404, {"error": "not found"})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                question = json.loads(self.rfile.read(length) or b"{}").get("question", "")
+            except (ValueError, AttributeError):
+                self._send_json(400, {"success": False, "error": "請求格式錯誤"})
+                return
+
+            result = rag_system.query(question)
+            result["worker_pid"] = os.getpid()
+            self._send_json(200 if result["success"] else result.get("status_code", 500), result)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = rag_system.metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif self.path in ("/livez", "/readyz"):
+                probe = rag_system.liveness() if self.path == "/livez" else rag_system.readiness()
+                self._send_json(200 if probe["status"] in ("alive", "ready") else 503, probe)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+def run_worker(rag_system, listen_socket: socket.socket, vectors_path: str, nodes: List[BaseNode]):
+    """工作行程：以共享的監聽 socket 提供 HTTP 服務，直到被父行程終止"""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _reset_http_clients(rag_system)
+
+    # mmap_mode="r" 只映射檔案，頁面在用到時才載入，且所有工作行程共享
+    vectors = np.load(vectors_path, mmap_mode="r")
+    # 父行程已清空記憶體內的向量，查詢與就緒探針都必須改用記憶體映射的檢索器
+    rag_system.replace_retriever(MmapVectorRetriever(
+        vectors,
+        nodes,
+        rag_system.query_embed_model,
+        similarity_top_k=rag_system.config.get("similarity_top_k", 3)
+    ))
+
+    server = ThreadingHTTPServer(
+        listen_socket.getsockname(), make_handler(rag_system), bind_and_activate=False
+    )
+    server.socket.close()
+    server.socket = listen_socket
+    logger.info(f"工作行程 {os.getpid()} 開始服務")
+    server.serve_forever()
+
+def serve(config: Dict[str, Any], host: str = "127.0.0.1", port: int = 8080, workers: Optional[int] = None, serve_dir: str = "./prefork_index"):
+    """父行程：建立索引、匯出向量、分叉工作行程並在其異常結束時補上"""
+    if not hasattr(os, "fork"):
+        raise RuntimeError("預先分叉模式需要支援 os.fork 的作業系統")
+
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(serve_dir, exist_ok=True)
+    vectors_path = os.path.join(serve_dir, "vectors.npy")
+
+    rag_system = production.ProductionRAGSystem(config)
+    nodes = export_index(rag_system.index, vectors_path)
+    logger.info(f"已匯出 {len(nodes)} 個向量至 {vectors_path}")
+
+    # 記憶體內向量已改由 .npy 提供，釋放原本的 Python 串列；
+    # 其餘物件凍結在 GC 之外，避免子行程因 GC 觸碰物件而複製共享頁面
+    vector_store = rag_system.index.vector_store
+    if isinstance(vector_store, (NumpyVectorStore, FaissANNVectorStore)):
+        vector_store.clear()
+    elif not vector_store.stores_text:
+        vector_store.data.embedding_dict.clear()
+    gc.collect()
+    gc.freeze()
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(1024)
+    logger.info(f"預先分叉服務啟動: http://{host}:{listen_socket.getsockname()[1]} ({workers} 個工作行程)")
+
+    children = set()
+    shutting_down = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(rag_system, listen_socket, vectors_path, nodes)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def shutdown(*_):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not shutting_down:
+            logger.warning(f"工作行程 {pid} 結束 (狀態 {status})，重新啟動")
+            spawn()
+
+    listen_socket.close()
+
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="ProductionRAGSystem 預先分叉服務")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None, help="工作行程數，預設為 CPU 核心數")
+    parser.add_argument("--documents-dir", default="sample_documents")
+    parser.add_argument("--serve-dir", default="./prefork_index", help="向量檔輸出目錄")
+    parser.add_argument("--use-chroma", action="store_true")
+    parser.add_argument("--fake-backends", action="store_true", help="使用 fake_backends 替身（離線測試用）")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    config = {
+        "documents_dir": args.documents_dir,
+        "use_chroma": args.use_chroma,
+        "similarity_top_k": 3,
+        "response_mode": "compact"
+    }
+    if args.fake_backends:
+        from fake_backends import install_fake_backends
+        install_fake_backends()
+        config["embedding_provider"] = "settings"
+
+    serve(config, host=args.host, port=args.port, workers=args.workers, serve_dir=args.serve_dir)
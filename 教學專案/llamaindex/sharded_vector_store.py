@@ -0,0 +1,207 @@
+# sharded_vector_store.py - 將節點雜湊分片到多個向量儲存，查詢時並行扇出再合併
+#
+# 單一 Chroma 集合的匯入與查詢延遲都隨資料量成長。ShardedVectorStore 依文件 ID 的
+# 穩定雜湊把節點分配到 N 個子儲存（例如 N 個 Chroma 集合或 N 個持久化路徑），
+# 匯入時各分片並行寫入；查詢時同時向所有分片要 top-k，再以堆積合併各分片已排序的結果，
+# 因此單次查詢延遲取決於最大的分片，而不是整個知識庫。
+#
+#   shards = [ChromaVectorStore(chroma_collection=client.get_or_create_collection(f"kb_shard{i}")) for i in range(4)]
+#   vector_store = ShardedVectorStore(shards)
+#   index = VectorStoreIndex.from_vector_store(vector_store)
+import asyncio
+import hashlib
+import heapq
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+from pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult
+)
+
+def shard_for(key: str, num_shards: int) -> int:
+    """穩定的分片編號（內建 hash() 每個行程的種子不同，不能用於持久化的分片）"""
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % num_shards
+
+class ShardedVectorStore(BasePydanticVectorStore):
+    """把節點雜湊分片到多個子向量儲存的轉接層"""
+
+    stores_text: bool = True
+
+    _shards: List[BasePydanticVectorStore] = PrivateAttr()
+    _max_workers: int = PrivateAttr()
+    _executor: Optional[ThreadPoolExecutor] = PrivateAttr(default=None)
+    _executor_pid: Optional[int] = PrivateAttr(default=None)
+
+    def __init__(self, shards: Sequence[BasePydanticVectorStore], max_workers: Optional[int] = None, **kwargs: Any):
+        """
+        初始化分片儲存
+
+        Args:
+            shards: 子向量儲存；分片數與順序必須與建立時相同，否則節點會被分到錯的分片
+            max_workers: 扇出的執行緒數，預設為分片數
+        """
+        if not shards:
+            raise ValueError("至少需要一個分片")
+        if len({shard.stores_text for shard in shards}) != 1:
+            raise ValueError("所有分片的 stores_text 必須相同")
+        super().__init__(stores_text=shards[0].stores_text, **kwargs)
+        self._shards = list(shards)
+        self._max_workers = max_workers or len(shards)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ShardedVectorStore"
+
+    @property
+    def client(self) -> List[Any]:
+        """各分片的底層用戶端"""
+        return [shard.client for shard in self._shards]
+
+    @property
+    def shards(self) -> List[BasePydanticVectorStore]:
+        return self._shards
+
+    def shard_of(self, node: BaseNode) -> int:
+        """依文件 ID 分片，同一文件的節點在同一分片，delete(ref_doc_id) 只需碰一個分片"""
+        return shard_for(node.ref_doc_id or node.node_id, len(self._shards))
+
+    def _partition(self, nodes: Sequence[BaseNode]) -> Dict[int, List[BaseNode]]:
+        groups: Dict[int, List[BaseNode]] = {}
+        for node in nodes:
+            groups.setdefault(self.shard_of(node), []).append(node)
+        return groups
+
+    def _pool(self) -> ThreadPoolExecutor:
+        """扇出用的執行緒池；分叉後子行程沒有父行程的執行緒，需重新建立"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="vector-shard")
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _fan_out(self, calls: Dict[int, Any]) -> Dict[int, Any]:
+        """在執行緒池中同時執行 {分片: 無參數函式}，回傳 {分片: 結果}"""
+        if len(calls) == 1:
+            shard, call = next(iter(calls.items()))
+            return {shard: call()}
+        pool = self._pool()
+        futures = {shard: pool.submit(call) for shard, call in calls.items()}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    async def _afan_out(self, calls: Dict[int, Any]) -> Dict[int, Any]:
+        """非同步版本：子儲存的同步 API 放到執行緒池，避免預設的 async 方法在事件迴圈中依序執行"""
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        results = await asyncio.gather(*(loop.run_in_executor(pool, call) for call in calls.values()))
+        return dict(zip(calls, results))
+
+    def _add_calls(self, nodes: Sequence[BaseNode], add_kwargs: Dict[str, Any]) -> Dict[int, Any]:
+        return {
+            shard: (lambda shard=shard, group=group: self._shards[shard].add(group, **add_kwargs))
+            for shard, group in self._partition(nodes).items()
+        }
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """各分片並行寫入，回傳與輸入順序相同的 ID"""
+        if not nodes:
+            return []
+        self._fan_out(self._add_calls(nodes, add_kwargs))
+        return [node.node_id for node in nodes]
+
+    async def async_add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        await self._afan_out(self._add_calls(nodes, add_kwargs))
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """刪除某份文件的所有節點（只在該文件所屬的分片上執行）"""
+        self._shards[shard_for(ref_doc_id, len(self._shards))].delete(ref_doc_id, **delete_kwargs)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any
+    ) -> None:
+        """節點 ID 無法對應分片，所有分片都執行"""
+        self._fan_out({
+            shard: (lambda store=store: store.delete_nodes(node_ids, filters, **delete_kwargs))
+            for shard, store in enumerate(self._shards)
+        })
+
+    def clear(self) -> None:
+        self._fan_out({shard: store.clear for shard, store in enumerate(self._shards)})
+
+    def get_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None
+    ) -> List[BaseNode]:
+        results = self._fan_out({
+            shard: (lambda store=store: store.get_nodes(node_ids, filters))
+            for shard, store in enumerate(self._shards)
+        })
+        return [node for shard in sorted(results) for node in results[shard]]
+
+    def _query_calls(self, query: VectorStoreQuery, kwargs: Dict[str, Any]) -> Dict[int, Any]:
+        return {
+            shard: (lambda store=store: store.query(query, **kwargs))
+            for shard, store in enumerate(self._shards)
+        }
+
+    @staticmethod
+    def _merge(results: List[VectorStoreQueryResult], top_k: int) -> VectorStoreQueryResult:
+        """以堆積合併各分片依分數遞減排序的結果，取全域 top-k"""
+        streams = []
+        for result in results:
+            similarities = result.similarities or []
+            ids = result.ids or []
+            nodes = result.nodes or [None] * len(ids)
+            # 多數儲存已依分數排序，這裡仍排序一次以免個別儲存不保證順序
+            streams.append(sorted(zip(similarities, ids, nodes), key=lambda hit: -hit[0]))
+
+        merged = list(itertools.islice(heapq.merge(*streams, key=lambda hit: -hit[0]), top_k))
+        return VectorStoreQueryResult(
+            nodes=[node for _, _, node in merged] if any(result.nodes for result in results) else None,
+            similarities=[score for score, _, _ in merged],
+            ids=[node_id for _, node_id, _ in merged]
+        )
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """同時向所有分片查詢 top-k 再合併"""
+        results = self._fan_out(self._query_calls(query, kwargs))
+        return self._merge([results[shard] for shard in sorted(results)], query.similarity_top_k)
+
+    def query_many(self, queries: Sequence[VectorStoreQuery], **kwargs: Any) -> List[VectorStoreQueryResult]:
+        """每個分片一次回答全部查詢（支援 query_many 的分片以矩陣批次計分），再逐一查詢合併"""
+        def shard_query_many(store):
+            if hasattr(store, "query_many"):
+                return store.query_many(queries, **kwargs)
+            return [store.query(query, **kwargs) for query in queries]
+
+        results = self._fan_out({
+            shard: (lambda store=store: shard_query_many(store))
+            for shard, store in enumerate(self._shards)
+        })
+        return [
+            self._merge([results[shard][i] for shard in sorted(results)], query.similarity_top_k)
+            for i, query in enumerate(queries)
+        ]
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        results = await self._afan_out(self._query_calls(query, kwargs))
+        return self._merge([results[shard] for shard in sorted(results)], query.similarity_top_k)
+
+    def close(self):
+        """停止扇出用的執行緒池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,52 @@
+# 測試直接匯入教學專案目錄下的輔助模組（與範例腳本相同的匯入方式）
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_backends import install_fake_backends
+
+SAMPLE_DOCUMENTS = {
+    "sample_ai.txt": "人工智慧（AI）是電腦科學的一個分支。機器學習是 AI 的子領域。深度學習使用神經網路。\n" * 20,
+    "sample_tech.txt": "雲端計算提供 IaaS、PaaS 與 SaaS。AWS、Azure 與 GCP 是主要供應商，具成本效益與可擴展性。\n" * 20
+}
+
+@pytest.fixture(scope="session")
+def production(tmp_path_factory):
+    """08_production_deployment 模組；匯入時會在目前目錄建立日誌檔，因此在暫存目錄中匯入"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("production"))
+    try:
+        return importlib.import_module("08_production_deployment")
+    finally:
+        os.chdir(cwd)
+
+@pytest.fixture
+def fake_backends():
+    """全域 Settings 換成確定性的嵌入與 LLM 替身"""
+    return install_fake_backends(embed_dim=32)
+
+@pytest.fixture
+def documents_dir(tmp_path):
+    path = tmp_path / "documents"
+    path.mkdir()
+    for name, text in SAMPLE_DOCUMENTS.items():
+        (path / name).write_text(text, encoding="utf-8")
+    return str(path)
+
+@pytest.fixture
+def production_config(tmp_path, documents_dir, fake_backends):
+    """使用替身後端、記憶體索引的最小 ProductionRAGSystem 設定"""
+    return {
+        "embedding_provider": "settings",
+        "documents_dir": documents_dir,
+        "chunk_size": 128,
+        "chunk_overlap": 10,
+        "embedding_cache": False,
+        "use_chroma": False,
+        "query_timeout": 5.0,
+        "chroma_path": str(tmp_path / "chroma")
+    }
@@ -0,0 +1,125 @@
+# adaptive_embedding.py 的排程器：等待時阻塞而不空轉、只重試可重試的錯誤、共用執行緒池
+import asyncio
+import concurrent.futures
+import time
+
+import pytest
+
+import adaptive_embedding
+from adaptive_embedding import AdaptiveBatchEmbedding, is_retryable, pack_by_tokens
+from fake_backends import FakeEmbedding, FakeRateLimitError, LatencyModel
+
+class HTTPError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+class FlakyEmbedding(FakeEmbedding):
+    """依序丟出 errors 中的錯誤，之後才正常回傳"""
+
+    def __init__(self, errors, **kwargs):
+        super().__init__(embed_dim=8, **kwargs)
+        self.__dict__["_errors"] = list(errors)
+        self.__dict__["calls"] = 0
+
+    def _get_text_embeddings(self, texts):
+        self.__dict__["calls"] += 1
+        if self._errors:
+            raise self._errors.pop(0)
+        return super()._get_text_embeddings(texts)
+
+def slow_model(delay: float = 0.2) -> AdaptiveBatchEmbedding:
+    """每批固定延遲、每批一筆，並行數固定為 2，8 批需要 4 輪往返"""
+    return AdaptiveBatchEmbedding(
+        FakeEmbedding(embed_dim=8, text_latency=LatencyModel("constant", delay)),
+        max_batch_size=1,
+        initial_concurrency=2,
+        max_concurrency=2,
+        report_interval=3600
+    )
+
+def test_pack_by_tokens_respects_budget_and_size():
+    assert pack_by_tokens([3, 3, 3, 10, 1], max_batch_tokens=6, max_batch_size=10) == [[0, 1], [2], [3], [4]]
+    assert pack_by_tokens([1] * 5, max_batch_tokens=100, max_batch_size=2) == [[0, 1], [2, 3], [4]]
+
+def test_is_retryable():
+    assert is_retryable(FakeRateLimitError())
+    assert is_retryable(HTTPError(503))
+    assert is_retryable(TimeoutError())
+    assert not is_retryable(HTTPError(401))
+    assert not is_retryable(HTTPError(400))
+    assert not is_retryable(ValueError("bad input"))
+
+def test_scheduler_blocks_while_all_slots_busy(monkeypatch):
+    calls = []
+    original_wait = concurrent.futures.wait
+
+    def counting_wait(*args, **kwargs):
+        calls.append(kwargs.get("timeout"))
+        return original_wait(*args, **kwargs)
+
+    monkeypatch.setattr(adaptive_embedding, "wait", counting_wait)
+    model = slow_model()
+    started = time.process_time()
+    vectors = model.get_text_embedding_batch([f"text {i}" for i in range(8)])
+
+    assert len(vectors) == 8 and all(vectors)
+    # 每次 wait 至少等到一批完成：次數不超過批次數，且都不帶逾時
+    assert len(calls) <= 8
+    assert all(timeout is None for timeout in calls)
+    assert time.process_time() - started < 0.5
+
+def test_async_scheduler_blocks_while_all_slots_busy(monkeypatch):
+    calls = []
+    original_wait = asyncio.wait
+
+    async def counting_wait(*args, **kwargs):
+        calls.append(kwargs.get("timeout"))
+        return await original_wait(*args, **kwargs)
+
+    monkeypatch.setattr(asyncio, "wait", counting_wait)
+    model = slow_model()
+    vectors = asyncio.run(model.aget_text_embedding_batch([f"text {i}" for i in range(8)]))
+
+    assert len(vectors) == 8 and all(vectors)
+    assert len(calls) <= 8
+    assert all(timeout is None for timeout in calls)
+
+def test_auth_errors_are_not_retried():
+    inner = FlakyEmbedding([HTTPError(401)])
+    model = AdaptiveBatchEmbedding(inner, initial_concurrency=4, backoff=0.01)
+
+    with pytest.raises(HTTPError):
+        model.get_text_embedding_batch(["a", "b"])
+    assert inner.calls == 1
+    assert model.ingest_stats()["concurrency_limit"] == 4
+    assert model.ingest_stats()["retries"] == 0
+
+def test_server_errors_are_retried_with_backoff():
+    inner = FlakyEmbedding([HTTPError(503), FakeRateLimitError()])
+    model = AdaptiveBatchEmbedding(inner, initial_concurrency=4, backoff=0.01)
+
+    vectors = model.get_text_embedding_batch(["a", "b"])
+    assert len(vectors) == 2 and all(vectors)
+    assert inner.calls == 3
+    stats = model.ingest_stats()
+    assert stats["retries"] == 2
+    assert stats["rate_limited"] == 1
+    assert stats["concurrency_limit"] < 4
+
+def test_gives_up_after_max_retries():
+    inner = FlakyEmbedding([HTTPError(500)] * 3)
+    model = AdaptiveBatchEmbedding(inner, max_retries=2, backoff=0.01)
+
+    with pytest.raises(HTTPError):
+        model.get_text_embedding_batch(["a"])
+    assert inner.calls == 3
+
+def test_executor_is_reused_across_calls():
+    model = slow_model(delay=0.0)
+    model.get_text_embedding_batch(["a", "b"])
+    pool = model._pool()
+    model.get_text_embedding_batch(["c", "d"])
+    assert model._pool() is pool
+    model.close()
+    assert model._executor is None
@@ -0,0 +1,82 @@
+# 08 的 AdmissionController：並行上限、有上限的等待佇列、逾時與取消不會洩漏名額
+import asyncio
+import threading
+import time
+
+import pytest
+
+def test_rejects_when_queue_is_full(production):
+    controller = production.AdmissionController(max_in_flight=1, max_queue_depth=0)
+    controller.acquire(time.time() + 1)
+    with pytest.raises(production.QueryRejectedError) as error:
+        controller.acquire(time.time() + 1)
+    assert (error.value.status_code, error.value.reason) == (429, "queue_full")
+    controller.release()
+    assert controller.in_flight == 0
+
+def test_release_hands_slot_to_waiters_in_order(production):
+    controller = production.AdmissionController(max_in_flight=1, max_queue_depth=4)
+    controller.acquire(time.time() + 5)
+    order = []
+
+    def worker(name):
+        controller.acquire(time.time() + 5)
+        order.append(name)
+
+    threads = []
+    for name in ("a", "b"):
+        thread = threading.Thread(target=worker, args=(name,))
+        thread.start()
+        threads.append(thread)
+        while controller.queue_depth < len(threads):
+            time.sleep(0.001)
+
+    for thread in threads:
+        controller.release()
+        thread.join(timeout=5)
+    assert order == ["a", "b"]
+    # 名額直接轉交，整段期間並行數不超過上限
+    assert controller.in_flight == 1
+    controller.release()
+    assert controller.in_flight == 0
+
+def test_queue_timeout_removes_waiter(production):
+    controller = production.AdmissionController(max_in_flight=1, max_queue_depth=4)
+    controller.acquire(time.time() + 1)
+    with pytest.raises(production.QueryRejectedError) as error:
+        controller.acquire(time.time() + 0.05)
+    assert error.value.reason == "queue_timeout"
+    assert controller.queue_depth == 0
+    controller.release()
+    assert controller.in_flight == 0
+
+def test_release_skips_expired_waiters(production):
+    controller = production.AdmissionController(max_in_flight=1, max_queue_depth=4)
+    controller.acquire(time.time() + 1)
+    expired = production._AdmissionWaiter(time.time() - 1, lambda: pytest.fail("逾期的等待者不應被放行"))
+    controller._waiting.append(expired)
+    controller.release()
+    assert not expired.granted
+    assert (controller.in_flight, controller.queue_depth) == (0, 0)
+
+def test_async_waiter_is_granted_and_cancel_does_not_leak(production):
+    controller = production.AdmissionController(max_in_flight=1, max_queue_depth=4)
+
+    async def scenario():
+        await controller.aacquire(time.time() + 5)
+        granted = asyncio.ensure_future(controller.aacquire(time.time() + 5))
+        cancelled = asyncio.ensure_future(controller.aacquire(time.time() + 5))
+        await asyncio.sleep(0.01)
+        assert controller.queue_depth == 2
+
+        # 從其他執行緒釋放（同步查詢路徑），名額交給第一個非同步等待者
+        threading.Thread(target=controller.release).start()
+        await asyncio.wait_for(granted, timeout=5)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert controller.queue_depth == 0
+        controller.release()
+
+    asyncio.run(scenario())
+    assert controller.in_flight == 0
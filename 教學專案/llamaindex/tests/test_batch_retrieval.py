@@ -0,0 +1,99 @@
+# batch_retrieval.py：批次檢索與逐一檢索結果相同、查詢嵌入不經過匯入用的包裝、缺少內部方法時退回逐一檢索
+import asyncio
+
+import numpy as np
+import pytest
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.schema import QueryBundle, TextNode
+
+import batch_retrieval
+from adaptive_embedding import AdaptiveBatchEmbedding
+from batch_retrieval import BatchVectorIndexRetriever, embed_query_batch
+from embedding_cache import CachedEmbedding
+from fake_backends import FakeEmbedding
+from numpy_vector_store import NumpyVectorStore
+
+QUESTIONS = [f"term{i} term{i + 1} term{(i * 7) % 40}" for i in range(12)]
+
+class CountingEmbedding(FakeEmbedding):
+    """記錄每次文字嵌入呼叫的批次大小"""
+
+    def __init__(self, **kwargs):
+        super().__init__(embed_dim=32, **kwargs)
+        self.__dict__["text_calls"] = []
+
+    def _get_text_embeddings(self, texts):
+        self.text_calls.append(len(texts))
+        return super()._get_text_embeddings(texts)
+
+def build_index(embed_model, vector_store=None):
+    rng = np.random.default_rng(0)
+    nodes = [
+        TextNode(id_=f"n{i}", text=" ".join(f"term{j}" for j in rng.integers(0, 40, 6)))
+        for i in range(200)
+    ]
+    storage_context = StorageContext.from_defaults(vector_store=vector_store or NumpyVectorStore())
+    return VectorStoreIndex(nodes, storage_context=storage_context, embed_model=embed_model)
+
+def node_ids(results):
+    return [[node.node_id for node in nodes] for nodes in results]
+
+@pytest.mark.parametrize("vector_store", [None, NumpyVectorStore(dtype="int8")], ids=["simple", "numpy-int8"])
+def test_retrieve_many_matches_retrieve(vector_store):
+    embed_model = CountingEmbedding()
+    index = build_index(embed_model, vector_store)
+    retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=5)
+
+    expected = node_ids(retriever.retrieve(question) for question in QUESTIONS)
+    embed_model.text_calls.clear()
+    assert node_ids(retriever.retrieve_many(QUESTIONS)) == expected
+    assert embed_model.text_calls == [len(QUESTIONS)]
+    assert node_ids(asyncio.run(retriever.aretrieve_many(QUESTIONS))) == expected
+
+def test_multi_string_bundle_is_embedded_once():
+    embed_model = CountingEmbedding()
+    index = build_index(embed_model)
+    bundle = QueryBundle("term1", custom_embedding_strs=["term1 term2", "term3", "term4 term5", "term6"])
+
+    for aggregation in batch_retrieval.EMBEDDING_AGGREGATIONS:
+        retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=5, embedding_aggregation=aggregation)
+        embed_model.text_calls.clear()
+        assert len(retriever.retrieve(bundle)) == 5
+        assert embed_model.text_calls == [4]
+    # 呼叫端的查詢束不被寫入嵌入，可以換一種合併方式重複使用
+    assert bundle.embedding is None
+
+def test_query_embedding_bypasses_ingest_wrappers(tmp_path):
+    base = CountingEmbedding()
+    adaptive = AdaptiveBatchEmbedding(base, report_interval=3600)
+    cached = CachedEmbedding(adaptive, cache_path=str(tmp_path / "cache.db"))
+    index = build_index(cached)
+    ingest = adaptive.ingest_stats()
+    assert ingest["chunks"] == 200
+
+    base.text_calls.clear()
+    retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=5)
+    retriever.retrieve_many(QUESTIONS)
+    embed_query_batch(cached, QUESTIONS)
+
+    # 查詢直接呼叫最內層的模型：匯入進度、批次數與 AIMD 狀態都不變，也不寫入嵌入快取
+    assert base.text_calls == [len(QUESTIONS), len(QUESTIONS)]
+    after = adaptive.ingest_stats()
+    assert (after["chunks"], after["batches"], after["concurrency_limit"]) == (
+        ingest["chunks"], ingest["batches"], ingest["concurrency_limit"]
+    )
+    assert cached.cache_stats()["misses"] == 200
+
+def test_falls_back_to_per_query_retrieve_without_internals(monkeypatch):
+    embed_model = CountingEmbedding()
+    index = build_index(embed_model)
+    expected = node_ids(
+        BatchVectorIndexRetriever.from_index(index, similarity_top_k=5).retrieve(question) for question in QUESTIONS
+    )
+
+    monkeypatch.setattr(batch_retrieval, "_RETRIEVER_INTERNALS", batch_retrieval._RETRIEVER_INTERNALS + ("_removed_in_this_version",))
+    retriever = BatchVectorIndexRetriever.from_index(index, similarity_top_k=5)
+    assert not retriever._batch_supported
+    assert node_ids(retriever.retrieve_many(QUESTIONS)) == expected
+    assert node_ids(retriever.retrieve_many(QUESTIONS, top_k=2)) == [ids[:2] for ids in expected]
+    assert node_ids(asyncio.run(retriever.aretrieve_many(QUESTIONS))) == expected
@@ -0,0 +1,110 @@
+# ProductionRAGSystem 的藍綠重建：建立中的版本不影響服務、切換與回滾、鎖外清理舊版本
+import threading
+
+import pytest
+
+def test_rebuild_does_not_touch_serving_components(production, production_config, monkeypatch):
+    rag = production.ProductionRAGSystem({**production_config, "similarity_cutoff": 0.0})
+    serving = rag.active_version
+    postprocessors = serving.node_postprocessors
+    synthesizer = serving.response_synthesizer
+    assert len(postprocessors) == 1
+
+    building = threading.Event()
+    release = threading.Event()
+
+    def blocked_smoke_test(version):
+        building.set()
+        release.wait(10)
+        return {"passed": False, "min_nodes": 1, "checks": []}
+
+    monkeypatch.setattr(rag, "_smoke_test", blocked_smoke_test)
+    thread = rag.start_rebuild()
+    assert building.wait(10)
+    try:
+        # 新版本已建立完元件但尚未驗證：服務中的查詢仍使用舊版本的全部元件
+        assert rag.active_version is serving
+        assert rag.node_postprocessors is postprocessors and len(postprocessors) == 1
+        assert rag.response_synthesizer is synthesizer
+        assert rag.query("雲端運算的優勢有哪些？")["success"]
+    finally:
+        release.set()
+        thread.join(10)
+
+    assert rag.last_rebuild["success"] is False
+    assert rag.active_version is serving
+    assert rag.node_postprocessors is postprocessors and len(postprocessors) == 1
+
+def test_rebuild_switches_and_rollback_restores(production, production_config):
+    rag = production.ProductionRAGSystem(production_config)
+    initial = rag.active_version
+
+    result = rag.rebuild()
+    assert result["success"], result
+    rebuilt = rag.active_version
+    assert rebuilt is not initial
+    assert rag.retriever is rebuilt.retriever
+    assert list(rag._previous_versions) == [initial]
+    assert rag.query("什麼是機器學習？")["success"]
+
+    assert rag.rollback()["version"] == initial.name
+    assert rag.active_version is initial and rag.retriever is initial.retriever
+    assert rag.rollback()["version"] == rebuilt.name
+    assert rag.active_version is rebuilt
+
+def test_rebuild_and_rollback_are_mutually_exclusive(production, production_config, monkeypatch):
+    rag = production.ProductionRAGSystem(production_config)
+    building = threading.Event()
+    release = threading.Event()
+    smoke_test = rag._smoke_test
+
+    def blocked_smoke_test(version):
+        building.set()
+        release.wait(10)
+        return smoke_test(version)
+
+    monkeypatch.setattr(rag, "_smoke_test", blocked_smoke_test)
+    thread = rag.start_rebuild()
+    assert building.wait(10)
+    try:
+        with pytest.raises(RuntimeError):
+            rag.rollback()
+        with pytest.raises(RuntimeError):
+            rag.rebuild()
+    finally:
+        release.set()
+        thread.join(10)
+    assert rag.last_rebuild["success"]
+
+def test_retired_versions_drain_in_the_background(production, production_config, monkeypatch):
+    rag = production.ProductionRAGSystem({**production_config, "index_keep_previous": 0, "query_timeout": 1.0})
+    initial = rag.active_version
+    dropped = []
+    monkeypatch.setattr(rag, "_drop_storage", lambda location: dropped.append(location))
+
+    # 新版本一上線 rebuild() 就返回，不等舊版本的查詢期限
+    result = rag.rebuild()
+    assert result["success"]
+    assert result["seconds"] < 1.0
+    assert not rag._rebuild_lock.locked()
+    # 舊版本名稱保留給清理，不會被新版本重用
+    assert initial.version in rag._draining_versions
+    assert dropped == []
+
+    for thread in rag._drain_threads:
+        thread.join(10)
+    assert dropped == [initial.location]
+    assert not rag._draining_versions
+
+def test_chroma_failure_fails_rebuild_instead_of_falling_back(production, production_config, monkeypatch):
+    rag = production.ProductionRAGSystem({**production_config, "use_chroma": True})
+    serving = rag.active_version
+
+    def broken(location):
+        raise ConnectionError("chroma unavailable")
+
+    monkeypatch.setattr(rag, "_open_chroma_collections", broken)
+    result = rag.rebuild()
+    assert result["success"] is False
+    assert "chroma unavailable" in result["error"]
+    assert rag.active_version is serving
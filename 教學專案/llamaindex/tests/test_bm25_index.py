@@ -0,0 +1,97 @@
+# bm25_index.py：待合併節點併入 CSR 倒排串列、刪除、持久化，以及混合檢索的 RRF 合併
+import pytest
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.retrievers import VectorIndexRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from bm25_index import BM25Index, BM25Retriever, HybridRetriever, reciprocal_rank_fusion, tokenize
+from fake_backends import FakeEmbedding
+
+TEXTS = [
+    "機器學習是人工智慧的子領域",
+    "深度學習使用神經網路",
+    "雲端計算提供 IaaS PaaS SaaS",
+    "AWS Azure GCP 是主要的雲端供應商",
+    "神經網路由多層神經元組成",
+    "人工智慧應用於醫療與金融"
+]
+
+def make_nodes(texts, start=0):
+    return [TextNode(id_=f"n{start + i}", text=text) for i, text in enumerate(texts)]
+
+def build(nodes, batches=1):
+    index = BM25Index()
+    size = -(-len(nodes) // batches)
+    for i in range(0, len(nodes), size):
+        index.add(nodes[i:i + size])
+        # 每批之後查詢一次，強制把待合併節點併入倒排串列
+        index.search("人工智慧")
+    return index
+
+def results(index, query, top_k=10):
+    return [(index.node_id(row), round(score, 5)) for row, score in index.search(query, top_k)]
+
+@pytest.mark.parametrize("query", ["人工智慧", "神經網路", "雲端", "aws"])
+def test_incremental_merge_matches_single_build(query):
+    nodes = make_nodes(TEXTS)
+    assert results(build(nodes, batches=3), query) == results(build(nodes), query)
+
+def test_vocabulary_and_pending_nodes_are_merged_before_search():
+    index = build(make_nodes(TEXTS[:3]))
+    index.add(make_nodes(TEXTS[3:], start=3))
+    assert [node_id for node_id, _ in results(index, "aws")] == ["n3"]
+    assert index.vocabulary_size == len({token for text in TEXTS for token in tokenize(text)})
+    assert index.node_count == len(TEXTS)
+
+def test_delete_merged_and_pending_nodes():
+    index = build(make_nodes(TEXTS[:3]))
+    index.add(make_nodes(TEXTS[3:], start=3))
+    index.delete_nodes(["n1", "n4"])
+    assert results(index, "神經網路") == []
+    assert index.node_count == len(TEXTS) - 2
+
+    # 重新加入同一個 ID 取代舊內容
+    index.add([TextNode(id_="n0", text="量子計算")])
+    assert [node_id for node_id, _ in results(index, "人工智慧")] == ["n5"]
+    assert [node_id for node_id, _ in results(index, "量子")] == ["n0"]
+
+def test_persist_round_trip_after_deletes(tmp_path):
+    index = build(make_nodes(TEXTS), batches=2)
+    index.delete_nodes(["n2"])
+    index.persist(str(tmp_path))
+
+    loaded = BM25Index.from_persist_dir(str(tmp_path))
+    for query in ["人工智慧", "神經網路", "雲端"]:
+        assert results(loaded, query) == results(index, query)
+    loaded.add(make_nodes(["雲端原生架構"], start=len(TEXTS)))
+    assert [node_id for node_id, _ in results(loaded, "雲端")][0] == f"n{len(TEXTS)}"
+
+def test_reciprocal_rank_fusion_uses_ranks_only():
+    nodes = make_nodes(["a", "b", "c"])
+    vector = [NodeWithScore(node=nodes[0], score=0.9), NodeWithScore(node=nodes[1], score=0.8)]
+    keyword = [NodeWithScore(node=nodes[1], score=42.0), NodeWithScore(node=nodes[2], score=30.0)]
+
+    fused = reciprocal_rank_fusion([vector, keyword], top_k=3, k=60.0)
+    assert [result.node.node_id for result in fused] == ["n1", "n0", "n2"]
+    assert fused[0].score == pytest.approx(1 / 62 + 1 / 61)
+    assert fused[1].score == pytest.approx(1 / 61)
+    assert len(reciprocal_rank_fusion([vector, keyword], top_k=1)) == 1
+
+def test_hybrid_retriever_reuses_query_embedding(fake_backends, monkeypatch):
+    keyword_index = BM25Index()
+    nodes = make_nodes(TEXTS)
+    keyword_index.add(nodes)
+    index = VectorStoreIndex(nodes)
+    hybrid = HybridRetriever(
+        VectorIndexRetriever(index=index, similarity_top_k=3),
+        BM25Retriever.from_vector_index(index, keyword_index, similarity_top_k=3),
+        similarity_top_k=3
+    )
+    calls = []
+    original = FakeEmbedding._get_query_embedding
+    monkeypatch.setattr(FakeEmbedding, "_get_query_embedding", lambda self, query: calls.append(query) or original(self, query))
+
+    query = "神經網路"
+    bundle = QueryBundle(query_str=query, embedding=Settings.embed_model.get_query_embedding(query))
+    assert "n1" in {result.node.node_id for result in hybrid.retrieve(bundle)}
+    assert calls == [query]
@@ -0,0 +1,73 @@
+# embedding_cache.py：命中不再呼叫上游、同批重複文字只送一次、未命中的文字整批交給自適應批次
+import asyncio
+
+from adaptive_embedding import AdaptiveBatchEmbedding
+from embedding_cache import CachedEmbedding
+from fake_backends import FakeEmbedding
+
+class CountingEmbedding(FakeEmbedding):
+    """記錄每次文字嵌入呼叫的批次大小"""
+
+    def __init__(self, **kwargs):
+        super().__init__(embed_dim=16, **kwargs)
+        self.__dict__["text_calls"] = []
+
+    def _get_text_embeddings(self, texts):
+        self.text_calls.append(len(texts))
+        return super()._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts):
+        self.text_calls.append(len(texts))
+        return await super()._aget_text_embeddings(texts)
+
+def test_hits_skip_upstream_and_duplicates_are_sent_once(tmp_path):
+    base = CountingEmbedding()
+    cached = CachedEmbedding(base, cache_path=str(tmp_path / "cache.db"))
+    texts = [f"text {i % 20}" for i in range(30)]
+
+    first = cached.get_text_embedding_batch(texts)
+    assert sum(base.text_calls) == 20
+    second = cached.get_text_embedding_batch(texts)
+    assert sum(base.text_calls) == 20
+    assert first == second
+    stats = cached.cache_stats()
+    assert (stats["hits"], stats["misses"]) == (30, 20)
+
+def test_misses_are_split_by_inner_batch_size(tmp_path):
+    base = CountingEmbedding(embed_batch_size=10)
+    cached = CachedEmbedding(base, cache_path=str(tmp_path / "cache.db"))
+    cached.get_text_embedding_batch([f"text {i}" for i in range(25)])
+    assert base.text_calls == [10, 10, 5]
+
+def test_adaptive_inner_model_receives_all_misses_at_once(tmp_path, monkeypatch):
+    base = CountingEmbedding()
+    adaptive = AdaptiveBatchEmbedding(base, max_batch_size=100, initial_concurrency=4, report_interval=3600)
+    cached = CachedEmbedding(adaptive, cache_path=str(tmp_path / "cache.db"))
+    calls = []
+    original = AdaptiveBatchEmbedding._get_text_embeddings
+
+    def record(self, texts):
+        calls.append(len(texts))
+        return original(self, texts)
+
+    monkeypatch.setattr(AdaptiveBatchEmbedding, "_get_text_embeddings", record)
+    texts = [f"text {i}" for i in range(5000)]
+    cached.get_text_embedding_batch(texts[:1000])
+    calls.clear()
+    base.text_calls.clear()
+
+    # 5000 筆超過外層的 embed_batch_size（2048），仍是一次快取查詢、一次交給自適應批次
+    vectors = cached.get_text_embedding_batch(texts)
+    assert len(vectors) == 5000
+    assert calls == [4000]
+    assert base.text_calls == [100] * 40
+
+def test_async_path_matches_sync(tmp_path):
+    sync_cached = CachedEmbedding(CountingEmbedding(embed_batch_size=7), cache_path=str(tmp_path / "a.db"))
+    async_base = CountingEmbedding(embed_batch_size=7)
+    async_cached = CachedEmbedding(async_base, cache_path=str(tmp_path / "b.db"))
+    texts = [f"text {i}" for i in range(20)]
+
+    expected = sync_cached.get_text_embedding_batch(texts)
+    assert asyncio.run(async_cached.aget_text_embedding_batch(texts)) == expected
+    assert sorted(async_base.text_calls) == [6, 7, 7]
@@ -0,0 +1,93 @@
+# numpy_vector_store.py：量化向量的 float32 重新計分、記憶體映射的重新計分檔與持久化
+import gc
+import os
+
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from numpy_vector_store import NumpyVectorStore, normalize_rows
+
+DIM = 32
+
+@pytest.fixture(scope="module")
+def vectors():
+    return normalize_rows(np.random.default_rng(0).standard_normal((500, DIM)).astype(np.float32))
+
+def make_nodes(vectors, start=0):
+    return [
+        TextNode(id_=f"n{start + i}", text=f"chunk {start + i}", embedding=vector.tolist())
+        for i, vector in enumerate(vectors)
+    ]
+
+def exact_top_k(vectors, query, k, offset=0):
+    scores = vectors @ query
+    return [f"n{offset + i}" for i in np.argsort(-scores)[:k]]
+
+def query_ids(store, query, k=10):
+    return store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=k)).ids
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_store_keeps_only_codes_resident(vectors, dtype):
+    store = NumpyVectorStore(dtype=dtype)
+    store.add(make_nodes(vectors))
+
+    # 未指定路徑時 float32 向量寫在暫存檔並以記憶體映射讀取
+    assert isinstance(store._full.matrix(), np.memmap)
+    usage = store.memory_usage()
+    itemsize = np.dtype(dtype).itemsize
+    assert usage["vectors"] < 2 * len(vectors) * DIM * itemsize + 1024 * DIM * itemsize
+    assert usage["full_precision_file"] == len(vectors) * DIM * 4
+    assert os.path.getsize(store._full.path) == len(vectors) * DIM * 4
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_rescoring_matches_float32_ranking(vectors, dtype):
+    store = NumpyVectorStore(dtype=dtype, rescore_multiplier=8)
+    store.add(make_nodes(vectors))
+    for query in vectors[:20]:
+        assert query_ids(store, query) == exact_top_k(vectors, query, 10)
+
+def test_temporary_rescore_file_is_removed_with_the_store(vectors):
+    store = NumpyVectorStore(dtype="int8")
+    store.add(make_nodes(vectors[:10]))
+    path = store._full.path
+    assert os.path.exists(path)
+    del store
+    gc.collect()
+    assert not os.path.exists(path)
+
+def test_explicit_rescore_path_is_used(vectors, tmp_path):
+    path = str(tmp_path / "vectors.f32")
+    store = NumpyVectorStore(dtype="float16", full_precision_path=path)
+    store.add(make_nodes(vectors[:50]))
+    assert store._full.path == path
+    assert os.path.getsize(path) == 50 * DIM * 4
+
+def test_delete_compacts_rescore_vectors(vectors, tmp_path):
+    store = NumpyVectorStore(dtype="int8", rescore_multiplier=8)
+    store.add(make_nodes(vectors))
+    store.delete_nodes([f"n{i}" for i in range(0, 500, 2)])
+    store.persist(str(tmp_path / "store.json"))
+
+    kept = vectors[1::2]
+    for query in vectors[:10]:
+        expected = [f"n{2 * int(i[1:]) + 1}" for i in exact_top_k(kept, query, 10)]
+        assert query_ids(store, query) == expected
+
+def test_persisted_store_accepts_new_vectors(vectors, tmp_path):
+    persist_path = str(tmp_path / "store.json")
+    store = NumpyVectorStore(dtype="int8", rescore_multiplier=8)
+    store.add(make_nodes(vectors[:300]))
+    store.persist(persist_path)
+
+    loaded = NumpyVectorStore.from_persist_path(persist_path)
+    assert isinstance(loaded._full.matrix(), np.memmap)
+    for query in vectors[:5]:
+        assert query_ids(loaded, query) == exact_top_k(vectors[:300], query, 10)
+
+    # 第一次新增時把載入的 float32 向量複製到可附加的暫存檔，舊向量仍參與重新計分
+    loaded.add(make_nodes(vectors[300:], start=300))
+    assert isinstance(loaded._full.matrix(), np.memmap)
+    for query in vectors[:20]:
+        assert query_ids(loaded, query) == exact_top_k(vectors, query, 10)
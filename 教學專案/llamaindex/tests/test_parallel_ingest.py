@@ -0,0 +1,45 @@
+# parallel_ingest.py：在多執行緒的服務中匯入（例如查詢進行中的藍綠重建），工作行程不可繼承其他執行緒持有的鎖
+import logging
+import multiprocessing
+import threading
+
+import pytest
+
+from parallel_ingest import ParallelIngestPipeline, _pool_context
+
+pytestmark = pytest.mark.skipif(
+    "forkserver" not in multiprocessing.get_all_start_methods(), reason="需要 forkserver 啟動方式"
+)
+
+def test_workers_start_while_another_thread_holds_a_lock(documents_dir):
+    assert _pool_context().get_start_method() == "forkserver"
+
+    # os.fork 會先取得 logging 的模組鎖；直接 fork 時，這裡的匯入會一直等到鎖被釋放
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold_logging_lock():
+        with logging._lock:
+            holding.set()
+            release.wait(timeout=60)
+
+    holder = threading.Thread(target=hold_logging_lock, daemon=True)
+    holder.start()
+    holding.wait(timeout=5)
+    result = {}
+
+    def ingest():
+        pipeline = ParallelIngestPipeline(documents_dir, chunk_size=128, chunk_overlap=10, max_workers=2)
+        result["nodes"] = sum(len(batch) for batch in pipeline.iter_batches(64))
+        result["stats"] = pipeline.stats
+
+    worker = threading.Thread(target=ingest, daemon=True)
+    worker.start()
+    worker.join(timeout=30)
+    finished = not worker.is_alive()
+    release.set()
+    holder.join(timeout=5)
+
+    assert finished, "匯入卡在分叉工作行程"
+    assert result["nodes"] > 0
+    assert result["stats"]["failed"] == result["stats"]["timed_out"] == 0
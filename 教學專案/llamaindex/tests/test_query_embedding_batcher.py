@@ -0,0 +1,72 @@
+# 08 的 QueryEmbeddingBatcher：批次滿時立即送出、並行請求合併成一次呼叫、錯誤分送給整批
+import asyncio
+import threading
+import time
+
+import pytest
+
+class Recorder:
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        if self.error is not None:
+            raise self.error
+        return [[float(len(text))] for text in texts]
+
+    async def acall(self, texts):
+        return self(texts)
+
+def make_batcher(production, recorder, **kwargs):
+    return production.QueryEmbeddingBatcher(recorder, recorder.acall, **kwargs)
+
+def test_full_batch_of_one_is_sent_without_waiting(production):
+    recorder = Recorder()
+    batcher = make_batcher(production, recorder, max_batch_size=1, max_wait=2.0)
+
+    started = time.perf_counter()
+    assert batcher.embed("abc") == [3.0]
+    assert asyncio.run(batcher.aembed("abcd")) == [4.0]
+    assert time.perf_counter() - started < 0.5
+    assert recorder.batches == [["abc"], ["abcd"]]
+
+def test_concurrent_sync_requests_share_one_call(production):
+    recorder = Recorder()
+    batcher = make_batcher(production, recorder, max_batch_size=8, max_wait=2.0)
+    results = {}
+    barrier = threading.Barrier(8)
+
+    def request(i):
+        barrier.wait()
+        results[i] = batcher.embed("x" * i)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    # 第 8 筆填滿批次，不必等到 max_wait
+    assert time.perf_counter() - started < 1.5
+    assert results == {i: [float(i)] for i in range(8)}
+    assert sorted(len(batch) for batch in recorder.batches) == [8]
+
+def test_concurrent_async_requests_share_one_call(production):
+    recorder = Recorder()
+    batcher = make_batcher(production, recorder, max_batch_size=32, max_wait=0.05)
+
+    async def run():
+        return await asyncio.gather(*(batcher.aembed("x" * i) for i in range(5)))
+
+    assert asyncio.run(run()) == [[float(i)] for i in range(5)]
+    assert len(recorder.batches) == 1
+
+def test_errors_reach_every_waiter(production):
+    batcher = make_batcher(production, Recorder(error=RuntimeError("upstream down")), max_batch_size=1, max_wait=0.01)
+    with pytest.raises(RuntimeError):
+        batcher.embed("a")
+    with pytest.raises(RuntimeError):
+        asyncio.run(batcher.aembed("a"))
@@ -0,0 +1,58 @@
+# 08 的 SemanticAnswerCache：門檻、LRU 淘汰，以及過期項目不遮住其他有效命中
+import numpy as np
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def test_hit_requires_similarity_threshold(production):
+    cache = production.SemanticAnswerCache(similarity_threshold=0.95, max_entries=4, ttl=None)
+    cache.store(unit(1, 0, 0), "a")
+    assert cache.lookup(unit(1, 0.1, 0)) == "a"
+    assert cache.lookup(unit(1, 1, 0)) is None
+
+def test_expired_best_match_does_not_hide_a_fresh_hit(production, monkeypatch):
+    cache = production.SemanticAnswerCache(similarity_threshold=0.9, max_entries=4, ttl=10.0)
+    now = [1000.0]
+    monkeypatch.setattr(production.time, "time", lambda: now[0])
+
+    cache.store(unit(1, 0, 0), "stale")
+    now[0] += 8
+    cache.store(unit(1, 0.3, 0), "fresh")
+    now[0] += 5
+
+    # 最相似的 "stale" 已過期，仍高於門檻的 "fresh" 應該命中
+    query = unit(1, 0.05, 0)
+    assert float(unit(1, 0, 0) @ query) > float(unit(1, 0.3, 0) @ query) > 0.9
+    assert cache.lookup(query) == "fresh"
+    assert len(cache) == 1
+
+def test_expired_entries_free_slots_before_lru_eviction(production, monkeypatch):
+    cache = production.SemanticAnswerCache(similarity_threshold=0.99, max_entries=2, ttl=10.0)
+    now = [1000.0]
+    monkeypatch.setattr(production.time, "time", lambda: now[0])
+
+    cache.store(unit(1, 0, 0), "old")
+    now[0] += 8
+    cache.store(unit(0, 1, 0), "live")
+    now[0] += 1
+    # "old" 最近被使用過，但在下一次寫入時已過期；應該讓出它的槽位，而不是淘汰仍有效的 "live"
+    assert cache.lookup(unit(1, 0, 0)) == "old"
+    now[0] += 4
+    cache.store(unit(0, 0, 1), "new")
+
+    assert cache.lookup(unit(0, 1, 0)) == "live"
+    assert cache.lookup(unit(0, 0, 1)) == "new"
+    assert cache.lookup(unit(1, 0, 0)) is None
+    assert len(cache) == 2
+
+def test_lru_eviction_when_full(production):
+    cache = production.SemanticAnswerCache(similarity_threshold=0.99, max_entries=2, ttl=None)
+    cache.store(unit(1, 0, 0), "a")
+    cache.store(unit(0, 1, 0), "b")
+    assert cache.lookup(unit(1, 0, 0)) == "a"
+    cache.store(unit(0, 0, 1), "c")
+
+    assert cache.lookup(unit(0, 1, 0)) is None
+    assert cache.lookup(unit(1, 0, 0)) == "a"
+    assert cache.lookup(unit(0, 0, 1)) == "c"
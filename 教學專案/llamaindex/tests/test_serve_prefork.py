@@ -0,0 +1,110 @@
+# serve_prefork.py：父行程匯出向量並分叉工作行程，工作行程的查詢與就緒探針都使用記憶體映射的檢索器
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from adaptive_embedding import AdaptiveBatchEmbedding
+from embedding_cache import CachedEmbedding
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_SCRIPT = """
+import sys
+from fake_backends import install_fake_backends
+import serve_prefork
+
+install_fake_backends(embed_dim=32)
+config = {
+    "embedding_provider": "settings",
+    "documents_dir": sys.argv[1],
+    "chunk_size": 128,
+    "chunk_overlap": 10,
+    "embedding_cache": False,
+    "use_chroma": False,
+    "similarity_top_k": 3,
+    "response_mode": "compact"
+}
+serve_prefork.serve(config, port=int(sys.argv[2]), workers=1, serve_dir=sys.argv[3])
+"""
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def request(url, payload=None):
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def test_reset_http_clients_covers_query_embed_model(production, fake_backends, tmp_path):
+    import serve_prefork  # production 夾具已在暫存目錄匯入 08，這裡不會在專案目錄建立日誌檔
+
+    ingest_client = OpenAIEmbedding(api_key="test")
+    query_client = OpenAIEmbedding(api_key="test")
+    for model in (ingest_client, query_client):
+        model._client = model._aclient = object()
+    rag_system = SimpleNamespace(
+        embed_model=CachedEmbedding(AdaptiveBatchEmbedding(ingest_client), cache_path=str(tmp_path / "cache.db")),
+        query_embed_model=query_client
+    )
+
+    serve_prefork._reset_http_clients(rag_system)
+    for model in (ingest_client, query_client):
+        assert model._client is None and model._aclient is None
+
+@pytest.fixture
+def prefork_server(tmp_path, documents_dir):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT, documents_dir, str(port), str(tmp_path / "serve")],
+        cwd=str(tmp_path),
+        env={**os.environ, "PYTHONPATH": PROJECT_DIR}
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 60
+        while True:
+            if process.poll() is not None:
+                pytest.fail(f"服務行程提前結束（狀態 {process.returncode}）")
+            try:
+                status, _ = request(f"{base_url}/livez")
+                if status == 200:
+                    break
+            except OSError:
+                pass
+            if time.time() > deadline:
+                pytest.fail("服務未在期限內啟動")
+            time.sleep(0.2)
+        yield base_url
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="預先分叉模式需要 os.fork")
+def test_worker_answers_from_mmap_vectors(prefork_server):
+    status, readiness = request(f"{prefork_server}/readyz")
+    assert status == 200
+    assert readiness["vector_store"]["nodes"] > 0
+
+    status, result = request(f"{prefork_server}/query", {"question": "什麼是機器學習？"})
+    assert status == 200, result
+    assert result["success"]
+    assert result["source_nodes"] > 0
+    assert result["worker_pid"] != os.getpid()
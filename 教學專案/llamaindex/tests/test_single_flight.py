@@ -0,0 +1,169 @@
+# 08 的 SingleFlight：相同鍵值同時抵達只執行一次，錯誤與取消的處理
+import asyncio
+import threading
+import time
+
+import pytest
+
+class CountingEvent(threading.Event):
+    """記錄進入等待的執行緒數，讓測試在追隨者確實排隊後才放行領頭者"""
+
+    def __init__(self):
+        super().__init__()
+        self.waiters = 0
+        self._count_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with self._count_lock:
+            self.waiters += 1
+        return super().wait(timeout)
+
+def start_leader(flight, key, fn, target):
+    """啟動領頭者並在它執行 fn 時換上 CountingEvent"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def leader_fn():
+        started.set()
+        release.wait(timeout=5)
+        return fn()
+
+    leader = threading.Thread(target=target, args=(leader_fn,))
+    leader.start()
+    started.wait(timeout=5)
+    event = flight._calls[key].event = CountingEvent()
+    return leader, event, release
+
+def wait_for_waiters(event, count):
+    while event.waiters < count:
+        time.sleep(0.001)
+
+def test_concurrent_callers_share_one_execution(production):
+    flight = production.SingleFlight()
+    calls = []
+    results = []
+
+    def fn():
+        calls.append(1)
+        return "answer"
+
+    def call(fn):
+        results.append(flight.do("q", fn))
+
+    leader, event, release = start_leader(flight, "q", fn, call)
+    followers = [threading.Thread(target=call, args=(fn,)) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    wait_for_waiters(event, len(followers))
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(timeout=5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [("answer", False)] + [("answer", True)] * 4
+    # 完成後移出執行中表，下一次請求重新執行
+    assert flight.do("q", lambda: "fresh") == ("fresh", False)
+
+def test_error_is_raised_to_every_waiter(production):
+    flight = production.SingleFlight()
+    errors = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    def call(fn):
+        try:
+            flight.do("q", fn)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    leader, event, release = start_leader(flight, "q", fail, call)
+    follower = threading.Thread(target=call, args=(fail,))
+    follower.start()
+    wait_for_waiters(event, 1)
+    release.set()
+    leader.join(timeout=5)
+    follower.join(timeout=5)
+    assert errors == ["boom", "boom"]
+    assert flight._calls == {}
+
+def test_follower_times_out_at_its_deadline(production):
+    flight = production.SingleFlight()
+    outcome = []
+
+    def call(fn):
+        outcome.append(flight.do("q", fn, deadline=time.time() + 0.2))
+
+    leader, event, release = start_leader(flight, "q", lambda: "answer", call)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        flight.do("q", lambda: pytest.fail("追隨者不應執行"), deadline=time.time() + 0.2)
+    assert time.monotonic() - started < 2.0
+    assert event.waiters == 1
+
+    # 領頭者不受追隨者逾時影響
+    release.set()
+    leader.join(timeout=5)
+    assert outcome == [("answer", False)]
+
+def test_coalesced_query_returns_504_when_leader_hangs(production, production_config, monkeypatch):
+    rag = production.ProductionRAGSystem({**production_config, "query_timeout": 0.3})
+    entered = threading.Event()
+    release = threading.Event()
+    original = rag._run_query_pipeline
+
+    def hanging_pipeline(question):
+        entered.set()
+        release.wait(timeout=10)
+        return original(question)
+
+    monkeypatch.setattr(rag, "_run_query_pipeline", hanging_pipeline)
+    leader_result = {}
+    leader = threading.Thread(target=lambda: leader_result.update(rag.query("什麼是機器學習？")))
+    leader.start()
+    entered.wait(timeout=5)
+    try:
+        follower = rag.query("什麼是機器學習？")
+        assert not follower["success"]
+        assert follower["status_code"] == 504
+        assert follower["response_time"] < 2.0
+        assert rag.metrics.counter("rag_queries_timeout_total") == 1
+    finally:
+        release.set()
+        leader.join(timeout=10)
+    assert leader_result["success"]
+
+def test_async_waiters_share_task_until_last_one_leaves(production):
+    flight = production.SingleFlight()
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.ado("q", slow) for _ in range(5)))
+        assert results == [("answer", False)] + [("answer", True)] * 4
+        assert len(calls) == 1
+
+        # 一位等待者取消不影響其他人；全部離開後共用的工作才被取消
+        first = asyncio.ensure_future(flight.ado("r", slow))
+        second = asyncio.ensure_future(flight.ado("r", slow))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == ("answer", True)
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        lone = asyncio.ensure_future(flight.ado("s", slow))
+        await asyncio.sleep(0)
+        task = flight._tasks["s"]
+        lone.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await lone
+        await asyncio.sleep(0)
+        assert task.cancelled()
+        assert flight._tasks == {} and flight._waiters == {}
+
+    asyncio.run(scenario())